@@ -0,0 +1,327 @@
+import logging
+import threading
+import warnings
+from collections import deque
+from datetime import datetime, timedelta, timezone
+import numpy as np
+import pandas as pd
+
+# --- Configuration & Constants ---
+# Look-back windows; each keeps its own incrementally updated state
+ANALYSIS_WINDOWS = {"1D": timedelta(days=1), "7D": timedelta(days=7), "30D": timedelta(days=30)}
+# A pair needs this many overlapping returns before its correlation is reported
+MIN_OVERLAP = 10
+# Flag thresholds for the latest return: plain z-score and MAD-based robust z-score
+Z_THRESHOLD = 3.0
+MAD_THRESHOLD = 3.5
+# Phi^-1(0.75): scales the MAD to a standard deviation for normally distributed returns
+MAD_SCALE = 0.6745
+# The running sums are recomputed from the buffered returns every this many updates, against float drift
+RESYNC_EVERY = 500
+
+logger = logging.getLogger(__name__)
+
+
+def align_prices(series, coins):
+    """
+    Pivots backend.history_by_coin output into a (snapshots x coins) price
+    matrix on the union of timestamps, NaN where a coin has no row.
+    Returns (epochs, matrix).
+    """
+    if not series:
+        return np.empty(0), np.empty((0, len(coins)))
+    epochs = np.unique(np.concatenate([t for t, _ in series.values()]))
+    matrix = np.full((len(epochs), len(coins)), np.nan)
+    for j, coin_id in enumerate(coins):
+        if coin_id in series:
+            t, v = series[coin_id]
+            matrix[np.searchsorted(epochs, t), j] = v
+    return epochs, matrix
+
+def log_returns(prices):
+    """
+    Snapshot-to-snapshot log returns; NaN where either price is missing or not positive.
+    """
+    with np.errstate(divide="ignore", invalid="ignore"):
+        log_prices = np.log(np.where(prices > 0, prices, np.nan))
+    return np.diff(log_prices, axis=0)
+
+
+class RollingCorrelation:
+    """
+    Pairwise-complete correlation over a sliding time window of return rows.
+
+    Keeps five (coins x coins) running sums: overlap counts n, sums of x
+    and x^2 over each pair's overlap, and the cross products x.y. New
+    rows are added and expired rows subtracted with one matrix product
+    each, so an update costs O(rows * coins^2) instead of a rescan of
+    the whole window.
+    """
+
+    def __init__(self, n_coins, window_seconds):
+        self.window_seconds = window_seconds
+        # (epochs, returns) blocks, oldest first; a return is stamped with the
+        # snapshot it starts from, so it expires together with that snapshot
+        self.blocks = deque()
+        self.updates = 0
+        self._reset(n_coins)
+
+    def _reset(self, n_coins):
+        self.n = np.zeros((n_coins, n_coins))
+        self.sx = np.zeros((n_coins, n_coins))
+        self.sxx = np.zeros((n_coins, n_coins))
+        self.sxy = np.zeros((n_coins, n_coins))
+
+    def _accumulate(self, rows, sign):
+        present = ~np.isnan(rows)
+        x = np.where(present, rows, 0.0)
+        m = present.astype(np.float64)
+        # sx[i, j] = sum of x_i over the rows where both i and j are present
+        self.n += sign * (m.T @ m)
+        self.sx += sign * (x.T @ m)
+        self.sxx += sign * ((x * x).T @ m)
+        self.sxy += sign * (x.T @ x)
+
+    def extend(self, epochs, rows):
+        if not len(rows):
+            return
+        self.blocks.append((epochs, rows))
+        self._accumulate(rows, 1.0)
+        self.updates += 1
+        if self.updates % RESYNC_EVERY == 0:
+            self.resync()
+
+    def evict(self, cutoff):
+        """
+        Subtracts and drops rows older than `cutoff` (epoch seconds).
+        """
+        while self.blocks:
+            epochs, rows = self.blocks[0]
+            expired = int(np.searchsorted(epochs, cutoff, side="left"))
+            if not expired:
+                break
+            self._accumulate(rows[:expired], -1.0)
+            if expired == len(epochs):
+                self.blocks.popleft()
+            else:
+                self.blocks[0] = (epochs[expired:], rows[expired:])
+
+    def resync(self):
+        self._reset(self.n.shape[0])
+        if self.blocks:
+            self._accumulate(self.returns(), 1.0)
+
+    def returns(self):
+        """
+        Returns the buffered (rows x coins) return matrix, oldest first.
+        """
+        if not self.blocks:
+            return np.empty((0, self.n.shape[0]))
+        return np.concatenate([rows for _, rows in self.blocks])
+
+    def correlation(self, min_overlap=MIN_OVERLAP):
+        n, sx, sxx = self.n, self.sx, self.sxx
+        cov = n * self.sxy - sx * sx.T
+        var = (n * sxx - sx * sx) * (n * sxx.T - sx.T * sx.T)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            corr = cov / np.sqrt(var)
+        corr[(n < min_overlap) | ~(var > 0)] = np.nan
+        np.clip(corr, -1.0, 1.0, out=corr)
+        diagonal = np.diagonal(corr).copy()
+        np.fill_diagonal(corr, np.where(np.isnan(diagonal), np.nan, 1.0))
+        return corr
+
+    def zscores(self):
+        """
+        Returns (latest return, z-score, robust z-score) per coin for the newest row.
+        """
+        returns = self.returns()
+        if not len(returns):
+            empty = np.full(self.n.shape[0], np.nan)
+            return empty, empty, empty
+        latest = returns[-1]
+        count = np.diagonal(self.n)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            mean = np.diagonal(self.sx) / count
+            std = np.sqrt(np.maximum(np.diagonal(self.sxx) / count - mean * mean, 0.0) * count / (count - 1))
+            z = (latest - mean) / std
+            with warnings.catch_warnings():
+                warnings.simplefilter("ignore", RuntimeWarning)  # all-NaN columns
+                median = np.nanmedian(returns, axis=0)
+                mad = np.nanmedian(np.abs(returns - median), axis=0)
+            robust = MAD_SCALE * (latest - median) / mad
+        z[~np.isfinite(z)] = np.nan
+        robust[~np.isfinite(robust)] = np.nan
+        return latest, z, robust
+
+
+class WindowAnalytics:
+    """
+    Correlation matrix and anomaly flags for one look-back window.
+
+    The first refresh() pulls the window's history in one grouped backend
+    query; later calls fetch only the snapshots after the last one applied
+    and fold them in incrementally. A coin new to the window triggers a
+    rebuild. Rows backfilled before the last applied snapshot (e.g. by
+    replay) are picked up on the next rebuild().
+    """
+
+    def __init__(self, window, field="current_price"):
+        self.window = window
+        self.field = field
+        self.coins = []
+        self.index = {}
+        self.rolling = None
+        self.last_epoch = None
+        self.last_prices = None
+        self.version = 0
+        self._cache = {}
+        self._lock = threading.Lock()
+
+    def rebuild(self, backend, now=None):
+        now = now or datetime.now(timezone.utc)
+        with self._lock:
+            self._rebuild(backend, now)
+
+    def _rebuild(self, backend, now):
+        series = backend.history_by_coin(start=now - self.window, end=now, field=self.field)
+        self.coins = sorted(series)
+        self.index = {coin_id: i for i, coin_id in enumerate(self.coins)}
+        epochs, prices = align_prices(series, self.coins)
+        self.rolling = RollingCorrelation(len(self.coins), self.window.total_seconds())
+        self.rolling.extend(epochs[:-1], log_returns(prices))
+        self.last_epoch = epochs[-1] if len(epochs) else None
+        self.last_prices = prices[-1] if len(epochs) else None
+        self._changed()
+        logger.info(f"Rebuilt {self.window} analytics: {len(self.coins)} coins x {len(epochs)} snapshots")
+        return len(epochs)
+
+    def _changed(self):
+        self.version += 1
+        self._cache = {}
+
+    def refresh(self, backend, now=None):
+        """
+        Applies snapshots recorded since the last refresh. Returns how many were applied.
+        """
+        now = now or datetime.now(timezone.utc)
+        with self._lock:
+            if self.last_epoch is None:
+                return self._rebuild(backend, now)
+
+            since = datetime.fromtimestamp(self.last_epoch, tz=timezone.utc)
+            series = {}
+            for coin_id, (t, v) in backend.history_by_coin(start=since, end=now, field=self.field).items():
+                fresh = t > self.last_epoch
+                if fresh.any():
+                    series[coin_id] = (t[fresh], v[fresh])
+            if series.keys() - self.index.keys():
+                return self._rebuild(backend, now)
+
+            blocks = len(self.rolling.blocks)
+            if series:
+                epochs, prices = align_prices(series, self.coins)
+                starts = np.concatenate([[self.last_epoch], epochs[:-1]])
+                self.rolling.extend(starts, log_returns(np.vstack([self.last_prices, prices])))
+                self.last_epoch, self.last_prices = epochs[-1], prices[-1]
+            self.rolling.evict(now.timestamp() - self.window.total_seconds())
+            if series or len(self.rolling.blocks) != blocks:
+                self._changed()
+            return len(epochs) if series else 0
+
+    def _cached(self, key, compute):
+        with self._lock:
+            if key not in self._cache:
+                self._cache[key] = compute()
+            return self._cache[key]
+
+    def correlation(self, coins=None, min_overlap=MIN_OVERLAP):
+        """
+        Returns the correlation matrix as a DataFrame labelled by coin_id
+        (optionally restricted to `coins`, in that order).
+        """
+        if self.rolling is None:
+            return pd.DataFrame()
+        matrix = self._cached(("corr", min_overlap), lambda: self.rolling.correlation(min_overlap))
+        if coins is None:
+            return pd.DataFrame(matrix, index=self.coins, columns=self.coins)
+        coins = [coin_id for coin_id in coins if coin_id in self.index]
+        idx = [self.index[coin_id] for coin_id in coins]
+        return pd.DataFrame(matrix[np.ix_(idx, idx)], index=coins, columns=coins)
+
+    def top_pairs(self, n=10, min_overlap=MIN_OVERLAP):
+        """
+        Returns the n most strongly (positively or negatively) correlated pairs.
+        """
+        if self.rolling is None:
+            return pd.DataFrame(columns=["coin_a", "coin_b", "correlation"])
+        matrix = self._cached(("corr", min_overlap), lambda: self.rolling.correlation(min_overlap))
+        upper_i, upper_j = np.triu_indices(len(self.coins), k=1)
+        values = matrix[upper_i, upper_j]
+        valid = np.flatnonzero(~np.isnan(values))
+        order = valid[np.argsort(-np.abs(values[valid]), kind="stable")[:n]]
+        return pd.DataFrame({
+            "coin_a": [self.coins[i] for i in upper_i[order]],
+            "coin_b": [self.coins[j] for j in upper_j[order]],
+            "correlation": values[order],
+        })
+
+    def anomalies(self, z_threshold=Z_THRESHOLD, mad_threshold=MAD_THRESHOLD):
+        """
+        Returns coins whose latest return is an outlier by z-score or robust
+        (MAD) z-score, most extreme first.
+        """
+        columns = ["coin_id", "log_return", "zscore", "robust_z"]
+        if self.rolling is None:
+            return pd.DataFrame(columns=columns)
+        latest, z, robust = self._cached("zscores", self.rolling.zscores)
+        with np.errstate(invalid="ignore"):
+            flagged = np.flatnonzero((np.abs(z) > z_threshold) | (np.abs(robust) > mad_threshold))
+        frame = pd.DataFrame({
+            "coin_id": [self.coins[i] for i in flagged],
+            "log_return": latest[flagged],
+            "zscore": z[flagged],
+            "robust_z": robust[flagged],
+        }, columns=columns)
+        return frame.reindex(frame["robust_z"].abs().sort_values(ascending=False).index).reset_index(drop=True)
+
+
+_analytics = {}
+_analytics_lock = threading.Lock()
+
+def get_analytics(window_key="7D"):
+    """
+    Returns the process-wide analytics state for one of ANALYSIS_WINDOWS.
+    """
+    if window_key not in ANALYSIS_WINDOWS:
+        raise ValueError(f"Unknown analysis window: {window_key}")
+    with _analytics_lock:
+        if window_key not in _analytics:
+            _analytics[window_key] = WindowAnalytics(ANALYSIS_WINDOWS[window_key])
+    return _analytics[window_key]
+
+
+def main(argv=None):
+    """
+    Prints the most correlated pairs and current anomalies for a window (`crypto-etl analytics`).
+    """
+    import argparse
+    from log_setup import configure_logging
+    from storage import get_backend
+
+    parser = argparse.ArgumentParser(description="Cross-coin return correlations and anomalies over history.")
+    parser.add_argument("--window", choices=list(ANALYSIS_WINDOWS), default="7D")
+    parser.add_argument("--top", type=int, default=10)
+    args = parser.parse_args(argv)
+
+    configure_logging("analytics")
+
+    analytics = get_analytics(args.window)
+    analytics.refresh(get_backend())
+    print(f"--- Most correlated pairs ({args.window}, {len(analytics.coins)} coins) ---")
+    print(analytics.top_pairs(args.top).to_string(index=False))
+    print("\n--- Anomalous latest returns ---")
+    print(analytics.anomalies().to_string(index=False))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,242 @@
+"""
+End-to-end pipeline benchmark against a local fake CoinGecko server.
+
+    python benchmarks/bench_e2e.py [--sizes 20 1000 20000] [--repeat 3] [--backend sqlite|mongo]
+                                   [--latency 0.05] [--rate-429 0.02] [--replay data_raw]
+                                   [--compare benchmarks/results/<earlier run>.json]
+
+Times each stage (extract, transform, latest upsert, unchanged re-upsert,
+history append, queries) per universe size and writes the results as JSON
+to benchmarks/results/, named after the git revision, so runs of two
+revisions can be compared with --compare. Runs in a scratch directory, so
+the repo's state/, data_raw/ and logs/ are left alone.
+"""
+import argparse
+import json
+import math
+import os
+import platform
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta, timezone
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+RESULTS_DIR = os.path.join(REPO_ROOT, "benchmarks", "results")
+sys.path.insert(0, REPO_ROOT)
+
+DEFAULT_SIZES = [20, 1000, 20000]
+STAGES = ["extract", "transform", "load_latest", "load_latest_unchanged", "load_history", "query", "total"]
+
+
+def git_revision():
+    try:
+        out = subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=REPO_ROOT,
+                             capture_output=True, text=True, check=True)
+        dirty = subprocess.run(["git", "status", "--porcelain", "--untracked-files=no"], cwd=REPO_ROOT,
+                               capture_output=True, text=True, check=True).stdout.strip()
+        return out.stdout.strip() + ("-dirty" if dirty else "")
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+def make_backend(kind, workdir, mongo_uri, run_no):
+    """
+    Returns an empty backend for one repetition.
+    """
+    if kind == "sqlite":
+        from storage import SQLiteBackend
+        return SQLiteBackend(os.path.join(workdir, f"bench_{run_no}.db"))
+
+    from db_mongo import get_client, ensure_indexes
+    from storage import MongoBackend
+    client = get_client(mongo_uri)
+    client.drop_database("crypto_bench")
+    db = client["crypto_bench"]
+    ensure_indexes(db, force=True)
+    return MongoBackend(db)
+
+
+def run_once(coins, per_page, concurrency, backend):
+    from extract import fetch_all_markets
+    from transform import transform_markets
+
+    timings = {}
+    started = time.perf_counter()
+
+    t = time.perf_counter()
+    pages = math.ceil(coins / per_page)
+    raw = fetch_all_markets(pages=pages, per_page=per_page, concurrency=concurrency, use_cache=False)
+    timings["extract"] = time.perf_counter() - t
+    if len(raw) != coins:
+        raise RuntimeError(f"Extract returned {len(raw)} of {coins} coins")
+
+    t = time.perf_counter()
+    docs = transform_markets(raw)
+    timings["transform"] = time.perf_counter() - t
+
+    t = time.perf_counter()
+    upsert = backend.upsert_latest(docs)
+    timings["load_latest"] = time.perf_counter() - t
+
+    t = time.perf_counter()
+    unchanged = backend.upsert_latest(docs)
+    timings["load_latest_unchanged"] = time.perf_counter() - t
+
+    t = time.perf_counter()
+    history = backend.append_history(docs)
+    timings["load_history"] = time.perf_counter() - t
+
+    t = time.perf_counter()
+    end = datetime.now(timezone.utc)
+    backend.top_n("market_cap", 10)
+    backend.top_n("price_change_24h", 10)
+    backend.history_series(docs[0]["coin_id"], end - timedelta(days=1), end)
+    backend.latest()
+    timings["query"] = time.perf_counter() - t
+
+    timings["total"] = time.perf_counter() - started
+    counts = {
+        "fetched": len(raw),
+        "transformed": len(docs),
+        "upserted": upsert["upserted"],
+        "skipped_unchanged": unchanged["skipped"],
+        "history_inserted": history["inserted"],
+    }
+    return timings, counts
+
+
+def summarize(samples):
+    return {
+        "min": min(samples),
+        "median": statistics.median(samples),
+        "max": max(samples),
+    }
+
+
+def bench_size(coins, args, workdir, replay_rows):
+    from fake_coingecko import FakeCoinGecko
+    import extract
+    import rate_limiter
+
+    per_page = min(coins, args.per_page)
+    # A permissive limiter, so the run measures the pipeline rather than the production token rate
+    rate_limiter._default_limiter = rate_limiter.RateLimiter(
+        state_file=os.path.join(workdir, "state", f"ratelimit_{coins}.json"),
+        rate=args.limiter_rate, capacity=args.limiter_rate, max_wait=30.0
+    )
+
+    runs = []
+    with FakeCoinGecko(coins, args.latency, args.rate_429, args.retry_after, replay_rows) as server:
+        extract.BASE_URL = server.base_url
+        for run_no in range(args.repeat):
+            backend = make_backend(args.backend, workdir, args.mongo_uri, f"{coins}_{run_no}")
+            try:
+                runs.append(run_once(coins, per_page, args.concurrency, backend))
+            finally:
+                backend.close()
+        server_counters = dict(server.counters)
+
+    stages = {stage: summarize([timings[stage] for timings, _ in runs]) for stage in STAGES}
+    best_total = stages["total"]["min"]
+    result = {
+        "coins": coins,
+        "pages": math.ceil(coins / per_page),
+        "per_page": per_page,
+        "stages": stages,
+        "coins_per_second": coins / best_total if best_total else None,
+        "counts": runs[-1][1],
+        "server": server_counters,
+        "limiter": rate_limiter.get_limiter().stats(),
+    }
+
+    print(f"\n{coins} coins ({result['pages']} pages, best of {args.repeat}):")
+    for stage in STAGES:
+        s = stages[stage]
+        print(f"  {stage:<22} {s['min'] * 1000:10.2f} ms   (median {s['median'] * 1000:10.2f} ms)")
+    print(f"  throughput             {result['coins_per_second']:10,.0f} coins/s; "
+          f"{server_counters['throttled']} of {server_counters['requests']} requests got 429")
+    return result
+
+
+def compare(current, baseline_path):
+    with open(baseline_path) as f:
+        baseline = json.load(f)
+    base_by_size = {entry["coins"]: entry for entry in baseline["results"]}
+
+    print(f"\nCompared with {baseline.get('revision')} ({os.path.basename(baseline_path)}); ratio = baseline / current min time:")
+    for entry in current["results"]:
+        base = base_by_size.get(entry["coins"])
+        if base is None:
+            continue
+        ratios = []
+        for stage in STAGES:
+            now, before = entry["stages"][stage]["min"], base["stages"].get(stage, {}).get("min")
+            if before and now:
+                ratios.append(f"{stage}={before / now:.2f}x")
+        print(f"  {entry['coins']:>6} coins: " + ", ".join(ratios))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", type=int, nargs="+", default=DEFAULT_SIZES)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--backend", choices=["sqlite", "mongo"], default="sqlite")
+    parser.add_argument("--mongo-uri", default="mongodb://localhost:27017",
+                        help="Local mongod used by --backend mongo (database crypto_bench is dropped)")
+    parser.add_argument("--per-page", type=int, default=250)
+    parser.add_argument("--concurrency", type=int, default=4)
+    parser.add_argument("--latency", type=float, default=0.05, help="Fake server delay per request (s)")
+    parser.add_argument("--rate-429", type=float, default=0.0, help="Share of requests answered with 429")
+    parser.add_argument("--retry-after", type=int, default=0)
+    parser.add_argument("--limiter-rate", type=float, default=1000.0, help="Client token rate during the run")
+    parser.add_argument("--replay", metavar="RAW_DIR", help="Serve rows replayed from data_raw payloads")
+    parser.add_argument("--output", help="Result file (default: benchmarks/results/e2e_<rev>_<time>.json)")
+    parser.add_argument("--compare", metavar="BASELINE_JSON", help="Earlier result file to compare against")
+    args = parser.parse_args()
+
+    from fake_coingecko import load_replay_rows
+    replay_rows = load_replay_rows(os.path.abspath(args.replay)) if args.replay else None
+    output = os.path.abspath(args.output) if args.output else None
+    baseline = os.path.abspath(args.compare) if args.compare else None
+
+    revision = git_revision()
+    workdir = tempfile.mkdtemp(prefix="crypto_bench_")
+    cwd = os.getcwd()
+    os.chdir(workdir)  # the pipeline writes state/, data_raw/ and logs/ relative to the cwd
+    try:
+        import logging
+        from log_setup import configure_logging
+        configure_logging("bench_e2e", level=logging.WARNING)
+
+        results = [bench_size(coins, args, workdir, replay_rows) for coins in args.sizes]
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    report = {
+        "benchmark": "e2e",
+        "revision": revision,
+        "ran_at": datetime.now(timezone.utc).isoformat(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "config": {k: v for k, v in vars(args).items() if k not in ("output", "compare")},
+        "results": results,
+    }
+    if output is None:
+        os.makedirs(RESULTS_DIR, exist_ok=True)
+        stamp = datetime.now(timezone.utc).strftime("%Y%m%d_%H%M%S")
+        output = os.path.join(RESULTS_DIR, f"e2e_{revision}_{stamp}.json")
+    with open(output, "w") as f:
+        json.dump(report, f, indent=2)
+    print(f"\nResults written to {output}")
+
+    if baseline:
+        compare(report, baseline)
+
+
+if __name__ == "__main__":
+    main()
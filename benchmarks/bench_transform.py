@@ -0,0 +1,154 @@
+"""
+Equivalence check and throughput benchmark for the two transform paths.
+
+    python benchmarks/bench_transform.py [--coins 20000] [--repeat 5] [--check]
+
+Fails (exit code 1) if transform_markets_columnar disagrees with the
+row-wise transform_markets on any archived snapshot, on the synthetic
+edge-case batch or on the null/NaN batches. --check skips the throughput run.
+"""
+import argparse
+import glob
+import json
+import math
+import os
+import random
+import sys
+import time
+from datetime import datetime, timezone
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from transform import transform_markets, transform_markets_columnar, frame_to_docs
+
+
+def synthetic_markets(n, seed=42, with_edge_cases=True):
+    """
+    Builds n CoinGecko-shaped rows, optionally sprinkled with the dirty values
+    the row-wise transform has to cope with.
+    """
+    rng = random.Random(seed)
+    rows = []
+    for i in range(n):
+        rows.append({
+            "id": f"coin-{i}",
+            "symbol": f"c{i}",
+            "name": f"Coin {i}",
+            "current_price": rng.uniform(0.0001, 70000),
+            "market_cap": rng.randint(0, 10**12),
+            "total_volume": rng.uniform(0, 10**10),
+            "price_change_percentage_24h": rng.uniform(-30, 30),
+            "market_cap_rank": i + 1,
+            "last_updated": "2026-03-01T00:00:00.000Z",
+        })
+    if with_edge_cases and n >= 10:
+        rows[1]["id"] = None                        # dropped: missing coin_id
+        rows[2].pop("id")                           # dropped: missing coin_id
+        rows[3]["current_price"] = None             # null -> 0
+        rows[4]["price_change_percentage_24h"] = None
+        rows[5]["market_cap_rank"] = None           # rank stays None
+        rows[6]["total_volume"] = "123.5"           # numeric string is accepted
+        rows[7]["market_cap"] = "n/a"               # dropped: bad cast
+        rows[8]["symbol"] = None                    # str(None).upper() -> "NONE"
+        rows[9].pop("symbol")                       # missing symbol -> ""
+    return rows
+
+
+def null_markets(with_strings):
+    """
+    Builds rows with None, NaN and "nan" in every numeric field. NaN and None
+    must end up as 0 (or rank None) on both paths. with_strings adds a
+    numeric string to each column, which sends the columnar path down its
+    per-value fallback instead of the NumPy cast.
+    """
+    nan = float("nan")
+    rows = synthetic_markets(12, seed=7, with_edge_cases=False)
+    fields = ["current_price", "market_cap", "total_volume", "price_change_percentage_24h", "market_cap_rank"]
+    for field in fields:
+        rows[0][field] = nan
+        rows[1][field] = None
+    rows[2]["market_cap_rank"] = float("inf")      # dropped: int(inf) overflows
+    rows[3]["current_price"] = float("inf")        # kept as inf on both paths
+    rows[4]["market_cap_rank"] = 5.9               # truncated to 5
+    if with_strings:
+        for field in fields:
+            rows[5][field] = "7"
+        rows[6]["current_price"] = "nan"           # parsed to NaN -> 0
+        rows[7]["market_cap_rank"] = "nan"         # dropped: int("nan") fails
+    return rows
+
+
+def _same(a, b):
+    if isinstance(a, float) and isinstance(b, float):
+        return a == b or (math.isnan(a) and math.isnan(b))
+    return a == b
+
+
+def check_equivalence(raw_list, label):
+    extracted_at = datetime.now(timezone.utc)
+    expected = transform_markets(raw_list, extracted_at=extracted_at)
+    frame, invalid_rows = transform_markets_columnar(raw_list, extracted_at=extracted_at)
+    actual = frame_to_docs(frame)
+
+    problems = []
+    if len(expected) != len(actual):
+        problems.append(f"row count {len(expected)} != {len(actual)}")
+    if len(expected) + len(invalid_rows) != len(raw_list):
+        problems.append(f"{len(invalid_rows)} invalid rows reported, expected {len(raw_list) - len(expected)}")
+    for exp, act in zip(expected, actual):
+        for key in exp:
+            if not _same(exp[key], act[key]):
+                problems.append(f"{exp['coin_id']}.{key}: {exp[key]!r} != {act[key]!r}")
+                break
+        if len(problems) > 5:
+            break
+
+    status = "OK" if not problems else "MISMATCH"
+    print(f"[{status}] {label}: {len(raw_list)} rows")
+    for problem in problems:
+        print(f"    {problem}")
+    return not problems
+
+
+def bench(fn, raw_list, repeat):
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn(raw_list)
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--coins", type=int, default=20000)
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--check", action="store_true", help="Only run the equivalence checks")
+    args = parser.parse_args()
+
+    # The per-row transform logs every bad row; keep the benchmark output readable
+    import logging
+    logging.getLogger("transform").setLevel(logging.ERROR)
+
+    ok = check_equivalence(synthetic_markets(1000), "synthetic edge cases")
+    ok &= check_equivalence(null_markets(with_strings=False), "null/NaN, numeric columns")
+    ok &= check_equivalence(null_markets(with_strings=True), "null/NaN, mixed-type columns")
+    for path in sorted(glob.glob("data_raw/markets_*.json")):
+        with open(path) as f:
+            ok &= check_equivalence(json.load(f), os.path.basename(path))
+    if args.check:
+        sys.exit(0 if ok else 1)
+
+    raw_list = synthetic_markets(args.coins, with_edge_cases=False)
+    row_wise = bench(transform_markets, raw_list, args.repeat)
+    columnar = bench(transform_markets_columnar, raw_list, args.repeat)
+    print(f"\nThroughput over {args.coins} coins (best of {args.repeat}):")
+    print(f"  row-wise : {row_wise * 1000:8.2f} ms  ({args.coins / row_wise:12,.0f} coins/s)")
+    print(f"  columnar : {columnar * 1000:8.2f} ms  ({args.coins / columnar:12,.0f} coins/s)")
+    print(f"  speedup  : {row_wise / columnar:.1f}x")
+
+    sys.exit(0 if ok else 1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,185 @@
+"""
+Local stand-in for CoinGecko's /coins/markets endpoint.
+
+    python benchmarks/fake_coingecko.py [--coins 1000] [--latency 0.05] [--rate-429 0.02] [--replay data_raw]
+
+Serves synthetic rows (or rows replayed from archived data_raw payloads,
+tiled up to the requested size) with configurable per-request latency and a
+configurable share of 429 responses carrying Retry-After. Point
+extract.BASE_URL at `server.base_url` to run the pipeline against it.
+"""
+import argparse
+import glob
+import hashlib
+import json
+import os
+import random
+import sys
+import threading
+import time
+from datetime import datetime, timezone
+from email.utils import format_datetime
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+def synthetic_row(i, rng):
+    price = rng.uniform(0.0001, 70000) / (1 + i / 100)
+    return {
+        "id": f"coin-{i}",
+        "symbol": f"c{i}",
+        "name": f"Coin {i}",
+        "current_price": price,
+        "market_cap": price * rng.uniform(1e6, 1e9),
+        "total_volume": rng.uniform(1e3, 1e10),
+        "price_change_percentage_24h": rng.uniform(-30, 30),
+        "market_cap_rank": i + 1,
+        "last_updated": None,
+    }
+
+def load_replay_rows(raw_dir):
+    """
+    Returns the rows of the newest snapshot found in raw_dir (archive first, then legacy files).
+    """
+    from raw_archive import RawArchive, iter_legacy_files
+
+    archive_root = os.path.join(raw_dir, "archive")
+    if os.path.isdir(archive_root):
+        snapshot = RawArchive(archive_root).read_snapshot()
+        if snapshot and snapshot[1]:
+            return snapshot[1]
+    legacy = list(iter_legacy_files(raw_dir))
+    if not legacy:
+        raise FileNotFoundError(f"No raw snapshots found in {raw_dir}")
+    with open(legacy[-1][0]) as f:
+        return json.load(f)
+
+def build_universe(coins, replay_rows=None, seed=42):
+    """
+    Builds `coins` market rows in rank order. Replayed rows are tiled with
+    suffixed ids so the universe can be larger than the recorded snapshot.
+    """
+    rng = random.Random(seed)
+    if not replay_rows:
+        return [synthetic_row(i, rng) for i in range(coins)]
+
+    rows = []
+    for i in range(coins):
+        base = replay_rows[i % len(replay_rows)]
+        copy_no = i // len(replay_rows)
+        row = dict(base)
+        if copy_no:
+            row["id"] = f"{base.get('id')}-{copy_no}"
+        row["market_cap_rank"] = i + 1
+        rows.append(row)
+    return rows
+
+
+class FakeCoinGecko:
+    """
+    Threaded HTTP server answering /api/v3/coins/markets from an in-memory universe.
+
+    Every request gets `latency` seconds of delay; a `rate_429` share of them
+    is answered with 429 and `Retry-After: retry_after`. last_updated is
+    stamped per request, so repeated pulls look like fresh source versions.
+    """
+
+    def __init__(self, coins=1000, latency=0.0, rate_429=0.0, retry_after=0, replay_rows=None, seed=42):
+        self.universe = build_universe(coins, replay_rows, seed)
+        self.latency = latency
+        self.rate_429 = rate_429
+        self.retry_after = retry_after
+        self.rng = random.Random(seed)
+        self.rng_lock = threading.Lock()
+        self.counters = {"requests": 0, "throttled": 0, "bytes_sent": 0}
+        self.server = None
+
+    def _page(self, per_page, page):
+        stamp = datetime.now(timezone.utc).isoformat(timespec="milliseconds").replace("+00:00", "Z")
+        rows = self.universe[(page - 1) * per_page:page * per_page]
+        return [{**row, "last_updated": stamp} for row in rows]
+
+    def _handler(self):
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, *args):
+                pass
+
+            def do_GET(self):
+                url = urlparse(self.path)
+                fake.counters["requests"] += 1
+                if not url.path.endswith("/coins/markets"):
+                    self.send_error(404)
+                    return
+                if fake.latency:
+                    time.sleep(fake.latency)
+                with fake.rng_lock:
+                    throttled = fake.rng.random() < fake.rate_429
+                if throttled:
+                    fake.counters["throttled"] += 1
+                    self.send_response(429)
+                    self.send_header("Retry-After", str(fake.retry_after))
+                    self.end_headers()
+                    return
+
+                query = parse_qs(url.query)
+                per_page = min(int(query.get("per_page", ["100"])[0]), 250)
+                page = max(int(query.get("page", ["1"])[0]), 1)
+                body = json.dumps(fake._page(per_page, page)).encode()
+                fake.counters["bytes_sent"] += len(body)
+
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.send_header("ETag", f'"{hashlib.sha1(body).hexdigest()}"')
+                self.send_header("Last-Modified", format_datetime(datetime.now(timezone.utc), usegmt=True))
+                self.end_headers()
+                self.wfile.write(body)
+
+        return Handler
+
+    def start(self, host="127.0.0.1", port=0):
+        self.server = ThreadingHTTPServer((host, port), self._handler())
+        self.server.daemon_threads = True
+        threading.Thread(target=self.server.serve_forever, name="fake-coingecko", daemon=True).start()
+        return self
+
+    def stop(self):
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+            self.server = None
+
+    @property
+    def base_url(self):
+        host, port = self.server.server_address[:2]
+        return f"http://{host}:{port}/api/v3"
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Serve a fake CoinGecko /coins/markets endpoint.")
+    parser.add_argument("--coins", type=int, default=1000)
+    parser.add_argument("--latency", type=float, default=0.05, help="Seconds of delay per request")
+    parser.add_argument("--rate-429", type=float, default=0.0, help="Share of requests answered with 429")
+    parser.add_argument("--retry-after", type=int, default=1)
+    parser.add_argument("--replay", metavar="RAW_DIR", help="Serve rows from archived data_raw payloads")
+    parser.add_argument("--port", type=int, default=8765)
+    args = parser.parse_args()
+
+    replay_rows = load_replay_rows(args.replay) if args.replay else None
+    server = FakeCoinGecko(args.coins, args.latency, args.rate_429, args.retry_after, replay_rows).start(port=args.port)
+    print(f"Serving {args.coins} coins at {server.base_url} (Ctrl+C to stop)")
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        server.stop()
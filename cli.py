@@ -0,0 +1,88 @@
+"""
+crypto-etl: one entry point for the pipeline's command-line tools.
+
+    python cli.py <command> [options]        python cli.py <command> --help
+
+Every command is its module's main(argv). The module is imported only when
+its command runs, so `run` never loads pandas or pymongo and `--help` loads
+none of the pipeline modules. `import-time` checks cold import times against
+IMPORT_BUDGET_MS (cron runs and Streamlit reruns pay them on every start).
+"""
+import argparse
+import importlib
+import os
+import subprocess
+import sys
+
+# --- Configuration & Constants ---
+# command -> (module whose main(argv) runs it, summary)
+COMMANDS = {
+    "run": ("etl_pipeline", "Run the ETL pipeline once"),
+    "schedule": ("scheduler", "Run the pipeline on a schedule (or once under the lease)"),
+    "replay": ("replay", "Rebuild history from archived raw snapshots"),
+    "export": ("history_export", "Export history to partitioned Parquet files"),
+    "snapshot": ("snapshot_service", "Serve the latest snapshot over HTTP"),
+    "analytics": ("analytics", "Print cross-coin correlations and anomalies"),
+    "rollups": ("rollups", "Rebuild OHLC rollups (MongoDB)"),
+    "spool": ("spool", "Show and drain the local load spool"),
+    "metrics": ("metrics", "Print the latest run as Prometheus metrics"),
+    "init-db": ("init_db", "Check the MongoDB connection and create indexes"),
+}
+IMPORT_TIME_COMMAND = "import-time"
+# Cold-start import budgets (ms, best of --repeat fresh interpreters).
+# Baseline before lazy imports: etl_pipeline ~510 ms, scheduler ~520 ms.
+IMPORT_BUDGET_MS = {
+    "cli": 25,
+    "etl_pipeline": 120,
+    "scheduler": 160,
+    "storage": 50,
+    "snapshot_service": 80,
+}
+REPO_ROOT = os.path.dirname(os.path.abspath(__file__))
+
+
+def _import_ms(module):
+    code = f"import time; t = time.perf_counter(); import {module}; print((time.perf_counter() - t) * 1000)"
+    out = subprocess.run([sys.executable, "-c", code], cwd=REPO_ROOT, capture_output=True, text=True, check=True)
+    return float(out.stdout.split()[-1])
+
+def check_import_times(argv=None):
+    """
+    Times each IMPORT_BUDGET_MS module in fresh interpreters; exits non-zero if any is over budget.
+    """
+    parser = argparse.ArgumentParser(prog=f"crypto-etl {IMPORT_TIME_COMMAND}",
+                                     description="Check cold import times against IMPORT_BUDGET_MS.")
+    parser.add_argument("--repeat", type=int, default=3, help="Fresh interpreters per module; the best time counts")
+    args = parser.parse_args(argv)
+
+    over = 0
+    for module, budget in IMPORT_BUDGET_MS.items():
+        best = min(_import_ms(module) for _ in range(args.repeat))
+        over += best > budget
+        print(f"{module:<18} {best:7.1f} ms   budget {budget:4d} ms   {'OVER' if best > budget else 'ok'}")
+    return 1 if over else 0
+
+def main(argv=None):
+    """
+    Parses `<command> [options]` and hands the options to the command's module.
+    """
+    listing = "\n".join(f"  {name:<12} {summary}" for name, (_, summary) in COMMANDS.items())
+    parser = argparse.ArgumentParser(
+        prog="crypto-etl", formatter_class=argparse.RawDescriptionHelpFormatter,
+        description="Crypto market ETL command-line tools.",
+        epilog=f"commands:\n{listing}\n  {IMPORT_TIME_COMMAND:<12} Check cold import times against their budgets"
+    )
+    parser.add_argument("command", choices=[*COMMANDS, IMPORT_TIME_COMMAND], metavar="command")
+    parser.add_argument("args", nargs=argparse.REMAINDER, help="Options for the command (see <command> --help)")
+    args = parser.parse_args(argv)
+
+    if args.command == IMPORT_TIME_COMMAND:
+        return check_import_times(args.args)
+    module_name, _ = COMMANDS[args.command]
+    # The command's own argparse usage then reads "crypto-etl <command>"
+    sys.argv[0] = f"crypto-etl {args.command}"
+    return importlib.import_module(module_name).main(args.args)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
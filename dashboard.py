@@ -1,11 +1,17 @@
+import os
 import streamlit as st
 import pandas as pd
 import plotly.express as px
 import plotly.graph_objects as go
-from datetime import datetime, timezone
+from datetime import datetime, timedelta, timezone
 from streamlit_autorefresh import st_autorefresh
-from db_mongo import get_db
-from etl_pipeline import run_etl
+from storage import get_backend
+from analytics import ANALYSIS_WINDOWS, MAD_THRESHOLD, Z_THRESHOLD, get_analytics
+from snapshot_service import SnapshotClient
+from log_setup import configure_logging
+
+# Read the latest snapshot from a snapshot service (e.g. scheduler.py --serve-snapshot) instead of the database
+SNAPSHOT_URL = os.getenv("SNAPSHOT_URL")
 
 # --- Page Configuration ---
 st.set_page_config(
@@ -33,21 +39,116 @@ st.markdown("""
     """, unsafe_allow_html=True)
 
 # --- Helper Functions ---
+@st.cache_resource
+def setup_logging():
+    # Streamlit reruns this script per interaction; cached, logging is configured once per server
+    return configure_logging("dashboard")
+
+setup_logging()
+
+@st.cache_resource
+def get_cached_backend():
+    # One shared backend (Mongo client/pool or SQLite connection) for every session and rerun of this server
+    return get_backend()
+
+@st.cache_resource
+def get_snapshot_client():
+    return SnapshotClient(SNAPSHOT_URL)
+
+@st.cache_data(ttl=5, show_spinner=False)
+def current_snapshot_version():
+    # One tiny meta lookup every few seconds, shared by all viewers
+    if SNAPSHOT_URL:
+        return get_snapshot_client().get("/version")["version"]
+    return get_cached_backend().snapshot_version()
+
+@st.cache_data(max_entries=2, show_spinner=False)
+def load_snapshot(version):
+    # Keyed on the version run_etl bumps: every viewer shares one load per snapshot
+    if SNAPSHOT_URL:
+        df = pd.DataFrame(get_snapshot_client().get("/snapshot")["coins"])
+        for column in ('extracted_at', 'last_updated'):
+            if column in df.columns:
+                df[column] = pd.to_datetime(df[column], utc=True, format="ISO8601")
+        return df
+    df = pd.DataFrame(get_cached_backend().latest())
+    return df
+
 def load_data():
-    db = get_db()
-    cursor = db.crypto_market.find({}, {"_id": 0})
-    df = pd.DataFrame(list(cursor))
+    return load_snapshot(current_snapshot_version())
+
+@st.cache_data(ttl=60, show_spinner=False)
+def load_stage_latencies(days=7):
+    # One row per (run, stage) from etl_runs, for the pipeline performance panel
+    since = datetime.now(timezone.utc) - timedelta(days=days)
+    rows = [
+        {"started_at": run["started_at"], "mode": run.get("mode"), "status": run.get("status"),
+         "stage": stage, "seconds": entry["seconds"]}
+        for run in get_cached_backend().recent_runs(limit=5000, since=since)
+        for stage, entry in run.get("stages", {}).items()
+    ]
+    return pd.DataFrame(rows, columns=["started_at", "mode", "status", "stage", "seconds"])
+
+def _utc(value):
+    ts = pd.Timestamp(value)
+    return ts.tz_localize("UTC") if ts.tzinfo is None else ts.tz_convert("UTC")
+
+def last_load_time(df, last_runs):
+    # Unchanged coins are skipped by the upsert and keep the extracted_at of their
+    # last change, so the newest successful run also counts as an update
+    times = [_utc(df['extracted_at'].max())]
+    run = next((run for run in last_runs if run.get("status") == "success"), None)
+    if run is not None:
+        times.append(_utc(run["started_at"]))
+    return max(times)
+
+CURRENCY_SYMBOLS = {"usd": "$", "eur": "€", "btc": "₿", "jpy": "¥", "gbp": "£"}
+QUOTE_COLUMNS = {"price": "current_price", "market_cap": "market_cap", "total_volume": "total_volume", "price_change_24h": "price_change_24h"}
+
+def in_currency(df, currency):
+    # Swap the USD top-level figures for quotes.<currency> when a multi-currency run stored them
+    if currency == "usd" or 'quotes' not in df.columns:
+        return df
+    df = df.copy()
+    quotes = df['quotes'].apply(lambda q: q.get(currency, {}) if isinstance(q, dict) else {})
+    for field, column in QUOTE_COLUMNS.items():
+        df[column] = quotes.apply(lambda q: q.get(field)).astype(float)
+    df['volatility_score'] = df['price_change_24h'].abs() * df['total_volume']
     return df
 
+@st.cache_data(ttl=60, show_spinner=False)
+def load_cross_coin(window_key, coins, version):
+    # The window's state lives in analytics and only folds in snapshots newer than its last refresh
+    analytics = get_analytics(window_key)
+    analytics.refresh(get_cached_backend())
+    return analytics.correlation(list(coins)), analytics.top_pairs(10), analytics.anomalies()
+
+HISTORY_RANGES = {"1D": timedelta(days=1), "7D": timedelta(days=7), "30D": timedelta(days=30), "1Y": timedelta(days=365)}
+
+@st.cache_data(ttl=60, show_spinner=False)
+def load_history(coin_id, range_key, version):
+    # Range filter and bucketing happen in the backend and LTTB in history_query,
+    # so a 1Y series is no larger than a 1D one
+    end = datetime.now(timezone.utc)
+    points = get_cached_backend().history_series(coin_id, end - HISTORY_RANGES[range_key], end)
+    return pd.DataFrame(points, columns=['extracted_at', 'current_price'])
+
 # --- Sidebar ---
 st.sidebar.title("🛠️ Actions")
 if st.sidebar.button("🚀 Run ETL Now"):
-    with st.spinner("Executing Pipeline..."):
-        result = run_etl(save_history=True)
-        if result["status"] == "success":
-            st.sidebar.success(f"ETL Complete! Fetched {result['fetched']} coins.")
-        else:
-            st.sidebar.error("ETL Failed! Check logs.")
+    # The scheduler daemon (scheduler.py) picks the request up; this session never blocks on the pipeline
+    request_id = get_cached_backend().enqueue_run_request(params={"save_history": True}, requested_by="dashboard")
+    st.sidebar.success(f"ETL run queued ({request_id[:8]}). The scheduler will pick it up shortly.")
+
+last_request = next(iter(get_cached_backend().recent_run_requests(limit=1)), None)
+if last_request is not None:
+    st.sidebar.caption(f"Last run request: {last_request['status']} "
+                       f"(queued {last_request['requested_at'].strftime('%H:%M:%S')} UTC)")
+last_run = next(iter(get_cached_backend().recent_runs(limit=1)), None)
+if last_run is not None and last_run.get("stages"):
+    slowest = max(last_run["stages"], key=lambda name: last_run["stages"][name]["seconds"])
+    st.sidebar.caption(f"Last ETL run: {last_run.get('status')} in {last_run['duration_seconds']:.2f}s; "
+                       f"slowest stage: {slowest} ({last_run['stages'][slowest]['seconds']:.2f}s)")
 
 st.sidebar.info("Auto-refreshing every 60 seconds.")
 
@@ -57,6 +158,12 @@ st.markdown("---")
 
 # Load Data from DB
 df = load_data()
+currencies = ["usd"]
+if 'quotes' in df.columns:
+    currencies += sorted({c for q in df['quotes'] if isinstance(q, dict) for c in q} - {"usd"})
+currency = st.sidebar.selectbox("Quote Currency", currencies, format_func=str.upper)
+symbol = CURRENCY_SYMBOLS.get(currency, currency.upper() + " ")
+df = in_currency(df, currency)
 
 if df.empty:
     st.warning("No data found in database. Please run ETL from the sidebar.")
@@ -68,12 +175,12 @@ else:
     top_gainer = df.loc[df['price_change_24h'].idxmax()]
     most_volatile = df.loc[df['volatility_score'].idxmax()]
     avg_price = df['current_price'].mean()
-    last_updated = df['extracted_at'].max()
+    last_updated = last_load_time(df, get_cached_backend().recent_runs(limit=20))
 
-    col1.metric("Total Market Cap (20)", f"${total_mcap/1e9:.2f}B")
+    col1.metric("Total Market Cap (20)", f"{symbol}{total_mcap/1e9:.2f}B")
     col2.metric("Top Gainer (24h%)", f"{top_gainer['symbol']}", f"{top_gainer['price_change_24h']:.2f}%")
     col3.metric("Most Volatile", f"{most_volatile['symbol']}")
-    col4.metric("Avg Price", f"${avg_price:,.2f}")
+    col4.metric("Avg Price", f"{symbol}{avg_price:,.2f}")
 
     st.caption(f"Last Database Update: {last_updated.strftime('%Y-%m-%d %H:%M:%S')} UTC")
     
@@ -88,7 +195,7 @@ else:
             df, x='symbol', y='market_cap', 
             color='market_cap', 
             hover_data=['name', 'current_price'],
-            labels={'market_cap': 'Market Cap ($)', 'symbol': 'Coin'},
+            labels={'market_cap': f'Market Cap ({symbol.strip()})', 'symbol': 'Coin'},
             template="plotly_dark",
             color_continuous_scale='Viridis'
         )
@@ -133,7 +240,82 @@ else:
         )
         st.plotly_chart(fig_vol_bar, use_container_width=True)
 
-    # 4. Data Table
+    # 4. Price History (downsampled)
+    st.markdown("---")
+    st.subheader("📉 Price History")
+    h1, h2 = st.columns([3, 1])
+    coin_labels = dict(zip(df['coin_id'], df['symbol'] + " — " + df['name'].astype(str)))
+    history_coin = h1.selectbox("Coin", list(coin_labels), format_func=coin_labels.get)
+    history_range = h2.radio("Range", list(HISTORY_RANGES), horizontal=True)
+    df_hist = load_history(history_coin, history_range, current_snapshot_version())
+    if df_hist.empty:
+        st.info("No history recorded for this coin in the selected range yet.")
+    else:
+        fig_hist = px.line(
+            df_hist, x='extracted_at', y='current_price',
+            labels={'extracted_at': 'Time (UTC)', 'current_price': 'Price ($)'},
+            template="plotly_dark"
+        )
+        st.plotly_chart(fig_hist, use_container_width=True)
+
+    # 5. Data Table
     st.markdown("---")
     st.subheader("📄 Detailed Market Data")
     st.dataframe(df[['market_cap_rank', 'symbol', 'name', 'current_price', 'price_change_24h', 'market_cap', 'volatility_score']], use_container_width=True)
+
+    # 6. Technical Indicators (computed incrementally at ingest, no history scan)
+    if 'indicators' in df.columns:
+        st.subheader("📐 Technical Indicators")
+        df_ind = pd.json_normalize(df['indicators'].apply(lambda v: v if isinstance(v, dict) else {}))
+        df_ind.insert(0, 'symbol', df['symbol'].values)
+        st.dataframe(df_ind, use_container_width=True)
+
+    # 6.1 Cross-Coin Correlation & Anomalies (return history, updated incrementally per window)
+    st.subheader("🔗 Cross-Coin Correlation & Anomalies")
+    window_key = st.radio("Window", list(ANALYSIS_WINDOWS), index=1, horizontal=True)
+    top_coins = tuple(df.sort_values('market_cap', ascending=False)['coin_id'].head(20))
+    df_corr, df_pairs, df_anom = load_cross_coin(window_key, top_coins, current_snapshot_version())
+    if df_corr.empty:
+        st.info("Not enough history in this window for correlations yet.")
+    else:
+        labels = dict(zip(df['coin_id'], df['symbol']))
+        a1, a2 = st.columns([2, 1])
+        fig_corr = px.imshow(
+            df_corr.rename(index=labels, columns=labels), zmin=-1, zmax=1,
+            color_continuous_scale='RdBu', template="plotly_dark",
+            labels={'color': 'Return Correlation'}
+        )
+        a1.plotly_chart(fig_corr, use_container_width=True)
+        a2.caption("Most correlated pairs (all coins)")
+        a2.dataframe(df_pairs, use_container_width=True, hide_index=True)
+        a2.caption(f"Anomalous latest returns (|z| > {Z_THRESHOLD:g} or robust |z| > {MAD_THRESHOLD:g})")
+        a2.dataframe(df_anom, use_container_width=True, hide_index=True)
+
+# 7. Pipeline Performance (per-stage latencies recorded in etl_runs)
+st.markdown("---")
+st.subheader("⏱️ Pipeline Stage Latencies")
+df_runs = load_stage_latencies()
+if df_runs.empty:
+    st.info("No ETL runs recorded yet.")
+else:
+    p1, p2 = st.columns([1, 3])
+    bucket = p1.radio("Bucket", ["Hourly", "Daily"], horizontal=True)
+    df_runs['bucket'] = pd.to_datetime(df_runs['started_at'], utc=True).dt.floor('h' if bucket == "Hourly" else 'D')
+    df_q = (
+        df_runs.groupby(['bucket', 'stage'])['seconds']
+        .quantile([0.5, 0.95]).unstack().rename(columns={0.5: 'p50', 0.95: 'p95'}).reset_index()
+    )
+    quantile = p1.radio("Quantile", ["p50", "p95"], horizontal=True)
+    fig_stages = px.line(
+        df_q, x='bucket', y=quantile, color='stage', markers=True,
+        labels={'bucket': 'Run Time', quantile: f'{quantile} Stage Latency (s)'},
+        template="plotly_dark"
+    )
+    p2.plotly_chart(fig_stages, use_container_width=True)
+
+    df_overall = (
+        df_runs.groupby('stage')['seconds'].quantile([0.5, 0.95]).unstack()
+        .rename(columns={0.5: 'p50 (s)', 0.95: 'p95 (s)'}).sort_values('p95 (s)', ascending=False)
+    )
+    df_overall['runs'] = df_runs.groupby('stage')['seconds'].count()
+    p1.dataframe(df_overall, use_container_width=True)
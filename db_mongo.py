@@ -1,38 +1,135 @@
 import os
-from dotenv import load_dotenv
-from pymongo import MongoClient, ASCENDING, DESCENDING
+import threading
+import time
+from datetime import datetime, timezone
 import logging
 
-import certifi
-
-# Load environment variables from .env
-load_dotenv()
-
-# Setup logging
-logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
 
 # Constants
+# Resolved on first use (from the environment, then .env); see _default_uri
 MONGO_URI = os.getenv("MONGO_URI")
 DB_NAME = "crypto_analytics"
 
+# Connection pool sizing (per process)
+MONGO_MAX_POOL_SIZE = int(os.getenv("MONGO_MAX_POOL_SIZE", "20"))
+MONGO_MIN_POOL_SIZE = int(os.getenv("MONGO_MIN_POOL_SIZE", "1"))
+# Seconds between liveness pings when a cached client is handed out
+HEALTH_CHECK_INTERVAL = float(os.getenv("MONGO_HEALTH_CHECK_INTERVAL", "60"))
+
+# Bump whenever ensure_indexes creates or changes an index
+INDEX_VERSION = 6
+
+# --- Process-wide client registry ---
+_clients = {}
+_last_health_check = {}
+_clients_lock = threading.Lock()
+_indexes_ensured = set()
+
+def _default_uri():
+    # dotenv and pymongo are imported on first connect, not on `import etl_pipeline`
+    global MONGO_URI
+    if MONGO_URI is None:
+        from dotenv import load_dotenv
+        load_dotenv()
+        MONGO_URI = os.getenv("MONGO_URI")
+    return MONGO_URI
+
+def _new_client(uri):
+    from pymongo import MongoClient
+
+    # Using 10s timeout for Atlas. Letting it use system CA store on Windows.
+    return MongoClient(
+        uri,
+        serverSelectionTimeoutMS=10000,
+        maxPoolSize=MONGO_MAX_POOL_SIZE,
+        minPoolSize=MONGO_MIN_POOL_SIZE
+    )
+
+def check_health(client):
+    """
+    Pings the deployment. Returns (ok, latency_ms).
+    """
+    started = time.monotonic()
+    try:
+        client.admin.command("ping")
+        return True, (time.monotonic() - started) * 1000
+    except Exception as e:
+        logger.warning(f"MongoDB health check failed: {e}")
+        return False, None
+
+def get_client(uri=None):
+    """
+    Returns the shared MongoClient for `uri`, creating it once per process.
+    
+    The client (and its connection pool, TLS sessions and SRV resolution) is
+    reused by every caller. At most every HEALTH_CHECK_INTERVAL seconds it is
+    pinged, and replaced if the ping fails.
+    """
+    uri = uri or _default_uri()
+    with _clients_lock:
+        client = _clients.get(uri)
+        if client is None:
+            client = _clients[uri] = _new_client(uri)
+            _last_health_check[uri] = time.monotonic()
+            return client
+        
+        if time.monotonic() - _last_health_check[uri] < HEALTH_CHECK_INTERVAL:
+            return client
+        _last_health_check[uri] = time.monotonic()
+    
+    ok, _ = check_health(client)
+    if not ok:
+        with _clients_lock:
+            if _clients.get(uri) is client:
+                logger.warning("Replacing unhealthy MongoDB client")
+                client.close()
+                _clients[uri] = _new_client(uri)
+                _indexes_ensured.difference_update({key for key in _indexes_ensured if key[0] == id(client)})
+            client = _clients[uri]
+    return client
+
+def close_clients():
+    """
+    Closes every registered client (for tests and clean shutdowns).
+    """
+    with _clients_lock:
+        for client in _clients.values():
+            client.close()
+        _clients.clear()
+        _last_health_check.clear()
+        _indexes_ensured.clear()
+
 def get_db():
     """
-    Initializes and returns the MongoDB database object.
+    Returns the MongoDB database object on the process-wide shared client.
     """
     try:
-        # Using 10s timeout for Atlas. Letting it use system CA store on Windows.
-        client = MongoClient(MONGO_URI, serverSelectionTimeoutMS=10000)
-        db = client[DB_NAME]
-        return db
+        return get_client()[DB_NAME]
     except Exception as e:
         logger.error(f"Failed to connect to MongoDB: {e}")
         raise
 
-def ensure_indexes(db):
+def ensure_indexes(db, force=False):
     """
     Ensures that the required indexes are created for performance and data integrity.
+    
+    Runs at most once per process and database. A {_id: "indexes", version}
+    stamp in the meta collection lets other processes skip the create_index
+    round trips until INDEX_VERSION changes. Pass force=True to re-issue them.
     """
+    from pymongo import ASCENDING, DESCENDING
+
+    key = (id(db.client), db.name)
+    if not force and key in _indexes_ensured:
+        return
+    
+    if not force:
+        stamp = db.meta.find_one({"_id": "indexes"})
+        if stamp and stamp.get("version") == INDEX_VERSION:
+            _indexes_ensured.add(key)
+            return
+    
     try:
         # Collection: crypto_market
         # Unique index on coin_id to prevent duplicate entries for the same coin
@@ -48,6 +145,68 @@ def ensure_indexes(db):
         db.crypto_market_history.create_index([("coin_id", ASCENDING), ("extracted_at", DESCENDING)])
         logger.info("Compound index created on crypto_market_history: (coin_id, extracted_at)")
 
+        # Unique (coin_id, last_updated) so unchanged CoinGecko quotes are not recorded twice.
+        # Partial on date-typed last_updated: rows written before the field existed stay valid.
+        db.crypto_market_history.create_index(
+            [("coin_id", ASCENDING), ("last_updated", ASCENDING)],
+            unique=True,
+            partialFilterExpression={"last_updated": {"$type": "date"}},
+            name="coin_id_last_updated_unique"
+        )
+        logger.info("Unique index created on crypto_market_history: (coin_id, last_updated)")
+
+        # OHLC rollup buckets: one doc per (coin_id, bucket start)
+        from rollups import GRANULARITIES
+        for _, collection in GRANULARITIES.values():
+            db[collection].create_index([("coin_id", ASCENDING), ("bucket", ASCENDING)], unique=True)
+            logger.info(f"Unique index created on {collection}: (coin_id, bucket)")
+
+        # Collection: etl_runs (per-run stage metrics, read newest first)
+        db.etl_runs.create_index([("started_at", DESCENDING)])
+        logger.info("Index created on etl_runs: started_at")
+
+        # Collection: etl_requests (run queue drained by scheduler.py)
+        db.etl_requests.create_index([("status", ASCENDING), ("requested_at", ASCENDING)])
+        logger.info("Index created on etl_requests: (status, requested_at)")
+
+        # At most one queued request: concurrent enqueue_run_request upserts collide here
+        db.etl_requests.create_index(
+            [("status", ASCENDING)],
+            unique=True,
+            partialFilterExpression={"status": "pending"},
+            name="one_pending_request"
+        )
+        logger.info("Unique partial index created on etl_requests: status (pending)")
+
+        db.meta.update_one(
+            {"_id": "indexes"},
+            {"$set": {"version": INDEX_VERSION, "ensured_at": datetime.now(timezone.utc)}},
+            upsert=True
+        )
+        _indexes_ensured.add(key)
+
     except Exception as e:
         logger.error(f"Error while creating indexes: {e}")
         raise
+
+def bump_snapshot_version(db, run_id=None):
+    """
+    Marks crypto_market as changed. Readers cache on this version instead of re-querying.
+    """
+    from pymongo import ReturnDocument
+
+    meta = db.meta.find_one_and_update(
+        {"_id": "snapshot"},
+        {"$inc": {"version": 1}, "$set": {"run_id": run_id, "updated_at": datetime.now(timezone.utc)}},
+        upsert=True,
+        return_document=ReturnDocument.AFTER
+    )
+    logger.info(f"Snapshot version bumped to {meta['version']}")
+    return meta["version"]
+
+def get_snapshot_version(db):
+    """
+    Returns the current crypto_market snapshot version (0 before the first bump).
+    """
+    meta = db.meta.find_one({"_id": "snapshot"}, {"version": 1})
+    return meta["version"] if meta else 0
@@ -1,31 +1,84 @@
 import logging
 import os
 import json
+import queue
+import threading
+import time
 from datetime import datetime, timezone
-from extract import fetch_markets
-from transform import transform_markets
-from load import upsert_latest, insert_history
-from db_mongo import get_db, ensure_indexes
-
-# --- Setup Logging ---
-LOGS_DIR = "logs"
-os.makedirs(LOGS_DIR, exist_ok=True)
-log_filename = os.path.join(LOGS_DIR, "etl_pipeline.log")
-
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(levelname)s - %(message)s',
-    handlers=[
-        logging.FileHandler(log_filename),
-        logging.StreamHandler()
-    ]
-)
+from extract import fetch_markets, fetch_all_markets, fetch_markets_multi, iter_market_pages, DEFAULT_CONCURRENCY
+from transform import transform_markets, transform_markets_batch, transform_multi_currency
+from market_batch import MarketBatch
+from indicators import get_engine
+from storage import get_backend
+from spool import get_spool, get_drainer
+import metrics
+
 logger = logging.getLogger(__name__)
 
-def run_etl(save_history: bool = True) -> dict:
+# Streaming mode: docs per load batch, and how many batches may wait for the loader
+LOAD_BATCH_SIZE = 500
+LOAD_QUEUE_SIZE = 4
+
+# Top-level price/volume/market-cap fields are always quoted in BASE_CURRENCY;
+# extra currencies (e.g. ETL_CURRENCIES=usd,eur,btc,jpy) go under quotes.<currency>
+BASE_CURRENCY = "usd"
+ETL_CURRENCIES = [c.strip().lower() for c in os.getenv("ETL_CURRENCIES", BASE_CURRENCY).split(",") if c.strip()]
+
+# "direct": write through the backend, spooling only what fails;
+# "spool": always append to the local spool and let the drainer load it
+ETL_LOAD_MODE = os.getenv("ETL_LOAD_MODE", "direct")
+# Seconds the __main__ runner waits for the spool to drain before exiting
+SPOOL_FLUSH_TIMEOUT = 30.0
+
+def run_etl(save_history: bool = True, pages: int = 1, per_page: int = 20,
+            streaming: bool = False, concurrency: int = DEFAULT_CONCURRENCY, backend=None,
+            currencies=None) -> dict:
     """
     Orchestrates the full ETL process: Extract -> Transform -> Load (Upsert + History).
+    With streaming=True the three stages overlap page by page (see _run_etl_streaming).
+    Loads go through `backend` (default: get_backend(), selected by STORAGE_BACKEND).
+    
+    Every run collects per-stage timings and counters (see metrics.py), which
+    are returned under "metrics", appended to etl_runs and written out as
+    Prometheus text.
+    
+    `currencies` (default: ETL_CURRENCIES) beyond BASE_CURRENCY are fetched
+    concurrently and merged into the same per-coin docs (batch mode only).
+    """
+    extra_currencies = [c for c in (currencies or ETL_CURRENCIES) if c != BASE_CURRENCY]
+    if streaming and extra_currencies:
+        raise ValueError("Streaming mode supports a single quote currency")
+    
+    run = metrics.start_run(mode="streaming" if streaming else "batch")
+    try:
+        if streaming:
+            summary = _run_etl_streaming(save_history, pages, per_page, concurrency, backend, run.run_id)
+        else:
+            summary = _run_etl_batch(save_history, pages, per_page, concurrency, backend, extra_currencies, run.run_id)
+    finally:
+        metrics.finish_run(run)
+    
+    summary["run_id"] = run.run_id
+    summary["metrics"] = _record_run(run, summary, backend)
+    return summary
+
+def _record_run(run, summary, backend=None):
     """
+    Persists the run's metrics to etl_runs and the Prometheus textfile.
+    Failures are logged but never fail the run itself.
+    """
+    run_doc = run.to_doc(summary)
+    try:
+        metrics.write_prometheus(run_doc)
+        (backend or get_backend()).record_run(run_doc)
+    except Exception as e:
+        logger.warning(f"Could not record metrics for run {run.run_id}: {e}")
+    return {
+        "stages": {name: round(entry["seconds"], 6) for name, entry in run_doc["stages"].items()},
+        "counters": run_doc["counters"],
+    }
+
+def _run_etl_batch(save_history, pages, per_page, concurrency, backend=None, extra_currencies=(), run_id=None):
     start_time = datetime.now(timezone.utc)
     logger.info(">>> Starting ETL Pipeline Orchestration...")
     
@@ -40,7 +93,17 @@ def run_etl(save_history: bool = True) -> dict:
     
     try:
         # 1. Extract
-        raw_data = fetch_markets(per_page=20)
+        with metrics.stage("extract"):
+            if extra_currencies:
+                # One fan-out for every currency; docs are merged per coin below
+                raw_by_currency = fetch_markets_multi([BASE_CURRENCY, *extra_currencies], pages=pages,
+                                                      per_page=per_page, concurrency=concurrency)
+                raw_data = raw_by_currency[BASE_CURRENCY]
+                summary["fetched_by_currency"] = {c: len(rows) for c, rows in raw_by_currency.items()}
+            elif pages > 1:
+                raw_data = fetch_all_markets(pages=pages, per_page=per_page, concurrency=concurrency)
+            else:
+                raw_data = fetch_markets(per_page=per_page)
         summary["fetched"] = len(raw_data) if raw_data else 0
         
         if not raw_data:
@@ -49,8 +112,14 @@ def run_etl(save_history: bool = True) -> dict:
             return summary
             
         # 2. Transform
-        docs = transform_markets(raw_data)
+        with metrics.stage("transform"):
+            if extra_currencies:
+                docs = transform_multi_currency(raw_by_currency, base_currency=BASE_CURRENCY)
+            else:
+                # Typed columns through to the load; dicts are only built at the database boundary
+                docs = transform_markets_batch(raw_data)
         summary["transformed"] = len(docs)
+        metrics.incr("records_transformed", len(docs))
         
         if not docs:
             logger.error("Transformation failed: No valid docs produced.")
@@ -58,35 +127,290 @@ def run_etl(save_history: bool = True) -> dict:
             return summary
             
         # 3. Load (Connect & Ensure Indexes)
-        db = get_db()
-        ensure_indexes(db)
+        backend, load_error = _connect(backend)
         
-        # 3.1 Upsert Latest Snapshot
-        upsert_res = upsert_latest(db, docs)
-        summary["upsert"] = upsert_res
+        # 3.1 Latest Snapshot carries incrementally updated indicators
+        with metrics.stage("indicators"):
+            latest_docs = with_indicators(backend, docs)
+            get_engine().save()
         
-        # 3.2 Insert History (Optional)
-        if save_history:
-            history_cnt = insert_history(db, docs)
-            summary["history_inserted"] = history_cnt
+        # 3.2 Upsert Latest + Insert History (Optional), or spool them; the backend bumps
+        #     the snapshot version and (Mongo) folds history into the OHLC rollups
+        upsert_res, history_res, write_error = _load_batch(backend, latest_docs, docs if save_history else [], run_id)
+        load_error = load_error or write_error
+        if upsert_res is None:
+            summary["spooled"] = len(latest_docs)
+        else:
+            summary["upsert"] = upsert_res
+        if history_res is not None:
+            summary["history_inserted"] = history_res["inserted"]
+            summary["history_duplicates"] = history_res["duplicates"]
+            if "rollups" in history_res:
+                summary["rollups"] = history_res["rollups"]
             
         end_time = datetime.now(timezone.utc)
         duration = (end_time - start_time).total_seconds()
+        summary["duration_seconds"] = duration
+        
+        if load_error is not None:
+            # Nothing is lost: the spool drainer retries the load once the database is back
+            summary["status"] = "spooled"
+            summary["error_message"] = str(load_error)
+            summary["error_type"] = type(load_error).__name__
+            logger.warning(f"<<< ETL Pipeline spooled its load after a storage error: {load_error}")
+            return summary
         
         summary["status"] = "success"
+        logger.info(f"<<< ETL Pipeline completed successfully in {duration:.2f}s.")
+        return summary
+        
+    except Exception as e:
+        logger.error(f"ETL Pipeline crashed: {e}")
+        summary["status"] = "error"
+        summary["error_message"] = str(e)
+        summary["error_type"] = type(e).__name__
+        return summary
+
+def _connect(backend=None):
+    """
+    Returns (backend, None), or (None, error) when the database is unreachable.
+    In spool mode only an explicitly passed backend is used, so loads never wait on the database.
+    """
+    if ETL_LOAD_MODE == "spool":
+        return backend, None
+    try:
+        with metrics.stage("index_ensure"):
+            backend = backend or get_backend()
+            backend.ensure_schema()
+        return backend, None
+    except Exception as e:
+        logger.error(f"Storage backend unavailable: {e}")
+        return None, e
+
+def _load_batch(backend, latest_docs, history_docs, run_id=None):
+    """
+    Writes one batch through the backend, or appends it to the fsync'd local
+    spool (in spool mode, without a backend, or when the write or the drain of
+    an older backlog fails) for the drainer to apply later. Returns
+    (upsert, history, error); upsert/history are None for a spooled batch.
+    `run_id` tags the snapshot version the batch writes (also when drained).
+    """
+    error = None
+    if backend is not None and ETL_LOAD_MODE != "spool":
+        try:
+            # Older spooled batches are applied first: drained later, their latest
+            # docs would overwrite this batch's newer ones. If that drain fails,
+            # this batch is spooled behind them.
+            if get_spool().has_pending():
+                get_drainer(backend).drain()
+            with metrics.stage("upsert"):
+                upsert_res = backend.upsert_latest(latest_docs, run_id=run_id)
+            if upsert_res.get("errors"):
+                raise RuntimeError(f"{upsert_res['errors']} of {len(latest_docs)} latest docs failed to upsert")
+            metrics.incr("records_upserted", upsert_res["upserted"] + upsert_res["modified"])
+            metrics.incr("records_skipped", upsert_res["skipped"])
+            
+            history_res = None
+            if history_docs:
+                with metrics.stage("history_insert"):
+                    history_res = backend.append_history(history_docs)
+                if history_res["errors"]:
+                    raise RuntimeError(f"{history_res['errors']} of {len(history_docs)} history docs failed to insert")
+                metrics.incr("records_history", history_res["inserted"])
+            # Hot in-memory snapshot readers see the batch right away (a no-op unless this process serves one)
+            from snapshot_service import publish
+            publish(latest_docs)
+            return upsert_res, history_res, None
+        except Exception as e:
+            # Replaying the whole batch is safe: both writes are idempotent
+            logger.error(f"Load failed: {e}. Spooling {len(latest_docs)} docs for a later drain.")
+            error = e
+    
+    spool = get_spool()
+    with metrics.stage("spool_write"):
+        spool.append("latest", latest_docs, run_id=run_id)
+        if history_docs:
+            spool.append("history", history_docs)
+    metrics.incr("records_spooled", len(latest_docs))
+    get_drainer(backend).wake()
+    return None, None, error
+
+def with_indicators(backend, docs):
+    """
+    Returns copies of `docs` for the latest snapshot with an `indicators`
+    sub-document (SMA/EMA/RSI/volatility) from the incremental engine.
+    History rows are left as-is; a MarketBatch gets an extra column sharing its arrays.
+    """
+    values = get_engine(backend).apply(docs)
+    if isinstance(docs, MarketBatch):
+        return docs.with_extra("indicators", [values[coin_id] for coin_id in docs.coin_id])
+    return [{**doc, "indicators": values[doc["coin_id"]]} for doc in docs]
+
+def _run_etl_streaming(save_history, pages, per_page, concurrency, backend=None, run_id=None):
+    """
+    Streaming variant of run_etl with bounded memory.
+    
+    Extraction yields pages as they arrive, each page is transformed on its
+    own, and a loader thread consumes fixed-size batches from a bounded
+    queue, so the first write happens after one page's latency and peak
+    memory stays at a few pages regardless of universe size. Reports the
+    same counts as run_etl.
+    """
+    start_time = datetime.now(timezone.utc)
+    started = time.monotonic()
+    logger.info(">>> Starting streaming ETL Pipeline Orchestration...")
+    
+    summary = {
+        "fetched": 0,
+        "transformed": 0,
+        "upsert": {"matched": 0, "modified": 0, "upserted": 0, "skipped": 0, "errors": 0, "total": 0},
+        "history_inserted": 0,
+        "history_duplicates": 0,
+        "spooled": 0,
+        "ran_at": start_time.isoformat(),
+        "status": "partial"
+    }
+    
+    batches = queue.Queue(maxsize=LOAD_QUEUE_SIZE)
+    loader_errors = []
+    load_errors = []
+    
+    def loader(backend):
+        while True:
+            batch = batches.get()
+            if batch is None:
+                return
+            if loader_errors:
+                continue  # drain so the producer never blocks on a dead loader
+            try:
+                with metrics.stage("indicators"):
+                    latest_docs = with_indicators(backend, batch)
+                upsert_res, history_res, write_error = _load_batch(
+                    None if load_errors else backend, latest_docs, batch if save_history else [], run_id)
+                if write_error is not None:
+                    load_errors.append(write_error)  # later batches go straight to the spool
+                if upsert_res is None:
+                    summary["spooled"] += len(latest_docs)
+                else:
+                    for key in summary["upsert"]:
+                        summary["upsert"][key] += upsert_res.get(key, 0)
+                if history_res is not None:
+                    summary["history_inserted"] += history_res["inserted"]
+                    summary["history_duplicates"] += history_res["duplicates"]
+                summary.setdefault("first_write_seconds", time.monotonic() - started)
+            except Exception as e:
+                loader_errors.append(e)
+    
+    loader_thread = None
+    try:
+        # Connect up front so the first batch can be written as soon as it is ready
+        backend, connect_error = _connect(backend)
+        if connect_error is not None:
+            load_errors.append(connect_error)
+        loader_thread = threading.Thread(target=loader, args=(backend,), name="etl-loader", daemon=True)
+        loader_thread.start()
+        
+        # One timestamp for the whole run, as in the batch path
+        extracted_at = datetime.now(timezone.utc)
+        pending = []
+        for page in iter_market_pages(pages=pages, per_page=per_page, concurrency=concurrency):
+            if loader_errors:
+                raise loader_errors[0]
+            summary["fetched"] += len(page)
+            with metrics.stage("transform"):
+                docs = transform_markets(page, extracted_at=extracted_at)
+            summary["transformed"] += len(docs)
+            metrics.incr("records_transformed", len(docs))
+            pending.extend(docs)
+            while len(pending) >= LOAD_BATCH_SIZE:
+                batches.put(pending[:LOAD_BATCH_SIZE])
+                pending = pending[LOAD_BATCH_SIZE:]
+        if pending:
+            batches.put(pending)
+        
+        batches.put(None)
+        loader_thread.join()
+        if loader_errors:
+            raise loader_errors[0]
+        with metrics.stage("indicators"):
+            get_engine().save()
+        
+        if not summary["fetched"]:
+            logger.error("Extraction failed: No data retrieved.")
+            summary["status"] = "failed"
+            return summary
+        if not summary["transformed"]:
+            logger.error("Transformation failed: No valid docs produced.")
+            summary["status"] = "failed"
+            return summary
+        
+        duration = (datetime.now(timezone.utc) - start_time).total_seconds()
         summary["duration_seconds"] = duration
         
-        logger.info(f"<<< ETL Pipeline completed successfully in {duration:.2f}s.")
+        if load_errors:
+            summary["status"] = "spooled"
+            summary["error_message"] = str(load_errors[0])
+            summary["error_type"] = type(load_errors[0]).__name__
+            logger.warning(f"<<< Streaming ETL Pipeline spooled its load after a storage error: {load_errors[0]}")
+            return summary
+        
+        summary["status"] = "success"
+        logger.info(f"<<< Streaming ETL Pipeline completed successfully in {duration:.2f}s.")
         return summary
         
     except Exception as e:
         logger.error(f"ETL Pipeline crashed: {e}")
+        if loader_thread is not None and loader_thread.is_alive():
+            loader_errors.append(e)
+            batches.put(None)
         summary["status"] = "error"
         summary["error_message"] = str(e)
+        summary["error_type"] = type(e).__name__
         return summary
 
-if __name__ == "__main__":
-    # Internal runner for verification
-    result = run_etl(save_history=True)
+def currency_args(parser, args):
+    """
+    Returns the --currencies list (None: ETL_CURRENCIES). Exits with a usage
+    error when --streaming is combined with currencies beyond BASE_CURRENCY.
+    """
+    currencies = [c.strip().lower() for c in args.currencies.split(",") if c.strip()] if args.currencies else None
+    if args.streaming and any(c != BASE_CURRENCY for c in currencies or ETL_CURRENCIES):
+        parser.error(f"--streaming supports only {BASE_CURRENCY}; currencies: {','.join(currencies or ETL_CURRENCIES)}")
+    return currencies
+
+def main(argv=None):
+    """
+    Runs the pipeline once under the scheduler's lease and prints its summary (`crypto-etl run`).
+    """
+    import argparse
+    from log_setup import configure_logging
+
+    parser = argparse.ArgumentParser(description="Run the ETL pipeline once.")
+    parser.add_argument("--pages", type=int, default=1)
+    parser.add_argument("--per-page", type=int, default=20)
+    parser.add_argument("--streaming", action="store_true")
+    parser.add_argument("--concurrency", type=int, default=DEFAULT_CONCURRENCY)
+    parser.add_argument("--currencies", help="Comma-separated quote currencies (default: ETL_CURRENCIES)")
+    parser.add_argument("--no-history", action="store_true", help="Only upsert the latest snapshot")
+    args = parser.parse_args(argv)
+    currencies = currency_args(parser, args)
+
+    configure_logging("etl_pipeline")
+    # Same lease as the scheduler, so a manual run never overlaps a scheduled one
+    from scheduler import Scheduler
+    scheduler = Scheduler()
+    with scheduler.lease() as held:
+        if not held:
+            logger.warning("ETL lease is held by another instance (a scheduled run is in progress); not running")
+            return 1
+        result = run_etl(save_history=not args.no_history, pages=args.pages, per_page=args.per_page,
+                         streaming=args.streaming, concurrency=args.concurrency, backend=scheduler.backend,
+                         currencies=currencies)
+    if not get_drainer(scheduler.backend).flush(timeout=SPOOL_FLUSH_TIMEOUT):
+        logger.warning("Spool not fully drained; the next run or the scheduler will finish it.")
     print("\n--- ETL Pipeline Summary ---")
     print(json.dumps(result, indent=2))
+    return 1 if result.get("status") in ("failed", "error") else 0
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -1,35 +1,53 @@
-import requests
-import json
-import os
 import time
 import logging
-from datetime import datetime
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+from rate_limiter import RateLimitError, get_limiter, parse_retry_after
+from http_cache import get_cache
+from raw_archive import get_archive
+import metrics
 
 # --- Configuration & Constants ---
 BASE_URL = "https://api.coingecko.com/api/v3"
-DATA_RAW_DIR = "data_raw"
-LOGS_DIR = "logs"
-
-# Ensure directories exist
-os.makedirs(DATA_RAW_DIR, exist_ok=True)
-os.makedirs(LOGS_DIR, exist_ok=True)
-
-# --- Logging Setup ---
-log_filename = os.path.join(LOGS_DIR, "extract.log")
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(levelname)s - %(message)s',
-    handlers=[
-        logging.FileHandler(log_filename),
-        logging.StreamHandler()
-    ]
-)
+
+# Concurrency for multi-page pulls. The pool is sized for the upper bound so
+# a single keep-alive session can serve any concurrency setting.
+DEFAULT_CONCURRENCY = 4
+MAX_POOL_SIZE = 16
+MAX_PER_PAGE = 250  # CoinGecko caps /coins/markets at 250 rows per page
+
 logger = logging.getLogger(__name__)
 
-def fetch_markets(vs_currency="usd", per_page=20, page=1):
+_session = None
+_session_lock = threading.Lock()
+
+def get_session():
     """
-    Fetches market data from CoinGecko API with retry logic and rate limit handling.
+    Returns the process-wide keep-alive session shared by all CoinGecko calls.
+    """
+    global _session
+    with _session_lock:
+        if _session is None:
+            import requests
+            from requests.adapters import HTTPAdapter
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=1, pool_maxsize=MAX_POOL_SIZE)
+            session.mount("https://", adapter)
+            session.mount("http://", adapter)
+            _session = session
+    return _session
+
+def _fetch_page(vs_currency, per_page, page, use_cache=True):
     """
+    Fetches a single /coins/markets page with retry logic and rate limit handling.
+    Returns (data, is_new); is_new is False when the page came from the response
+    cache or the server answered 304 Not Modified. Raises RateLimitError when
+    every attempt was throttled.
+    """
+    from requests.exceptions import RequestException  # loaded by get_session(); kept off the import path
+
     endpoint = f"{BASE_URL}/coins/markets"
     params = {
         "vs_currency": vs_currency,
@@ -42,49 +60,221 @@ def fetch_markets(vs_currency="usd", per_page=20, page=1):
     
     max_retries = 3
     backoff_factors = [1, 2, 4]
+    session = get_session()
+    limiter = get_limiter()
+    cache = get_cache()
+    
+    cache_key = cache.key(endpoint, params)
+    cached = cache.get(cache_key) if use_cache else None
+    if cache.is_fresh(cached):
+        metrics.incr("cache_hits")
+        logger.info(f"Cache hit: {vs_currency}, page {page} ({len(cached['data'])} coins)")
+        return cached["data"], False
     
     logger.info(f"Starting fetch: {vs_currency}, page {page}, per_page {per_page}")
     
     for attempt in range(max_retries):
+        if attempt:
+            metrics.incr("retries")
         try:
-            response = requests.get(endpoint, params=params, timeout=10)
+            # Blocks briefly for a shared token, or raises RateLimitError/CircuitOpenError
+            with metrics.stage("rate_limit_wait"):
+                limiter.acquire()
+            with metrics.stage("http_wait"):
+                response = session.get(endpoint, params=params, headers=cache.conditional_headers(cached), timeout=10)
+            metrics.incr("http_requests")
+            metrics.incr("http_bytes", len(response.content))
             
-            # Handle rate limiting (HTTP 429)
+            # Handle rate limiting (HTTP 429): the limiter holds every caller back until Retry-After
             if response.status_code == 429:
-                wait_time = (attempt + 1) * 30 # CoinGecko rate limits are strict, wait longer
-                logger.warning(f"Rate limit hit (429). Attempt {attempt + 1}/{max_retries}. Sleeping {wait_time}s...")
-                time.sleep(wait_time)
+                metrics.incr("http_429")
+                retry_after = parse_retry_after(response.headers.get("Retry-After"))
+                limiter.record_throttle(retry_after)
+                logger.warning(f"Rate limit hit (429) on page {page}. Attempt {attempt + 1}/{max_retries}. Retry-After: {retry_after}")
                 continue
+            
+            # Stale entry revalidated: keep the parsed payload, restart its TTL
+            if response.status_code == 304 and cached is not None:
+                metrics.incr("not_modified")
+                limiter.record_success()
+                cache.refresh(cache_key, cached)
+                logger.info(f"Not modified (304): {vs_currency}, page {page}")
+                return cached["data"], False
                 
             response.raise_for_status()
-            data = response.json()
-            
-            logger.info(f"Successfully fetched {len(data)} coins.")
-            
-            # Save raw data
-            timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-            filename = f"markets_{timestamp}.json"
-            filepath = os.path.join(DATA_RAW_DIR, filename)
+            with metrics.stage("json_parse"):
+                data = response.json()
+            metrics.incr("records_fetched", len(data))
+            limiter.record_success()
+            cache.put(cache_key, response.content, data,
+                      etag=response.headers.get("ETag"),
+                      last_modified=response.headers.get("Last-Modified"))
             
-            with open(filepath, "w") as f:
-                json.dump(data, f, indent=4)
+            logger.info(f"Successfully fetched {len(data)} coins (page {page}).")
+            return data, True
             
-            logger.info(f"Raw data saved to: {filepath}")
-            return data
-            
-        except requests.exceptions.RequestException as e:
-            logger.error(f"Attempt {attempt + 1} failed: {e}")
+        except RequestException as e:
+            metrics.incr("http_errors")
+            logger.error(f"Page {page} attempt {attempt + 1} failed: {e}")
             if attempt < max_retries - 1:
                 sleep_time = backoff_factors[attempt]
                 logger.info(f"Retrying in {sleep_time}s...")
                 time.sleep(sleep_time)
             else:
-                logger.critical("Max retries reached. Extraction failed.")
+                logger.critical(f"Max retries reached for page {page}. Extraction failed.")
                 raise
 
-    return None
+    # Still throttled: a missing page must fail the run, not look like the end of the listing
+    logger.critical(f"Page {page} still rate limited (429) after {max_retries} attempts. Extraction failed.")
+    raise RateLimitError(f"{vs_currency} page {page} still rate limited after {max_retries} attempts")
+
+def _save_raw(data, ts=None, page=None, vs_currency="usd"):
+    """
+    Appends a raw API response to the compressed data_raw/ archive for auditing and replay.
+    """
+    with metrics.stage("raw_write"):
+        entry = get_archive().append(data, ts=ts, page=page, vs_currency=vs_currency)
+    metrics.incr("raw_bytes", entry["length"])
+    logger.info(f"Raw data archived: {entry['segment']} @ {entry['offset']}")
+    return entry
+
+class _SnapshotPages:
+    """
+    Archives the pages of one multi-page run under its shared snapshot
+    timestamp. Replay reads a snapshot as one group, so cached (or 304)
+    pages are archived with it too, but only once the run has fetched a new
+    page: a run served entirely from cache adds no snapshot.
+    """
+
+    def __init__(self, ts, vs_currency="usd"):
+        self.ts = ts
+        self.vs_currency = vs_currency
+        self.held = []
+        self.has_new = False
+
+    def add(self, page, data, is_new):
+        if not (is_new or self.has_new):
+            self.held.append((page, data))
+            return
+        self.has_new = True
+        for held_page, held_data in self.held:
+            _save_raw(held_data, ts=self.ts, page=held_page, vs_currency=self.vs_currency)
+        self.held = []
+        _save_raw(data, ts=self.ts, page=page, vs_currency=self.vs_currency)
+
+def fetch_markets(vs_currency="usd", per_page=20, page=1, use_cache=True):
+    """
+    Fetches market data from CoinGecko API with retry logic and rate limit handling.
+    Responses still inside the cache TTL are served without a network call.
+    """
+    data, is_new = _fetch_page(vs_currency, per_page, page, use_cache=use_cache)
+    
+    # Only persist payloads we have not archived already
+    if is_new:
+        _save_raw(data)
+    return data
+
+def iter_market_pages(vs_currency="usd", pages=4, per_page=MAX_PER_PAGE, concurrency=DEFAULT_CONCURRENCY, use_cache=True):
+    """
+    Yields /coins/markets pages in rank order as soon as each one is available.
+    
+    At most `concurrency` requests are in flight (each page keeps its own
+    retry/backoff), so memory is bounded by a few pages no matter how many
+    are requested. Pages are archived individually under one shared
+    snapshot timestamp (see _SnapshotPages). Coins that drift across a page
+    boundary between requests are de-duplicated, keeping the higher-ranked
+    occurrence.
+    """
+    per_page = min(per_page, MAX_PER_PAGE)
+    concurrency = max(1, min(concurrency, MAX_POOL_SIZE, pages))
+    snapshot = _SnapshotPages(datetime.now(timezone.utc), vs_currency)
+    
+    logger.info(f"Starting multi-page fetch: {vs_currency}, {pages} pages x {per_page}, concurrency {concurrency}")
+    
+    executor = ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix="extract")
+    pending = deque()
+    next_page = 1
+    seen_ids = set()
+    try:
+        while next_page <= pages and len(pending) < concurrency:
+            pending.append((next_page, executor.submit(_fetch_page, vs_currency, per_page, next_page, use_cache)))
+            next_page += 1
+        
+        while pending:
+            page, future = pending.popleft()
+            page_data, is_new = future.result()
+            # Keep the window full while the caller consumes this page
+            if next_page <= pages:
+                pending.append((next_page, executor.submit(_fetch_page, vs_currency, per_page, next_page, use_cache)))
+                next_page += 1
+            
+            # An empty page means we ran past the end of the listing
+            if page_data == []:
+                break
+            snapshot.add(page, page_data, is_new)
+            
+            items = [item for item in page_data if item.get("id") not in seen_ids]
+            seen_ids.update(item.get("id") for item in items)
+            yield items
+    finally:
+        for _, future in pending:
+            future.cancel()
+        executor.shutdown(wait=True)
+
+def fetch_all_markets(vs_currency="usd", pages=4, per_page=MAX_PER_PAGE, concurrency=DEFAULT_CONCURRENCY, use_cache=True):
+    """
+    Fetches several /coins/markets pages concurrently on the shared session
+    and returns them concatenated in market-cap rank order.
+    """
+    data = []
+    for items in iter_market_pages(vs_currency, pages, per_page, concurrency, use_cache):
+        data.extend(items)
+    
+    logger.info(f"Successfully fetched {len(data)} coins across {pages} pages.")
+    return data
+
+def fetch_markets_multi(currencies=("usd",), pages=1, per_page=MAX_PER_PAGE, concurrency=DEFAULT_CONCURRENCY, use_cache=True):
+    """
+    Fetches the same /coins/markets pages for several quote currencies at once.
+    
+    Every (currency, page) request goes to one shared pool of `concurrency`
+    workers, so the whole fan-out stays inside the shared rate limiter's
+    budget instead of running a pool per currency. Returns
+    {currency: rows in rank order}; pages are archived per currency under
+    one snapshot timestamp (see _SnapshotPages).
+    """
+    per_page = min(per_page, MAX_PER_PAGE)
+    tasks = [(currency, page) for currency in currencies for page in range(1, pages + 1)]
+    concurrency = max(1, min(concurrency, MAX_POOL_SIZE, len(tasks)))
+    snapshot_ts = datetime.now(timezone.utc)
+    
+    logger.info(f"Starting multi-currency fetch: {', '.join(currencies)} x {pages} pages x {per_page}, concurrency {concurrency}")
+    
+    with ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix="extract") as executor:
+        futures = {task: executor.submit(_fetch_page, task[0], per_page, task[1], use_cache) for task in tasks}
+        
+        results = {}
+        for currency in currencies:
+            rows, seen_ids = [], set()
+            snapshot = _SnapshotPages(snapshot_ts, currency)
+            for page in range(1, pages + 1):
+                page_data, is_new = futures[(currency, page)].result()
+                # An empty page means we ran past the end of the listing
+                if page_data == []:
+                    break
+                snapshot.add(page, page_data, is_new)
+                items = [item for item in page_data if item.get("id") not in seen_ids]
+                seen_ids.update(item.get("id") for item in items)
+                rows.extend(items)
+            results[currency] = rows
+    
+    logger.info(f"Successfully fetched {', '.join(f'{c}={len(r)}' for c, r in results.items())} coins.")
+    return results
 
 if __name__ == "__main__":
+    from log_setup import configure_logging
+
+    configure_logging("extract")
     try:
         markets = fetch_markets()
         if markets and len(markets) > 0:
@@ -0,0 +1,403 @@
+import argparse
+import json
+import logging
+import os
+import shutil
+import threading
+import time
+import uuid
+import zlib
+from datetime import datetime, timedelta, timezone
+from file_lock import file_lock
+from market_batch import DOC_COLUMNS, MarketBatch
+
+# --- Configuration & Constants ---
+EXPORT_DIR = os.getenv("HISTORY_EXPORT_DIR", os.path.join("exports", "crypto_market_history"))
+STATE_DIR = "state"
+WATERMARK_FILE = os.path.join(STATE_DIR, "history_export.json")
+LOCK_FILE = os.path.join(STATE_DIR, "history_export.lock")
+MANIFEST = "_manifest.json"
+
+# coin_id hashes into this many coin_bucket partitions per day; a directory
+# per coin would mean thousands of tiny files per day
+COIN_BUCKETS = 16
+# Rows newer than now - EXPORT_LAG wait for the next run, so a history insert still in progress is never split
+EXPORT_LAG = timedelta(minutes=2)
+# History is pulled one window at a time, which bounds memory
+EXPORT_CHUNK = timedelta(hours=6)
+# How far back the first export (no watermark yet) starts, unless --since is given
+DEFAULT_BACKFILL = timedelta(days=90)
+
+# A partition with at least this many files below COMPACT_MAX_FILE_BYTES is merged into one file
+COMPACT_MIN_FILES = 4
+COMPACT_MAX_FILE_BYTES = 64 * 1024 * 1024
+# Files replaced by a compaction are deleted after this long, so readers holding the old manifest can finish
+COMPACT_GRACE = timedelta(minutes=10)
+COMPACT_INTERVAL = 600.0
+PARQUET_COMPRESSION = "zstd"
+
+logger = logging.getLogger(__name__)
+
+
+def _arrow():
+    # Optional dependency: only the export and its reader need it
+    try:
+        import pyarrow as pa
+        import pyarrow.compute as pc
+        import pyarrow.parquet as pq
+    except ImportError as e:
+        raise ImportError("history_export needs pyarrow (pip install pyarrow)") from e
+    return pa, pc, pq
+
+def _schema():
+    pa, _, _ = _arrow()
+    timestamp = pa.timestamp("us", tz="UTC")
+    return pa.schema([
+        ("coin_id", pa.string()), ("symbol", pa.string()), ("name", pa.string()),
+        ("current_price", pa.float64()), ("market_cap", pa.float64()), ("total_volume", pa.float64()),
+        ("price_change_24h", pa.float64()), ("market_cap_rank", pa.int64()), ("volatility_score", pa.float64()),
+        ("last_updated", timestamp), ("extracted_at", timestamp),
+    ])
+
+def coin_bucket(coin_id):
+    # crc32, unlike hash(), is stable across processes
+    return zlib.crc32(coin_id.encode("utf-8")) % COIN_BUCKETS
+
+def _epoch(value):
+    if value.tzinfo is None:
+        value = value.replace(tzinfo=timezone.utc)  # pymongo returns naive UTC
+    return value.timestamp()
+
+def _write_json(path, payload):
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(payload, f, indent=1)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+
+# --- Watermark & Manifests ---
+def _read_state():
+    try:
+        with open(WATERMARK_FILE) as f:
+            return json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return {}
+
+def read_watermark():
+    """
+    Returns the extracted_at up to which history has been exported, or None.
+    """
+    try:
+        return datetime.fromisoformat(_read_state()["watermark"])
+    except KeyError:
+        return None
+
+def _write_watermark(watermark, rows, pending=None):
+    # `pending` is the (start, end) window being written: a run that finds it
+    # redoes exactly that window, so its chunk ids match what was already written
+    state = {"watermark": watermark.isoformat(), "rows": rows,
+             "updated_at": datetime.now(timezone.utc).isoformat()}
+    if pending:
+        state["pending"] = [pending[0].isoformat(), pending[1].isoformat()]
+    os.makedirs(STATE_DIR, exist_ok=True)
+    _write_json(WATERMARK_FILE, state)
+
+def _read_manifest(partition):
+    try:
+        with open(os.path.join(partition, MANIFEST)) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {"files": [], "retired": []}
+
+def _partitions(root):
+    for date_dir in sorted(os.listdir(root)) if os.path.isdir(root) else []:
+        if not date_dir.startswith("date="):
+            continue
+        for bucket_dir in sorted(os.listdir(os.path.join(root, date_dir))):
+            if bucket_dir.startswith("coin_bucket="):
+                yield date_dir[len("date="):], int(bucket_dir[len("coin_bucket="):]), os.path.join(root, date_dir, bucket_dir)
+
+
+# --- Export ---
+def _to_table(rows):
+    pa, _, _ = _arrow()
+    frame = MarketBatch.from_docs(rows).to_frame()[DOC_COLUMNS]
+    return pa.Table.from_pandas(frame, preserve_index=False).cast(_schema())
+
+def _write_partition(root, day, bucket, table, chunk_id):
+    """
+    Adds one part file to a partition. Idempotent per chunk: a chunk already
+    recorded in the manifest (e.g. exported before a crash that lost the
+    watermark update, and maybe compacted since) is not written again.
+    """
+    _, pc, pq = _arrow()
+    partition = os.path.join(root, f"date={day}", f"coin_bucket={bucket:02d}")
+    os.makedirs(partition, exist_ok=True)
+    manifest = _read_manifest(partition)
+    if any(chunk_id in entry["chunks"] for entry in manifest["files"]):
+        return 0
+
+    name = f"part-{chunk_id}.parquet"
+    path = os.path.join(partition, name)
+    pq.write_table(table, f"{path}.tmp", compression=PARQUET_COMPRESSION)
+    os.replace(f"{path}.tmp", path)
+    extracted = pc.min_max(table.column("extracted_at"))
+    manifest["files"].append({
+        "name": name, "rows": table.num_rows, "bytes": os.path.getsize(path), "chunks": [chunk_id],
+        "min_extracted_at": extracted["min"].as_py().isoformat(), "max_extracted_at": extracted["max"].as_py().isoformat(),
+    })
+    _write_json(os.path.join(partition, MANIFEST), manifest)
+    return table.num_rows
+
+def _export_until(now):
+    """
+    Upper bound of this run: EXPORT_LAG behind now, and just before the oldest
+    history still in the local spool, so rows the drainer inserts late (after
+    an outage) are not left behind the watermark.
+    """
+    from spool import get_spool
+
+    until = now - EXPORT_LAG
+    oldest = get_spool().oldest_pending("history")
+    if oldest is not None:
+        if oldest.tzinfo is None:
+            oldest = oldest.replace(tzinfo=timezone.utc)
+        if oldest <= until:
+            logger.info(f"Spooled history from {oldest.isoformat()} not loaded yet; exporting up to it")
+            until = oldest - timedelta(microseconds=1)
+    return until
+
+def _export_window(backend, root, start, end):
+    pa, pc, _ = _arrow()
+    # query_history's start bound is inclusive; the watermark row itself was exported last time
+    start_epoch = start.timestamp()
+    rows = [row for row in backend.query_history(start=start, end=end)
+            if _epoch(row["extracted_at"]) > start_epoch]
+    if not rows:
+        return 0, 0
+    table = _to_table(rows)
+    chunk_id = f"{int(start_epoch * 1000)}-{int(end.timestamp() * 1000)}"
+    days = pc.strftime(table.column("extracted_at"), format="%Y-%m-%d")
+    buckets = pa.array([coin_bucket(coin_id) for coin_id in table.column("coin_id").to_pylist()])
+    keys = pc.binary_join_element_wise(days, pc.cast(buckets, pa.string()), "/")
+    exported, files = 0, 0
+    for key in pc.unique(keys).to_pylist():
+        day, bucket = key.split("/")
+        part = table.filter(pc.equal(keys, key))
+        part = part.sort_by([("coin_id", "ascending"), ("extracted_at", "ascending")])
+        written = _write_partition(root, day, int(bucket), part, chunk_id)
+        exported += written
+        files += 1 if written else 0
+    return exported, files
+
+def export(backend=None, root=EXPORT_DIR, since=None, until=None):
+    """
+    Appends history newer than the watermark to date/coin_bucket Parquet
+    partitions, one EXPORT_CHUNK window at a time, advancing the watermark
+    after each window. Returns {"rows", "files", "watermark"}.
+
+    The watermark stops short of history still waiting in the spool. Rows
+    backfilled behind it by other means (e.g. replay.py) are only picked
+    up after --reset.
+    """
+    if backend is None:
+        from storage import get_backend
+        backend = get_backend()
+
+    summary = {"rows": 0, "files": 0, "watermark": None}
+    with file_lock(LOCK_FILE):
+        state = _read_state()
+        watermark = read_watermark() or since or datetime.now(timezone.utc) - DEFAULT_BACKFILL
+        until = until or _export_until(datetime.now(timezone.utc))
+        logger.info(f">>> Exporting history from {watermark.isoformat()} to {until.isoformat()} into {root}")
+
+        window = None
+        if state.get("pending"):
+            # A previous run stopped inside this window: redo it with the same bounds
+            window = tuple(datetime.fromisoformat(ts) for ts in state["pending"])
+            logger.warning(f"Resuming interrupted export window {state['pending'][0]} - {state['pending'][1]}")
+        while window or watermark < until:
+            window = window or (watermark, min(watermark + EXPORT_CHUNK, until))
+            _write_watermark(watermark, summary["rows"], pending=window)
+            rows, files = _export_window(backend, root, *window)
+            summary["rows"] += rows
+            summary["files"] += files
+            watermark = max(watermark, window[1])
+            _write_watermark(watermark, summary["rows"])
+            window = None
+
+        summary["watermark"] = watermark.isoformat()
+    logger.info(f"<<< History export complete: {summary}")
+    return summary
+
+
+# --- Compaction ---
+def compact(root=EXPORT_DIR, min_files=COMPACT_MIN_FILES, now=None):
+    """
+    Merges each partition's small files into one sorted file and deletes
+    files retired more than COMPACT_GRACE ago. The manifest is switched
+    atomically, so readers always see either the old or the new file set.
+    Returns the number of partitions compacted.
+    """
+    pa, _, pq = _arrow()
+    now = now or datetime.now(timezone.utc)
+    compacted = 0
+    with file_lock(LOCK_FILE):
+        for day, bucket, partition in _partitions(root):
+            manifest = _read_manifest(partition)
+            keep_retired = []
+            for entry in manifest["retired"]:
+                if now - datetime.fromisoformat(entry["retired_at"]) >= COMPACT_GRACE:
+                    try:
+                        os.remove(os.path.join(partition, entry["name"]))
+                    except FileNotFoundError:
+                        pass
+                else:
+                    keep_retired.append(entry)
+            manifest["retired"] = keep_retired
+
+            small = [entry for entry in manifest["files"] if entry["bytes"] < COMPACT_MAX_FILE_BYTES]
+            if len(small) >= min_files:
+                table = pa.concat_tables(
+                    pq.read_table(os.path.join(partition, entry["name"]), memory_map=True) for entry in small
+                ).sort_by([("coin_id", "ascending"), ("extracted_at", "ascending")])
+                name = f"compact-{uuid.uuid4().hex[:12]}.parquet"
+                path = os.path.join(partition, name)
+                pq.write_table(table, f"{path}.tmp", compression=PARQUET_COMPRESSION)
+                os.replace(f"{path}.tmp", path)
+                merged = {
+                    "name": name, "rows": table.num_rows, "bytes": os.path.getsize(path),
+                    "chunks": sorted({chunk for entry in small for chunk in entry["chunks"]}),
+                    "min_extracted_at": min(entry["min_extracted_at"] for entry in small),
+                    "max_extracted_at": max(entry["max_extracted_at"] for entry in small),
+                }
+                small_names = {entry["name"] for entry in small}
+                manifest["files"] = [entry for entry in manifest["files"] if entry["name"] not in small_names] + [merged]
+                manifest["retired"] += [{"name": n, "retired_at": now.isoformat()} for n in sorted(small_names)]
+                compacted += 1
+                logger.info(f"Compacted {len(small)} files ({table.num_rows} rows) in date={day}/coin_bucket={bucket:02d}")
+            _write_json(os.path.join(partition, MANIFEST), manifest)
+    return compacted
+
+def start_compactor(root=EXPORT_DIR, interval=COMPACT_INTERVAL, stop_event=None):
+    """
+    Compacts in a background thread every `interval` seconds until stop_event is set.
+    """
+    stop_event = stop_event or threading.Event()
+
+    def loop():
+        while not stop_event.wait(interval):
+            try:
+                compact(root)
+            except Exception as e:
+                logger.error(f"History compaction failed: {e}")
+
+    thread = threading.Thread(target=loop, name="history-compactor", daemon=True)
+    thread.start()
+    return thread
+
+
+# --- Reading ---
+class HistoryReader:
+    """
+    Offline reads over the export, without touching the database.
+
+    Partitions are pruned by date directory, coin bucket and the manifests'
+    extracted_at ranges; files are memory-mapped and streamed as record
+    batches, so a query over months only holds the rows it returns.
+    """
+
+    def __init__(self, root=EXPORT_DIR):
+        self.root = root
+
+    def files(self, start=None, end=None, coin_ids=None):
+        buckets = {coin_bucket(coin_id) for coin_id in coin_ids} if coin_ids else None
+        first_day = start.astimezone(timezone.utc).strftime("%Y-%m-%d") if start else None
+        last_day = end.astimezone(timezone.utc).strftime("%Y-%m-%d") if end else None
+        for day, bucket, partition in _partitions(self.root):
+            if (first_day and day < first_day) or (last_day and day > last_day):
+                continue
+            if buckets is not None and bucket not in buckets:
+                continue
+            for entry in _read_manifest(partition)["files"]:
+                if start and datetime.fromisoformat(entry["max_extracted_at"]) < start:
+                    continue
+                if end and datetime.fromisoformat(entry["min_extracted_at"]) > end:
+                    continue
+                yield os.path.join(partition, entry["name"])
+
+    def iter_batches(self, start=None, end=None, coin_ids=None, columns=None, batch_size=65536):
+        """
+        Yields pyarrow RecordBatches of matching rows, limited to `columns` (default: all).
+        """
+        pa, pc, pq = _arrow()
+        wanted = list(columns) if columns else _schema().names
+        needed = list(dict.fromkeys(wanted + ["extracted_at"] + (["coin_id"] if coin_ids else [])))
+        coin_set = pa.array(sorted(coin_ids)) if coin_ids else None
+        for path in self.files(start, end, coin_ids):
+            for batch in pq.ParquetFile(path, memory_map=True).iter_batches(batch_size=batch_size, columns=needed):
+                mask = None
+                for condition in (
+                    pc.greater_equal(batch.column("extracted_at"), pa.scalar(start, pa.timestamp("us", tz="UTC"))) if start else None,
+                    pc.less_equal(batch.column("extracted_at"), pa.scalar(end, pa.timestamp("us", tz="UTC"))) if end else None,
+                    pc.is_in(batch.column("coin_id"), value_set=coin_set) if coin_set is not None else None,
+                ):
+                    if condition is not None:
+                        mask = condition if mask is None else pc.and_(mask, condition)
+                if mask is not None:
+                    batch = batch.filter(mask)
+                if batch.num_rows:
+                    yield batch.select(wanted)
+
+    def read(self, start=None, end=None, coin_ids=None, columns=None):
+        """
+        Returns matching rows as one pyarrow Table.
+        """
+        pa, _, _ = _arrow()
+        wanted = list(columns) if columns else _schema().names
+        schema = pa.schema([_schema().field(name) for name in wanted])
+        return pa.Table.from_batches(list(self.iter_batches(start, end, coin_ids, columns)), schema=schema)
+
+    def to_pandas(self, start=None, end=None, coin_ids=None, columns=None):
+        return self.read(start, end, coin_ids, columns).to_pandas()
+
+
+def _parse_time(value):
+    ts = datetime.fromisoformat(value)
+    return ts if ts.tzinfo else ts.replace(tzinfo=timezone.utc)
+
+def main(argv=None):
+    """
+    Exports new history (optionally compacting, or on a loop with --watch) (`crypto-etl export`).
+    """
+    from log_setup import configure_logging
+
+    parser = argparse.ArgumentParser(description="Export crypto_market_history to partitioned Parquet files.")
+    parser.add_argument("--root", default=EXPORT_DIR)
+    parser.add_argument("--since", type=_parse_time, help="Start of the first export (ISO-8601; default: 90 days ago)")
+    parser.add_argument("--reset", action="store_true", help="Delete the export and its watermark, then export from --since again")
+    parser.add_argument("--compact", action="store_true", help="Compact small files after exporting")
+    parser.add_argument("--watch", type=float, metavar="SECONDS",
+                        help="Keep exporting every SECONDS, compacting in the background")
+    args = parser.parse_args(argv)
+
+    configure_logging("history_export")
+
+    if args.reset:
+        with file_lock(LOCK_FILE):
+            shutil.rmtree(args.root, ignore_errors=True)
+            if os.path.exists(WATERMARK_FILE):
+                os.remove(WATERMARK_FILE)
+    if args.watch:
+        start_compactor(args.root)
+        while True:
+            export(root=args.root, since=args.since)
+            time.sleep(args.watch)
+    print(json.dumps(export(root=args.root, since=args.since), indent=2))
+    if args.compact:
+        print(json.dumps({"compacted_partitions": compact(args.root)}, indent=2))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,84 @@
+import logging
+from datetime import datetime, timezone
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+# Points returned per series, whatever the time range
+MAX_POINTS = 1500
+# Server-side buckets per output point; LTTB picks among them
+OVERSAMPLE = 4
+
+# Fields that can be charted from crypto_market_history
+HISTORY_FIELDS = {"current_price", "market_cap", "total_volume", "price_change_24h", "volatility_score"}
+
+
+def lttb(x, y, threshold):
+    """
+    Largest-Triangle-Three-Buckets downsampling. Returns the indices to keep.
+
+    Keeps the first and last points; from every bucket in between it keeps
+    the point forming the largest triangle with the previously kept point
+    and the average of the next bucket, preserving the visual shape.
+    """
+    n = len(x)
+    if threshold >= n or threshold < 3:
+        return np.arange(n)
+
+    x = np.asarray(x, dtype=np.float64)
+    y = np.asarray(y, dtype=np.float64)
+    edges = np.linspace(1, n - 1, threshold - 1).astype(np.int64)
+
+    keep = np.empty(threshold, dtype=np.int64)
+    keep[0] = 0
+    prev = 0
+    for i in range(threshold - 2):
+        start, end = edges[i], edges[i + 1]
+        next_start, next_end = edges[i + 1], edges[i + 2] if i + 2 < len(edges) else n
+        avg_x = x[next_start:next_end].mean() if next_end > next_start else x[-1]
+        avg_y = y[next_start:next_end].mean() if next_end > next_start else y[-1]
+
+        bx, by = x[start:end], y[start:end]
+        areas = np.abs((x[prev] - avg_x) * (by - y[prev]) - (x[prev] - bx) * (avg_y - y[prev]))
+        prev = start + int(np.argmax(areas)) if len(areas) else start
+        keep[i + 1] = prev
+    keep[-1] = n - 1
+    return keep
+
+def query_history(db, coin_id, start, end, field="current_price", max_points=MAX_POINTS):
+    """
+    Returns [(timestamp, value)] for one coin over [start, end] with at most
+    `max_points` points.
+
+    The range filter and time bucketing run in Mongo on the
+    (coin_id, extracted_at) index: rows are averaged into about
+    max_points * OVERSAMPLE fixed-width buckets, so the payload is bounded
+    by the bucket count and not the number of raw rows. LTTB then reduces
+    the buckets to `max_points`.
+    """
+    if field not in HISTORY_FIELDS:
+        raise ValueError(f"Unsupported history field: {field}")
+
+    span_ms = max(int((end - start).total_seconds() * 1000), 1)
+    bucket_ms = max(span_ms // (max_points * OVERSAMPLE), 1000)
+    ts_ms = {"$toLong": "$extracted_at"}
+
+    pipeline = [
+        {"$match": {"coin_id": coin_id, "extracted_at": {"$gte": start, "$lte": end}}},
+        {"$group": {
+            "_id": {"$subtract": [ts_ms, {"$mod": [ts_ms, bucket_ms]}]},
+            "t": {"$avg": ts_ms},
+            "v": {"$avg": f"${field}"},
+        }},
+        {"$sort": {"_id": 1}},
+    ]
+    rows = list(db.crypto_market_history.aggregate(pipeline, allowDiskUse=True))
+    if not rows:
+        return []
+
+    t = np.fromiter((row["t"] for row in rows), dtype=np.float64, count=len(rows))
+    v = np.fromiter((row["v"] if row["v"] is not None else np.nan for row in rows), dtype=np.float64, count=len(rows))
+    keep = lttb(t, np.nan_to_num(v), max_points)
+
+    logger.info(f"History {coin_id}.{field}: {len(rows)} buckets of {bucket_ms}ms -> {len(keep)} points")
+    return [(datetime.fromtimestamp(t[i] / 1000, tz=timezone.utc), float(v[i])) for i in keep]
@@ -0,0 +1,175 @@
+import hashlib
+import json
+import os
+import time
+import logging
+import threading
+from collections import OrderedDict
+
+# --- Configuration & Constants ---
+STATE_DIR = "state"
+CACHE_DIR = os.path.join(STATE_DIR, "http_cache")
+
+# CoinGecko refreshes /coins/markets roughly once a minute.
+DEFAULT_TTL = 60.0
+DEFAULT_MAX_BYTES = 64 * 1024 * 1024
+DEFAULT_MEMORY_ENTRIES = 32
+
+logger = logging.getLogger(__name__)
+
+
+class ResponseCache:
+    """
+    TTL + conditional-request cache for GET responses.
+
+    Entries are keyed on endpoint plus params. Parsed payloads are kept in an
+    in-process LRU so a hit inside the freshness window costs neither a
+    request nor a JSON parse; bodies and validators (ETag/Last-Modified) are
+    also written to disk so other processes and restarts can revalidate
+    instead of re-downloading. The disk store is bounded by total size and
+    evicts least-recently-used entries first.
+
+    Cached payloads are shared between callers and must not be mutated.
+    """
+
+    def __init__(self, cache_dir=CACHE_DIR, ttl=DEFAULT_TTL, max_bytes=DEFAULT_MAX_BYTES,
+                 memory_entries=DEFAULT_MEMORY_ENTRIES):
+        self.cache_dir = cache_dir
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.memory_entries = memory_entries
+        self._memory = OrderedDict()
+        self._lock = threading.Lock()
+        os.makedirs(cache_dir, exist_ok=True)
+
+    @staticmethod
+    def key(endpoint, params):
+        raw = json.dumps([endpoint, sorted((str(k), str(v)) for k, v in (params or {}).items())])
+        return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+    def _paths(self, key):
+        base = os.path.join(self.cache_dir, key)
+        return f"{base}.body", f"{base}.meta"
+
+    def is_fresh(self, entry):
+        return entry is not None and (time.time() - entry["stored_at"]) < self.ttl
+
+    def get(self, key):
+        """
+        Returns the cached entry (fresh or stale) or None.
+        """
+        with self._lock:
+            entry = self._memory.get(key)
+            if entry is not None:
+                self._memory.move_to_end(key)
+                return entry
+
+        body_path, meta_path = self._paths(key)
+        try:
+            with open(meta_path) as f:
+                meta = json.load(f)
+            with open(body_path, "rb") as f:
+                data = json.loads(f.read())
+            # mtime doubles as the LRU clock for disk eviction
+            os.utime(body_path)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return None
+
+        entry = {**meta, "data": data}
+        self._remember(key, entry)
+        return entry
+
+    def conditional_headers(self, entry):
+        """
+        Builds If-None-Match / If-Modified-Since headers for a stale entry.
+        """
+        headers = {}
+        if entry is None:
+            return headers
+        if entry.get("etag"):
+            headers["If-None-Match"] = entry["etag"]
+        if entry.get("last_modified"):
+            headers["If-Modified-Since"] = entry["last_modified"]
+        return headers
+
+    def put(self, key, body, data, etag=None, last_modified=None):
+        """
+        Stores a fresh 200 response (raw body bytes plus its parsed payload).
+        """
+        meta = {"etag": etag, "last_modified": last_modified, "stored_at": time.time(), "size": len(body)}
+        body_path, meta_path = self._paths(key)
+        try:
+            with open(body_path, "wb") as f:
+                f.write(body)
+            with open(meta_path, "w") as f:
+                json.dump(meta, f)
+        except OSError as e:
+            logger.warning(f"Could not persist cache entry {key[:12]}: {e}")
+
+        entry = {**meta, "data": data}
+        self._remember(key, entry)
+        self._evict()
+        return entry
+
+    def refresh(self, key, entry):
+        """
+        Restarts the freshness window of an entry after a 304 Not Modified.
+        """
+        entry["stored_at"] = time.time()
+        _, meta_path = self._paths(key)
+        meta = {k: v for k, v in entry.items() if k != "data"}
+        try:
+            with open(meta_path, "w") as f:
+                json.dump(meta, f)
+        except OSError as e:
+            logger.warning(f"Could not refresh cache entry {key[:12]}: {e}")
+        self._remember(key, entry)
+        return entry
+
+    def _remember(self, key, entry):
+        with self._lock:
+            self._memory[key] = entry
+            self._memory.move_to_end(key)
+            while len(self._memory) > self.memory_entries:
+                self._memory.popitem(last=False)
+
+    def _evict(self):
+        try:
+            bodies = []
+            for name in os.listdir(self.cache_dir):
+                if name.endswith(".body"):
+                    stat = os.stat(os.path.join(self.cache_dir, name))
+                    bodies.append((stat.st_mtime, stat.st_size, name[:-len(".body")]))
+        except OSError:
+            return
+
+        total = sum(size for _, size, _ in bodies)
+        if total <= self.max_bytes:
+            return
+
+        for _, size, key in sorted(bodies):
+            if total <= self.max_bytes:
+                break
+            for path in self._paths(key):
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+            with self._lock:
+                self._memory.pop(key, None)
+            total -= size
+            logger.info(f"Evicted cache entry {key[:12]} ({size} bytes)")
+
+
+_default_cache = None
+_default_lock = threading.Lock()
+
+def get_cache():
+    """
+    Returns the process-wide response cache used by extract.
+    """
+    global _default_cache
+    with _default_lock:
+        if _default_cache is None:
+            _default_cache = ResponseCache()
+    return _default_cache
@@ -0,0 +1,225 @@
+import json
+import math
+import os
+import logging
+import threading
+from collections import deque
+from datetime import datetime, timedelta, timezone
+from file_lock import file_lock
+
+# --- Configuration & Constants ---
+STATE_DIR = "state"
+STATE_FILE = os.path.join(STATE_DIR, "indicators.json")
+
+SMA_WINDOW = 20
+EMA_PERIOD = 20
+RSI_PERIOD = 14
+VOLATILITY_WINDOW = 20
+# How far back a cold start replays crypto_market_history
+REBUILD_LOOKBACK = timedelta(days=7)
+
+logger = logging.getLogger(__name__)
+
+
+class CoinIndicators:
+    """
+    Rolling indicator state for one coin; every update is O(1).
+
+    - SMA over the last SMA_WINDOW prices (ring buffer + running sum)
+    - EMA with alpha = 2 / (EMA_PERIOD + 1)
+    - Wilder RSI over RSI_PERIOD, seeded with a simple average
+    - Volatility: stdev of log returns over VOLATILITY_WINDOW (running sums)
+    """
+
+    __slots__ = ("prices", "price_sum", "ema", "avg_gain", "avg_loss", "rsi_seen",
+                 "returns", "ret_sum", "ret_sq_sum", "last_price", "last_updated", "samples")
+
+    def __init__(self):
+        self.prices = deque(maxlen=SMA_WINDOW)
+        self.price_sum = 0.0
+        self.ema = None
+        self.avg_gain = 0.0
+        self.avg_loss = 0.0
+        self.rsi_seen = 0
+        self.returns = deque(maxlen=VOLATILITY_WINDOW)
+        self.ret_sum = 0.0
+        self.ret_sq_sum = 0.0
+        self.last_price = None
+        self.last_updated = None
+        self.samples = 0
+
+    def update(self, price, last_updated=None):
+        """
+        Folds in one new snapshot. Repeats of an already-seen source version are ignored.
+        """
+        if isinstance(last_updated, datetime) and last_updated.tzinfo is None:
+            last_updated = last_updated.replace(tzinfo=timezone.utc)  # pymongo returns naive UTC
+        if last_updated is not None and last_updated == self.last_updated:
+            return False
+
+        # SMA
+        if len(self.prices) == self.prices.maxlen:
+            self.price_sum -= self.prices[0]
+        self.prices.append(price)
+        self.price_sum += price
+
+        # EMA
+        alpha = 2.0 / (EMA_PERIOD + 1)
+        self.ema = price if self.ema is None else alpha * price + (1 - alpha) * self.ema
+
+        if self.last_price is not None:
+            # RSI (Wilder smoothing once RSI_PERIOD changes have been seen)
+            change = price - self.last_price
+            gain, loss = max(change, 0.0), max(-change, 0.0)
+            if self.rsi_seen < RSI_PERIOD:
+                self.rsi_seen += 1
+                self.avg_gain += (gain - self.avg_gain) / self.rsi_seen
+                self.avg_loss += (loss - self.avg_loss) / self.rsi_seen
+            else:
+                self.avg_gain = (self.avg_gain * (RSI_PERIOD - 1) + gain) / RSI_PERIOD
+                self.avg_loss = (self.avg_loss * (RSI_PERIOD - 1) + loss) / RSI_PERIOD
+
+            # Volatility of log returns
+            if self.last_price > 0 and price > 0:
+                ret = math.log(price / self.last_price)
+                if len(self.returns) == self.returns.maxlen:
+                    old = self.returns[0]
+                    self.ret_sum -= old
+                    self.ret_sq_sum -= old * old
+                self.returns.append(ret)
+                self.ret_sum += ret
+                self.ret_sq_sum += ret * ret
+
+        self.last_price = price
+        self.last_updated = last_updated
+        self.samples += 1
+        return True
+
+    def values(self):
+        rsi = None
+        if self.rsi_seen >= RSI_PERIOD:
+            rsi = 100.0 if self.avg_loss == 0 else 100.0 - 100.0 / (1.0 + self.avg_gain / self.avg_loss)
+
+        volatility = None
+        n = len(self.returns)
+        if n >= 2:
+            variance = (self.ret_sq_sum - self.ret_sum * self.ret_sum / n) / (n - 1)
+            volatility = math.sqrt(max(variance, 0.0))
+
+        return {
+            f"sma_{SMA_WINDOW}": self.price_sum / len(self.prices) if len(self.prices) == SMA_WINDOW else None,
+            f"ema_{EMA_PERIOD}": self.ema if self.samples >= EMA_PERIOD else None,
+            f"rsi_{RSI_PERIOD}": rsi,
+            f"volatility_{VOLATILITY_WINDOW}": volatility,
+            "samples": self.samples,
+        }
+
+    def to_dict(self):
+        state = {name: getattr(self, name) for name in self.__slots__}
+        state["prices"] = list(self.prices)
+        state["returns"] = list(self.returns)
+        if isinstance(self.last_updated, datetime):
+            state["last_updated"] = self.last_updated.isoformat()
+        return state
+
+    @classmethod
+    def from_dict(cls, state):
+        coin = cls()
+        for name in cls.__slots__:
+            if name in state:
+                setattr(coin, name, state[name])
+        coin.prices = deque(state.get("prices", []), maxlen=SMA_WINDOW)
+        coin.returns = deque(state.get("returns", []), maxlen=VOLATILITY_WINDOW)
+        if isinstance(coin.last_updated, str):
+            coin.last_updated = datetime.fromisoformat(coin.last_updated)
+        return coin
+
+
+class IndicatorEngine:
+    """
+    Per-coin incremental indicators, persisted to a JSON state file between runs.
+    """
+
+    def __init__(self, state_file=STATE_FILE):
+        self.state_file = state_file
+        self.lock_file = f"{state_file}.lock"
+        self.coins = {}
+        self._loaded_mtime = None
+
+    def load(self):
+        """
+        Loads persisted state. Returns False when there is none yet.
+        """
+        try:
+            mtime = os.path.getmtime(self.state_file)
+            if mtime == self._loaded_mtime:
+                return True
+            with open(self.state_file) as f:
+                payload = json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return False
+
+        self.coins = {coin_id: CoinIndicators.from_dict(state) for coin_id, state in payload["coins"].items()}
+        self._loaded_mtime = mtime
+        return True
+
+    def save(self):
+        os.makedirs(os.path.dirname(self.state_file) or ".", exist_ok=True)
+        payload = {
+            "saved_at": datetime.now(timezone.utc).isoformat(),
+            "coins": {coin_id: coin.to_dict() for coin_id, coin in self.coins.items()},
+        }
+        with file_lock(self.lock_file):
+            tmp_path = f"{self.state_file}.tmp"
+            with open(tmp_path, "w") as f:
+                json.dump(payload, f, separators=(",", ":"))
+            os.replace(tmp_path, self.state_file)
+            self._loaded_mtime = os.path.getmtime(self.state_file)
+
+    def update(self, coin_id, price, last_updated=None):
+        coin = self.coins.get(coin_id)
+        if coin is None:
+            coin = self.coins[coin_id] = CoinIndicators()
+        coin.update(price, last_updated)
+        return coin.values()
+
+    def apply(self, docs):
+        """
+        Updates state from transformed docs and returns coin_id -> indicator values.
+        """
+        return {
+            doc["coin_id"]: self.update(doc["coin_id"], doc["current_price"], doc.get("last_updated"))
+            for doc in docs
+        }
+
+    def rebuild_from_history(self, backend, lookback=REBUILD_LOOKBACK):
+        """
+        Rebuilds every coin's state by replaying recent history from the storage backend once.
+        """
+        since = datetime.now(timezone.utc) - lookback
+        cursor = backend.query_history(start=since)
+
+        self.coins = {}
+        rows = 0
+        for row in cursor:
+            self.update(row["coin_id"], row.get("current_price") or 0.0, row.get("last_updated"))
+            rows += 1
+        logger.info(f"Rebuilt indicator state for {len(self.coins)} coins from {rows} history rows")
+        self.save()
+
+
+_engine = None
+_engine_lock = threading.Lock()
+
+def get_engine(backend=None):
+    """
+    Returns the process-wide engine, loading persisted state (or rebuilding
+    it from history once, when a storage backend is given and no state exists).
+    """
+    global _engine
+    with _engine_lock:
+        if _engine is None:
+            _engine = IndicatorEngine()
+        if not _engine.load() and backend is not None:
+            _engine.rebuild_from_history(backend)
+    return _engine
@@ -1,7 +1,12 @@
 from db_mongo import get_db, ensure_indexes
+import argparse
 import sys
 
-def main():
+def main(argv=None):
+    from log_setup import configure_logging
+
+    argparse.ArgumentParser(description="Check the MongoDB connection and create its indexes.").parse_args(argv)
+    configure_logging("init_db")
     try:
         # 1. Get database connection
         db = get_db()
@@ -12,7 +17,7 @@ def main():
         print("[SUCCESS] MongoDB Atlas ping successful")
 
         # 3. Ensure indexes
-        ensure_indexes(db)
+        ensure_indexes(db, force=True)
         print("[SUCCESS] Indexes ensured on Atlas")
 
     except Exception as e:
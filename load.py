@@ -1,76 +1,219 @@
+import hashlib
+import json
 import logging
-import os
-from pymongo.errors import BulkWriteError
 
-# --- Setup Logging ---
-LOGS_DIR = "logs"
-os.makedirs(LOGS_DIR, exist_ok=True)
-log_filename = os.path.join(LOGS_DIR, "load.log")
-
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(levelname)s - %(message)s',
-    handlers=[
-        logging.FileHandler(log_filename),
-        logging.StreamHandler()
-    ]
-)
 logger = logging.getLogger(__name__)
 
-def upsert_latest(db, docs):
+# Latest-snapshot upserts are sent in bulk_write batches of this size
+UPSERT_BATCH_SIZE = 1000
+# Fields that change on every run without the market data changing
+HASH_EXCLUDED_FIELDS = {"_id", "extracted_at", "content_hash"}
+
+# Database name -> {coin_id: content hash of the last doc written}, for callers
+# that pass no cache of their own (MongoBackend keeps one per instance)
+_latest_hashes = {}
+
+def content_hash(doc):
+    """
+    Stable hash of a transformed doc's market fields (ignores extracted_at).
+    """
+    payload = {k: v for k, v in doc.items() if k not in HASH_EXCLUDED_FIELDS}
+    encoded = json.dumps(payload, sort_keys=True, default=str, separators=(",", ":"))
+    return hashlib.sha1(encoded.encode("utf-8")).hexdigest()
+
+def _known_hashes(db, coin_ids, hashes):
+    """
+    Returns coin_id -> stored hash, reading only coins missing from the
+    `hashes` cache from the documents themselves (a cold start or new coins).
+    """
+    missing = [coin_id for coin_id in coin_ids if coin_id not in hashes]
+    if missing:
+        cursor = db.crypto_market.find(
+            {"coin_id": {"$in": missing}, "content_hash": {"$exists": True}},
+            {"_id": 0, "coin_id": 1, "content_hash": 1}
+        )
+        for stored in cursor:
+            hashes[stored["coin_id"]] = stored["content_hash"]
+    return {coin_id: hashes.get(coin_id) for coin_id in coin_ids}
+
+def _bulk_upsert(db, docs, hashes, summary):
+    """
+    Sends one unordered bulk_write of upserts for `docs`, records their hashes
+    and adds the counts to `summary`. Returns the number of docs inserted.
+    """
+    from pymongo import UpdateOne
+    from pymongo.errors import BulkWriteError
+
+    ops, op_hashes = [], []
+    for doc, doc_hash in docs:
+        ops.append(UpdateOne(
+            {"coin_id": doc["coin_id"]},
+            {"$set": {**doc, "content_hash": doc_hash}},
+            upsert=True
+        ))
+        op_hashes.append((doc["coin_id"], doc_hash))
+    
+    failed = set()
+    try:
+        result = db.crypto_market.bulk_write(ops, ordered=False)
+        details = result.bulk_api_result
+    except BulkWriteError as bwe:
+        details = bwe.details
+        for error in details.get("writeErrors", []):
+            failed.add(error["index"])
+            coin_id = op_hashes[error["index"]][0]
+            logger.error(f"Error upserting {coin_id}: {error.get('errmsg')}",
+                         extra={"rate_key": "load.upsert_error", "coin_id": coin_id})
+    except Exception as e:
+        logger.error(f"Error upserting batch of {len(ops)} docs: {e}")
+        summary["errors"] += len(ops)
+        return []
+    summary["errors"] += len(failed)
+    
+    summary["matched"] += details.get("nMatched", 0)
+    summary["modified"] += details.get("nModified", 0)
+    summary["upserted"] += details.get("nUpserted", 0)
+    
+    for index, (coin_id, doc_hash) in enumerate(op_hashes):
+        if index not in failed:
+            hashes[coin_id] = doc_hash
+    return details.get("nUpserted", 0)
+
+def upsert_latest(db, docs, skip_unchanged=True, batch_size=UPSERT_BATCH_SIZE, hashes=None):
     """
     Upserts transformed docs into 'crypto_market' collection (Latest Snapshot).
+    
+    Writes go out as unordered bulk_write batches of UpdateOne ops. With
+    skip_unchanged, each doc carries a content_hash and coins whose hash
+    matches the last written version are not sent at all. `hashes` is the
+    coin_id -> hash cache for this database (default: one per database name).
+    
+    The cache is only checked against the collection when it looks stale:
+    when a coin it knew had to be inserted again (it was deleted behind the
+    cache), or when a batch had nothing to send. Skipped coins that turn out
+    to be missing are then written after all; one deleted on its own while
+    the rest of its batch changed is rewritten on its next change.
     """
-    summary = {"matched": 0, "modified": 0, "upserted": 0, "total": len(docs)}
+    summary = {"matched": 0, "modified": 0, "upserted": 0, "skipped": 0, "errors": 0, "total": len(docs)}
+    if hashes is None:
+        hashes = _latest_hashes.setdefault(db.name, {})
     
     logger.info(f"Upserting {len(docs)} docs into crypto_market...")
     
-    for doc in docs:
-        try:
-            result = db.crypto_market.update_one(
-                {"coin_id": doc["coin_id"]},
-                {"$set": doc},
-                upsert=True
-            )
-            
-            summary["matched"] += result.matched_count
-            summary["modified"] += result.modified_count
-            if result.upserted_id:
-                summary["upserted"] += 1
-                
-        except Exception as e:
-            logger.error(f"Error upserting {doc.get('coin_id')}: {e}")
+    for start in range(0, len(docs), batch_size):
+        batch = docs[start:start + batch_size]
+        known = _known_hashes(db, [doc["coin_id"] for doc in batch], hashes) if skip_unchanged else {}
+        
+        changed, skipped = [], []
+        for doc in batch:
+            doc_hash = content_hash(doc)
+            if skip_unchanged and known.get(doc["coin_id"]) == doc_hash:
+                skipped.append((doc, doc_hash))
+            else:
+                changed.append((doc, doc_hash))
+        
+        inserted = _bulk_upsert(db, changed, hashes, summary) if changed else 0
+        # More inserts than coins new to the cache: some cached coins had been deleted
+        expected_new = sum(1 for doc, _ in changed if not known.get(doc["coin_id"]))
+        if skipped and (not changed or inserted > expected_new):
+            skipped_ids = [doc["coin_id"] for doc, _ in skipped]
+            present = {stored["coin_id"] for stored in
+                       db.crypto_market.find({"coin_id": {"$in": skipped_ids}}, {"_id": 0, "coin_id": 1})}
+            gone = [(doc, doc_hash) for doc, doc_hash in skipped if doc["coin_id"] not in present]
+            if gone:
+                logger.warning(f"{len(gone)} cached coins are missing from crypto_market; writing them again")
+                for doc, _ in gone:
+                    hashes.pop(doc["coin_id"], None)
+                _bulk_upsert(db, gone, hashes, summary)
+                skipped = [item for item in skipped if item[0]["coin_id"] in present]
+        summary["skipped"] += len(skipped)
             
     logger.info(f"Upsert Summary: {summary}")
     return summary
 
-def insert_history(db, docs):
+# Database name -> {coin_id: source last_updated of the newest history row written},
+# for callers that pass no cache of their own (MongoBackend keeps one per instance)
+_last_history_version = {}
+
+DUPLICATE_KEY_ERROR = 11000
+
+def insert_history(db, docs, ordered=False, return_docs=False, versions=None):
     """
     Inserts transformed docs into 'crypto_market_history' for time-series analysis.
+    
+    Rows are deduplicated on (coin_id, source last_updated): versions already
+    written to this database (the `versions` cache, default: one per database
+    name) are dropped before the insert, and the unique index from
+    ensure_indexes rejects the rest. Both are reported as
+    duplicates, not errors. Returns {"inserted", "duplicates", "errors", "total"};
+    with return_docs=True, returns (summary, the docs actually inserted).
     """
+    from pymongo.errors import BulkWriteError
+
+    summary = {"inserted": 0, "duplicates": 0, "errors": 0, "total": len(docs)}
     if not docs:
-        return 0
+        return (summary, []) if return_docs else summary
+    if versions is None:
+        versions = _last_history_version.setdefault(db.name, {})
+    
+    fresh = []
+    for doc in docs:
+        version = doc.get("last_updated")
+        if version is not None and versions.get(doc["coin_id"]) == version:
+            summary["duplicates"] += 1
+        else:
+            fresh.append(doc)
+    
+    if not fresh:
+        logger.info(f"History unchanged: all {len(docs)} docs already recorded.")
+        return (summary, []) if return_docs else summary
         
-    logger.info(f"Inserting {len(docs)} docs into crypto_market_history...")
+    logger.info(f"Inserting {len(fresh)} docs into crypto_market_history ({summary['duplicates']} unchanged skipped)...")
+    failed = set()  # indexes into fresh that were not recorded
+    rejected = set()  # indexes into fresh that were not inserted (failed or duplicate)
     try:
-        # unordered=False ensures we stop on error, ordered=False continues (we want false for resilience)
-        result = db.crypto_market_history.insert_many(docs, ordered=False)
-        inserted_count = len(result.inserted_ids)
-        logger.info(f"Successfully inserted {inserted_count} history records.")
-        return inserted_count
+        # ordered=True stops on the first error, ordered=False continues (we want False for resilience)
+        result = db.crypto_market_history.insert_many(fresh, ordered=ordered)
+        summary["inserted"] = len(result.inserted_ids)
     except BulkWriteError as bwe:
-        inserted_count = bwe.details.get("nInserted", 0)
-        logger.warning(f"Bulk insert partially failed. Inserted: {inserted_count}. Errors: {len(bwe.details.get('writeErrors', []))}")
-        return inserted_count
+        summary["inserted"] = bwe.details.get("nInserted", 0)
+        for error in bwe.details.get("writeErrors", []):
+            rejected.add(error["index"])
+            if error.get("code") == DUPLICATE_KEY_ERROR:
+                summary["duplicates"] += 1
+            else:
+                summary["errors"] += 1
+                failed.add(error["index"])
+        if ordered:
+            # Everything after the first failure was never attempted
+            first_error = min((e["index"] for e in bwe.details.get("writeErrors", [])), default=len(fresh))
+            failed.update(range(first_error + 1, len(fresh)))
+            rejected.update(failed)
+            # Counted within fresh only: cache-filtered duplicates were never sent
+            summary["errors"] = len(failed)
+        if summary["errors"]:
+            logger.warning(f"Bulk insert partially failed. Inserted: {summary['inserted']}. Errors: {summary['errors']}")
     except Exception as e:
         logger.error(f"Failed to insert history: {e}")
-        return 0
+        summary["errors"] = len(fresh)
+        return (summary, []) if return_docs else summary
+    
+    for index, doc in enumerate(fresh):
+        if index not in failed and doc.get("last_updated") is not None:
+            versions[doc["coin_id"]] = doc["last_updated"]
+    
+    logger.info(f"History Summary: {summary}")
+    if return_docs:
+        return summary, [doc for index, doc in enumerate(fresh) if index not in rejected]
+    return summary
 
 if __name__ == "__main__":
     from db_mongo import get_db, ensure_indexes
+    from log_setup import configure_logging
     from extract import fetch_markets
     from transform import transform_markets
     
+    configure_logging("load")
     try:
         db = get_db()
         ensure_indexes(db)
@@ -81,11 +224,11 @@ if __name__ == "__main__":
         
         # Load sequence
         upsert_res = upsert_latest(db, docs)
-        history_cnt = insert_history(db, docs)
+        history_res = insert_history(db, docs)
         
         print("\n--- Load Phase Summary ---")
         print(f"Upsert Result: {upsert_res}")
-        print(f"History Inserts: {history_cnt}")
+        print(f"History Result: {history_res}")
         print(f"Current crypto_market total: {db.crypto_market.count_documents({})}")
         
     except Exception as e:
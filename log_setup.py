@@ -0,0 +1,185 @@
+import atexit
+import copy
+import json
+import logging
+import os
+import queue
+import sys
+import threading
+import time
+from datetime import datetime, timezone
+from logging.handlers import QueueHandler, QueueListener
+
+# --- Configuration & Constants ---
+LOGS_DIR = os.getenv("LOGS_DIR", "logs")
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+# Console output: "text" for people, "json" for log shippers. The file is always JSON lines.
+LOG_CONSOLE_FORMAT = os.getenv("LOG_CONSOLE_FORMAT", "text")
+TEXT_FORMAT = "%(asctime)s - %(levelname)s - %(message)s"
+# Per-row messages (tagged with extra={"rate_key": ...}): the first ROW_LOG_BURST
+# per key and window go through, then one in ROW_LOG_SAMPLE_EVERY
+ROW_LOG_BURST = int(os.getenv("ROW_LOG_BURST", "5"))
+ROW_LOG_WINDOW = float(os.getenv("ROW_LOG_WINDOW", "60"))
+ROW_LOG_SAMPLE_EVERY = int(os.getenv("ROW_LOG_SAMPLE_EVERY", "1000"))
+
+# LogRecord attributes that are not caller-supplied `extra` fields
+_RECORD_ATTRS = set(vars(logging.LogRecord("", 0, "", 0, "", None, None))) | {"message", "asctime", "rate_key"}
+
+
+class JsonFormatter(logging.Formatter):
+    """
+    One JSON object per line: ts, level, logger, msg, every `extra` field and exc on errors.
+    """
+
+    def format(self, record):
+        entry = {
+            "ts": datetime.fromtimestamp(record.created, tz=timezone.utc).isoformat(timespec="milliseconds"),
+            "level": record.levelname,
+            "logger": record.name,
+            "msg": record.getMessage(),
+        }
+        for key, value in vars(record).items():
+            if key not in _RECORD_ATTRS:
+                entry[key] = value
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            entry["exc"] = record.exc_text
+        return json.dumps(entry, default=str)
+
+
+class _RecordQueueHandler(QueueHandler):
+    """
+    Enqueues a copy of the record with its message merged, keeping extras and
+    the traceback as separate fields (QueueHandler folds them into msg).
+    """
+
+    def prepare(self, record):
+        record = copy.copy(record)
+        record.msg, record.args = record.getMessage(), None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+
+class TextFormatter(logging.Formatter):
+    """
+    TEXT_FORMAT, noting how many similar per-row messages were held back.
+    """
+
+    def format(self, record):
+        text = super().format(record)
+        suppressed = getattr(record, "suppressed", 0)
+        return f"{text} (+{suppressed} similar suppressed)" if suppressed else text
+
+
+class RowRateLimit(logging.Filter):
+    """
+    Caps records carrying a `rate_key` extra: ROW_LOG_BURST per key per
+    ROW_LOG_WINDOW seconds, then a 1-in-ROW_LOG_SAMPLE_EVERY sample. The next
+    record let through carries the number held back as `suppressed`. Records
+    without a rate_key always pass.
+    """
+
+    def __init__(self, burst=ROW_LOG_BURST, window=ROW_LOG_WINDOW, sample_every=ROW_LOG_SAMPLE_EVERY):
+        super().__init__()
+        self.burst = burst
+        self.window = window
+        self.sample_every = sample_every
+        self._lock = threading.Lock()
+        self._keys = {}  # rate_key -> [window start, seen in window, suppressed since last pass]
+
+    def filter(self, record):
+        key = getattr(record, "rate_key", None)
+        if key is None:
+            return True
+        now = time.monotonic()
+        with self._lock:
+            state = self._keys.get(key)
+            if state is None or now - state[0] >= self.window:
+                state = self._keys[key] = [now, 0, state[2] if state else 0]
+            state[1] += 1
+            if state[1] > self.burst and state[1] % self.sample_every:
+                state[2] += 1
+                return False
+            record.suppressed, state[2] = state[2], 0
+        return True
+
+    def pending(self):
+        """
+        Returns {rate_key: suppressed count} for keys with records held back since their last pass.
+        """
+        with self._lock:
+            return {key: state[2] for key, state in self._keys.items() if state[2]}
+
+
+_listener = None
+_queue_handler = None
+_config_lock = threading.Lock()
+
+def configure_logging(name, level=LOG_LEVEL, console=True):
+    """
+    Routes all logging through a QueueHandler, so callers only enqueue records;
+    a QueueListener thread writes them as JSON lines to LOGS_DIR/<name>.log
+    (and to stderr). Called once by each entry point, never at import time;
+    later calls keep the first configuration. Returns the log file path.
+    """
+    global _listener, _queue_handler
+    with _config_lock:
+        if _listener is not None:
+            return _listener.handlers[0].baseFilename
+
+        os.makedirs(LOGS_DIR, exist_ok=True)
+        file_handler = logging.FileHandler(os.path.join(LOGS_DIR, f"{name}.log"))
+        file_handler.setFormatter(JsonFormatter())
+        handlers = [file_handler]
+        if console:
+            stream_handler = logging.StreamHandler(sys.stderr)
+            stream_handler.setFormatter(JsonFormatter() if LOG_CONSOLE_FORMAT == "json" else TextFormatter(TEXT_FORMAT))
+            handlers.append(stream_handler)
+
+        log_queue = queue.SimpleQueue()
+        _queue_handler = _RecordQueueHandler(log_queue)
+        # Dropped per-row records are never formatted or queued
+        _queue_handler.addFilter(RowRateLimit())
+        root = logging.getLogger()
+        root.setLevel(level)
+        root.addHandler(_queue_handler)
+
+        _listener = QueueListener(log_queue, *handlers, respect_handler_level=True)
+        _listener.start()
+        atexit.register(shutdown_logging)
+        os.register_at_fork(after_in_child=_detach_after_fork)
+        return file_handler.baseFilename
+
+def _detach_after_fork():
+    # The listener thread does not survive fork: forked workers (replay's
+    # process pool) write through the inherited handlers directly instead
+    global _listener, _queue_handler
+    if _listener is None:
+        return
+    root = logging.getLogger()
+    root.removeHandler(_queue_handler)
+    for handler in _listener.handlers:
+        handler.addFilter(RowRateLimit())
+        root.addHandler(handler)
+    _listener = _queue_handler = None
+
+def shutdown_logging():
+    """
+    Reports still-suppressed per-row messages, then drains the queue and closes the handlers.
+    """
+    global _listener, _queue_handler
+    with _config_lock:
+        if _listener is None:
+            return
+        for rate_filter in _queue_handler.filters:
+            for key, count in rate_filter.pending().items():
+                logging.getLogger(__name__).warning(f"{count} more '{key}' messages suppressed",
+                                                    extra={"suppressed_key": key, "suppressed_total": count})
+        logging.getLogger().removeHandler(_queue_handler)
+        _listener.stop()
+        for handler in _listener.handlers:
+            handler.close()
+        _listener = _queue_handler = None
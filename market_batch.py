@@ -0,0 +1,244 @@
+import sys
+from array import array
+from datetime import datetime, timezone
+
+# --- Configuration & Constants ---
+# float64 columns, stored as array('d')
+FLOAT_COLUMNS = ("current_price", "market_cap", "total_volume", "price_change_24h", "volatility_score")
+# Interned string columns, stored as lists
+STRING_COLUMNS = ("coin_id", "symbol", "name")
+# Doc key order, matching transform_markets
+DOC_COLUMNS = [
+    "coin_id", "symbol", "name", "current_price", "market_cap", "total_volume",
+    "price_change_24h", "market_cap_rank", "volatility_score", "last_updated", "extracted_at"
+]
+# market_cap_rank is an int64 column; CoinGecko ranks start at 1, so 0 stands for None
+NO_RANK = 0
+NAN = float("nan")
+
+
+def _epoch(value):
+    if value is None:
+        return NAN
+    if value.tzinfo is None:
+        value = value.replace(tzinfo=timezone.utc)
+    return value.timestamp()
+
+def _datetime(epoch):
+    # NaN != NaN marks a missing timestamp
+    return None if epoch != epoch else datetime.fromtimestamp(epoch, tz=timezone.utc)
+
+def _intern(value):
+    return sys.intern(value) if type(value) is str else value
+
+
+class MarketBatch:
+    """
+    Column-oriented batch of transformed market rows.
+
+    Numeric columns live in typed arrays (8 bytes per coin each), string
+    columns hold interned str references and the extraction timestamp is
+    stored once per batch, instead of one 11-key dict and datetime per coin.
+    column() and to_frame() expose the arrays to NumPy/pandas without
+    copying; dicts are only built by iteration / to_docs(), at the database
+    boundary. Extra per-coin fields (indicators, quotes) ride along in
+    `extras` and are merged into those dicts.
+    """
+
+    __slots__ = ("coin_id", "symbol", "name", "market_cap_rank", "last_updated",
+                 "extracted_at", "_extracted", "extras") + FLOAT_COLUMNS
+
+    def __init__(self, extracted_at=None):
+        self.extracted_at = extracted_at
+        # Per-row extraction epochs, only for batches concatenated from several snapshots
+        self._extracted = None
+        self.coin_id, self.symbol, self.name = [], [], []
+        for column in FLOAT_COLUMNS:
+            setattr(self, column, array("d"))
+        self.market_cap_rank = array("q")
+        self.last_updated = array("d")
+        self.extras = {}
+
+    # --- Building ---
+    def append(self, coin_id, symbol, name, current_price, market_cap, total_volume,
+               price_change_24h, market_cap_rank, volatility_score, last_updated):
+        self.coin_id.append(_intern(coin_id))
+        self.symbol.append(_intern(symbol))
+        self.name.append(_intern(name))
+        self.current_price.append(current_price)
+        self.market_cap.append(market_cap)
+        self.total_volume.append(total_volume)
+        self.price_change_24h.append(price_change_24h)
+        self.market_cap_rank.append(NO_RANK if market_cap_rank is None else market_cap_rank)
+        self.volatility_score.append(volatility_score)
+        self.last_updated.append(_epoch(last_updated))
+
+    @classmethod
+    def from_docs(cls, docs):
+        """
+        Packs transform_markets-style dicts; keys outside DOC_COLUMNS become extras.
+        """
+        docs = list(docs)
+        stamps = {doc.get("extracted_at") for doc in docs}
+        batch = cls(stamps.pop() if len(stamps) == 1 else None)
+        if stamps:
+            batch._extracted = array("d", (_epoch(doc.get("extracted_at")) for doc in docs))
+        for doc in docs:
+            batch.append(*(doc.get(column) for column in DOC_COLUMNS[:-1]))
+        for key in {key for doc in docs for key in doc} - set(DOC_COLUMNS) - {"_id"}:
+            batch.extras[key] = [doc.get(key) for doc in docs]
+        return batch
+
+    @classmethod
+    def from_columns(cls, columns, extracted_at):
+        """
+        Packs whole columns ({name: array}, or a DataFrame, with DOC_COLUMNS
+        except extracted_at; e.g. from the columnar transform) straight into
+        the typed arrays, without building a dict per row.
+        """
+        import numpy as np
+        import pandas as pd
+
+        batch = cls(extracted_at)
+        for column in STRING_COLUMNS:
+            setattr(batch, column, [_intern(value) for value in columns[column].tolist()])
+        for column in FLOAT_COLUMNS:
+            getattr(batch, column).frombytes(np.ascontiguousarray(columns[column], dtype=np.float64).tobytes())
+        ranks = pd.Series(columns["market_cap_rank"]).to_numpy(dtype=np.int64, na_value=NO_RANK)
+        batch.market_cap_rank.frombytes(np.ascontiguousarray(ranks).tobytes())
+        # Whole microseconds / 1e6, exactly as datetime.timestamp() in _epoch
+        stamps = pd.Series(columns["last_updated"]).dt.tz_convert("UTC").dt.tz_localize(None)
+        stamps = stamps.to_numpy(dtype="datetime64[us]")
+        epochs = np.where(np.isnat(stamps), np.nan, stamps.astype(np.int64) / 1e6)
+        batch.last_updated.frombytes(epochs.astype(np.float64).tobytes())
+        return batch
+
+    @classmethod
+    def concat(cls, batches):
+        """
+        Joins batches (e.g. replayed snapshots) into one, keeping each row's extraction time.
+        """
+        batches = [b for b in batches if len(b)]
+        stamps = {b.extracted_at for b in batches if b._extracted is None}
+        uniform = len(stamps) == 1 and all(b._extracted is None for b in batches)
+        out = cls(stamps.pop() if uniform else None)
+        if not uniform:
+            out._extracted = array("d")
+        for b in batches:
+            for column in STRING_COLUMNS:
+                getattr(out, column).extend(getattr(b, column))
+            for column in FLOAT_COLUMNS + ("market_cap_rank", "last_updated"):
+                getattr(out, column).extend(getattr(b, column))
+            if not uniform:
+                out._extracted.extend(b._extracted if b._extracted is not None
+                                      else array("d", [_epoch(b.extracted_at)]) * len(b))
+        for key in {key for b in batches for key in b.extras}:
+            out.extras[key] = [v for b in batches for v in b.extras.get(key, [None] * len(b))]
+        return out
+
+    def with_extra(self, key, values):
+        """
+        Returns a batch sharing this one's columns with one more per-coin field.
+        """
+        if len(values) != len(self):
+            raise ValueError(f"Extra column {key} has {len(values)} values for {len(self)} rows")
+        out = MarketBatch.__new__(MarketBatch)
+        for slot in MarketBatch.__slots__:
+            setattr(out, slot, getattr(self, slot))
+        out.extras = {**self.extras, key: list(values)}
+        return out
+
+    # --- Columnar access ---
+    def __len__(self):
+        return len(self.coin_id)
+
+    def column(self, name):
+        """
+        Returns a column as a NumPy array; numeric columns are zero-copy views of the typed arrays.
+        """
+        import numpy as np
+
+        if name in FLOAT_COLUMNS or name == "last_updated":
+            return np.frombuffer(getattr(self, name), dtype=np.float64)
+        if name == "market_cap_rank":
+            return np.frombuffer(self.market_cap_rank, dtype=np.int64)
+        if name == "extracted_at":
+            if self._extracted is not None:
+                return np.frombuffer(self._extracted, dtype=np.float64)
+            return np.full(len(self), _epoch(self.extracted_at))
+        if name in STRING_COLUMNS:
+            return np.array(getattr(self, name), dtype=object)
+        return np.array(self.extras[name], dtype=object)
+
+    def to_frame(self):
+        """
+        Returns a DataFrame with DOC_COLUMNS (plus extras). Float columns share
+        memory with the batch; timestamps come back as UTC datetime64 columns.
+        """
+        import numpy as np
+        import pandas as pd
+
+        data = {name: self.column(name) for name in STRING_COLUMNS + FLOAT_COLUMNS}
+        ranks = self.column("market_cap_rank")
+        data["market_cap_rank"] = pd.arrays.IntegerArray(ranks, ranks == NO_RANK)
+        for name in ("last_updated", "extracted_at"):
+            # Through whole microseconds, so float rounding cannot shift the instant
+            data[name] = pd.to_datetime(np.round(self.column(name) * 1e6), unit="us", utc=True)
+        data.update({key: self.column(key) for key in self.extras})
+        frame = pd.DataFrame(data, copy=False)
+        return frame[DOC_COLUMNS + list(self.extras)]
+
+    def market_rows(self):
+        """
+        Yields one tuple per coin in DOC_COLUMNS order, with timestamps as epoch
+        seconds (None when missing), straight from the columns.
+        """
+        extracted = self._extracted if self._extracted is not None else [_epoch(self.extracted_at)] * len(self)
+        for row in zip(self.coin_id, self.symbol, self.name, self.current_price, self.market_cap,
+                       self.total_volume, self.price_change_24h, self.market_cap_rank,
+                       self.volatility_score, self.last_updated, extracted):
+            rank, last_updated = row[7], row[9]
+            yield row[:7] + (None if rank == NO_RANK else rank, row[8],
+                             None if last_updated != last_updated else last_updated, row[10])
+
+    # --- Dict view (database boundary) ---
+    def doc(self, i):
+        doc = {
+            "coin_id": self.coin_id[i],
+            "symbol": self.symbol[i],
+            "name": self.name[i],
+            "current_price": self.current_price[i],
+            "market_cap": self.market_cap[i],
+            "total_volume": self.total_volume[i],
+            "price_change_24h": self.price_change_24h[i],
+            "market_cap_rank": None if self.market_cap_rank[i] == NO_RANK else self.market_cap_rank[i],
+            "volatility_score": self.volatility_score[i],
+            "last_updated": _datetime(self.last_updated[i]),
+            "extracted_at": self.extracted_at if self._extracted is None else _datetime(self._extracted[i]),
+        }
+        for key, values in self.extras.items():
+            doc[key] = values[i]
+        return doc
+
+    def __iter__(self):
+        return (self.doc(i) for i in range(len(self)))
+
+    def to_docs(self):
+        return [self.doc(i) for i in range(len(self))]
+
+    def nbytes(self):
+        """
+        Approximate memory held by the columns (not counting shared interned strings or extras).
+        """
+        size = sum(getattr(self, c).itemsize * len(getattr(self, c)) for c in FLOAT_COLUMNS)
+        size += 8 * len(self) * (2 + len(STRING_COLUMNS))
+        if self._extracted is not None:
+            size += 8 * len(self)
+        return size
+
+
+def as_docs(docs):
+    """
+    Returns `docs` as a list of dicts, expanding a MarketBatch.
+    """
+    return docs.to_docs() if isinstance(docs, MarketBatch) else docs
@@ -0,0 +1,182 @@
+import json
+import os
+import time
+import uuid
+import logging
+import threading
+from contextlib import contextmanager
+from datetime import datetime, timezone
+
+# --- Configuration & Constants ---
+STATE_DIR = "state"
+# Written after every run, for node_exporter's textfile collector or any scraper
+PROMETHEUS_FILE = os.path.join(STATE_DIR, "etl_metrics.prom")
+METRIC_PREFIX = "crypto_etl"
+
+logger = logging.getLogger(__name__)
+
+
+class RunMetrics:
+    """
+    Stage timings and counters for one ETL run.
+
+    Stage times come from time.monotonic and are summed per stage, so a
+    stage running in several threads (e.g. HTTP waits in the extract pool)
+    reports the total time spent in it rather than wall-clock time.
+    """
+
+    def __init__(self, run_id=None, mode="batch"):
+        self.run_id = run_id or uuid.uuid4().hex
+        self.mode = mode
+        self.started_at = datetime.now(timezone.utc)
+        self.stages = {}
+        self.counters = {}
+        self._started = time.monotonic()
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def stage(self, name):
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            elapsed = time.monotonic() - start
+            with self._lock:
+                entry = self.stages.setdefault(name, {"seconds": 0.0, "calls": 0})
+                entry["seconds"] += elapsed
+                entry["calls"] += 1
+
+    def incr(self, name, amount=1):
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + amount
+
+    def elapsed(self):
+        return time.monotonic() - self._started
+
+    def to_doc(self, summary=None):
+        """
+        Returns the etl_runs document for this run.
+        """
+        with self._lock:
+            doc = {
+                "run_id": self.run_id,
+                "mode": self.mode,
+                "started_at": self.started_at,
+                "duration_seconds": self.elapsed(),
+                "stages": {name: dict(entry) for name, entry in self.stages.items()},
+                "counters": dict(self.counters),
+            }
+        if summary is not None:
+            doc["status"] = summary.get("status")
+            doc["error_message"] = summary.get("error_message")
+            doc["fetched"] = summary.get("fetched", 0)
+            doc["transformed"] = summary.get("transformed", 0)
+        return doc
+
+
+_current = None
+_current_lock = threading.Lock()
+
+def start_run(run_id=None, mode="batch"):
+    """
+    Starts collecting metrics for a new run; stage() and incr() calls from any thread go to it.
+    """
+    global _current
+    with _current_lock:
+        _current = RunMetrics(run_id, mode)
+    return _current
+
+def finish_run(run):
+    global _current
+    with _current_lock:
+        if _current is run:
+            _current = None
+
+@contextmanager
+def stage(name):
+    """
+    Times a block into the current run's `name` stage (a no-op outside a run).
+    """
+    run = _current
+    if run is None:
+        yield
+        return
+    with run.stage(name):
+        yield
+
+def incr(name, amount=1):
+    run = _current
+    if run is not None:
+        run.incr(name, amount)
+
+
+def _label(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+def to_prometheus(doc):
+    """
+    Renders an etl_runs document in the Prometheus text exposition format.
+    """
+    mode = _label(doc.get("mode", "batch"))
+    started = doc["started_at"]
+    if isinstance(started, str):
+        started = datetime.fromisoformat(started)
+    if started.tzinfo is None:
+        started = started.replace(tzinfo=timezone.utc)
+
+    lines = [
+        f"# HELP {METRIC_PREFIX}_run_duration_seconds Wall-clock duration of the last ETL run.",
+        f"# TYPE {METRIC_PREFIX}_run_duration_seconds gauge",
+        f'{METRIC_PREFIX}_run_duration_seconds{{mode="{mode}"}} {doc["duration_seconds"]:.6f}',
+        f"# HELP {METRIC_PREFIX}_run_success Whether the last ETL run succeeded (1) or not (0).",
+        f"# TYPE {METRIC_PREFIX}_run_success gauge",
+        f'{METRIC_PREFIX}_run_success{{mode="{mode}"}} {1 if doc.get("status") == "success" else 0}',
+        f"# HELP {METRIC_PREFIX}_run_timestamp_seconds Start time of the last ETL run.",
+        f"# TYPE {METRIC_PREFIX}_run_timestamp_seconds gauge",
+        f'{METRIC_PREFIX}_run_timestamp_seconds{{mode="{mode}"}} {started.timestamp():.3f}',
+        f"# HELP {METRIC_PREFIX}_stage_seconds Time spent per pipeline stage in the last run.",
+        f"# TYPE {METRIC_PREFIX}_stage_seconds gauge",
+    ]
+    for name, entry in sorted(doc.get("stages", {}).items()):
+        lines.append(f'{METRIC_PREFIX}_stage_seconds{{mode="{mode}",stage="{_label(name)}"}} {entry["seconds"]:.6f}')
+    lines += [
+        f"# HELP {METRIC_PREFIX}_stage_calls Calls per pipeline stage in the last run.",
+        f"# TYPE {METRIC_PREFIX}_stage_calls gauge",
+    ]
+    for name, entry in sorted(doc.get("stages", {}).items()):
+        lines.append(f'{METRIC_PREFIX}_stage_calls{{mode="{mode}",stage="{_label(name)}"}} {entry["calls"]}')
+    lines += [
+        f"# HELP {METRIC_PREFIX}_run_count Byte, record, retry and 429 counts of the last run.",
+        f"# TYPE {METRIC_PREFIX}_run_count gauge",
+    ]
+    for name, value in sorted(doc.get("counters", {}).items()):
+        lines.append(f'{METRIC_PREFIX}_run_count{{mode="{mode}",name="{_label(name)}"}} {value}')
+    return "\n".join(lines) + "\n"
+
+def write_prometheus(doc, path=PROMETHEUS_FILE):
+    """
+    Atomically rewrites the Prometheus textfile with the given run.
+    """
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w") as f:
+        f.write(to_prometheus(doc))
+    os.replace(tmp_path, path)
+
+
+def main(argv=None):
+    """
+    Prints the latest run's metrics in Prometheus text format (`crypto-etl metrics`).
+    """
+    import argparse
+    from storage import get_backend
+
+    argparse.ArgumentParser(description="Print the latest ETL run as Prometheus metrics.").parse_args(argv)
+    runs = get_backend().recent_runs(limit=1)
+    if not runs:
+        print("No ETL runs recorded yet.")
+    else:
+        print(to_prometheus(runs[0]), end="")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,214 @@
+import json
+import os
+import time
+import logging
+import threading
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+from file_lock import file_lock
+
+# --- Configuration & Constants ---
+STATE_DIR = "state"
+DEFAULT_STATE_FILE = os.path.join(STATE_DIR, "coingecko_ratelimit.json")
+
+# CoinGecko's public tier allows roughly 30 calls/minute.
+DEFAULT_RATE_PER_SEC = 0.5
+DEFAULT_CAPACITY = 5
+# Longest a caller is allowed to block waiting for a token before we fail fast.
+DEFAULT_MAX_WAIT = 10.0
+# Used when a 429 arrives without a usable Retry-After header.
+DEFAULT_RETRY_AFTER = 30.0
+# Consecutive 429s that trip the breaker, and how long it stays open.
+BREAKER_THRESHOLD = 3
+BREAKER_COOLDOWN = 120.0
+
+logger = logging.getLogger(__name__)
+
+
+class RateLimitError(Exception):
+    """Raised when a call cannot get a token within the allowed wait."""
+
+
+class CircuitOpenError(RateLimitError):
+    """Raised while the circuit breaker is open after repeated throttling."""
+
+
+def parse_retry_after(value):
+    """
+    Parses a Retry-After header (delta-seconds or HTTP-date) into seconds.
+    """
+    if not value:
+        return None
+    try:
+        return max(float(value), 0.0)
+    except ValueError:
+        pass
+    try:
+        retry_at = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    if retry_at.tzinfo is None:
+        retry_at = retry_at.replace(tzinfo=timezone.utc)
+    return max((retry_at - datetime.now(timezone.utc)).total_seconds(), 0.0)
+
+
+class RateLimiter:
+    """
+    Token bucket shared across processes through a lock-guarded state file.
+
+    Every process that points at the same state file draws from one budget.
+    A 429 empties the bucket and blocks it until Retry-After has passed;
+    repeated 429s open a circuit breaker so callers fail fast instead of
+    sleeping inside a request thread.
+    """
+
+    def __init__(self, state_file=DEFAULT_STATE_FILE, rate=DEFAULT_RATE_PER_SEC,
+                 capacity=DEFAULT_CAPACITY, max_wait=DEFAULT_MAX_WAIT,
+                 breaker_threshold=BREAKER_THRESHOLD, breaker_cooldown=BREAKER_COOLDOWN):
+        self.state_file = state_file
+        self.lock_file = f"{state_file}.lock"
+        self.rate = rate
+        self.capacity = capacity
+        self.max_wait = max_wait
+        self.breaker_threshold = breaker_threshold
+        self.breaker_cooldown = breaker_cooldown
+
+        state_dir = os.path.dirname(state_file)
+        if state_dir:
+            os.makedirs(state_dir, exist_ok=True)
+
+    # --- Shared state ---
+    def _locked(self):
+        return file_lock(self.lock_file)
+
+    def _default_state(self, now):
+        return {
+            "tokens": float(self.capacity),
+            "updated_at": now,
+            "blocked_until": 0.0,
+            "consecutive_throttles": 0,
+            "breaker_open_until": 0.0,
+            "counters": {"acquired": 0, "throttled": 0, "waited": 0, "rejected": 0},
+        }
+
+    def _read_state(self, now):
+        try:
+            with open(self.state_file) as f:
+                state = json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return self._default_state(now)
+
+        # Refill for the time elapsed since the last writer touched the bucket
+        elapsed = max(now - state.get("updated_at", now), 0.0)
+        state["tokens"] = min(self.capacity, state.get("tokens", 0.0) + elapsed * self.rate)
+        state["updated_at"] = now
+        return state
+
+    def _write_state(self, state):
+        tmp_path = f"{self.state_file}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(state, f)
+        os.replace(tmp_path, self.state_file)
+
+    # --- Public API ---
+    def acquire(self):
+        """
+        Takes one token, sleeping (outside the lock) for at most max_wait seconds.
+        Returns the number of seconds spent waiting.
+        """
+        waited = 0.0
+        while True:
+            with self._locked():
+                now = time.time()
+                state = self._read_state(now)
+                counters = state["counters"]
+
+                if state["breaker_open_until"] > now:
+                    counters["rejected"] += 1
+                    self._write_state(state)
+                    remaining = state["breaker_open_until"] - now
+                    raise CircuitOpenError(f"CoinGecko circuit open for another {remaining:.0f}s after repeated 429s")
+
+                wait = max(state["blocked_until"] - now, 0.0)
+                if wait == 0.0:
+                    if state["tokens"] >= 1.0:
+                        state["tokens"] -= 1.0
+                        counters["acquired"] += 1
+                        self._write_state(state)
+                        return waited
+                    wait = (1.0 - state["tokens"]) / self.rate
+
+                if waited + wait > self.max_wait:
+                    counters["rejected"] += 1
+                    self._write_state(state)
+                    raise RateLimitError(f"No CoinGecko token within {self.max_wait:.0f}s (next in {wait:.1f}s)")
+
+                if waited == 0.0:
+                    counters["waited"] += 1
+                    self._write_state(state)
+
+            logger.info(f"Rate limiter: waiting {wait:.2f}s for a token")
+            time.sleep(wait)
+            waited += wait
+
+    def record_throttle(self, retry_after=None):
+        """
+        Registers a 429: drains the bucket until Retry-After and trips the
+        breaker once the throttles keep coming.
+        """
+        delay = retry_after if retry_after is not None else DEFAULT_RETRY_AFTER
+        with self._locked():
+            now = time.time()
+            state = self._read_state(now)
+            state["tokens"] = 0.0
+            state["blocked_until"] = max(state["blocked_until"], now + delay)
+            state["consecutive_throttles"] += 1
+            state["counters"]["throttled"] += 1
+
+            if state["consecutive_throttles"] >= self.breaker_threshold:
+                state["breaker_open_until"] = now + max(self.breaker_cooldown, delay)
+                logger.warning(f"Circuit breaker opened for {max(self.breaker_cooldown, delay):.0f}s after {state['consecutive_throttles']} consecutive 429s")
+            self._write_state(state)
+
+    def record_success(self):
+        """
+        Resets the throttle streak (closing a half-open breaker).
+        """
+        with self._locked():
+            state = self._read_state(time.time())
+            if state["consecutive_throttles"] or state["breaker_open_until"]:
+                state["consecutive_throttles"] = 0
+                state["breaker_open_until"] = 0.0
+                self._write_state(state)
+
+    def stats(self):
+        """
+        Returns the shared counters plus the current bucket and breaker state.
+        """
+        with self._locked():
+            now = time.time()
+            state = self._read_state(now)
+        return {
+            **state["counters"],
+            "tokens": round(state["tokens"], 3),
+            "blocked_for": max(state["blocked_until"] - now, 0.0),
+            "breaker_open": state["breaker_open_until"] > now,
+        }
+
+
+_default_limiter = None
+_default_lock = threading.Lock()
+
+def get_limiter():
+    """
+    Returns the process-wide limiter used by every extract call.
+    """
+    global _default_limiter
+    with _default_lock:
+        if _default_limiter is None:
+            _default_limiter = RateLimiter()
+    return _default_limiter
+
+
+if __name__ == "__main__":
+    print(json.dumps(get_limiter().stats(), indent=2))
@@ -0,0 +1,244 @@
+import bisect
+import glob
+import gzip
+import json
+import os
+import logging
+import threading
+from datetime import datetime, timezone
+from file_lock import file_lock
+
+# --- Configuration & Constants ---
+DATA_RAW_DIR = "data_raw"
+ARCHIVE_DIR = os.path.join(DATA_RAW_DIR, "archive")
+INDEX_FILENAME = "index.ndjson"
+# Roll over to a new segment once the current one passes this size.
+MAX_SEGMENT_BYTES = 64 * 1024 * 1024
+COMPRESS_LEVEL = 6
+
+logger = logging.getLogger(__name__)
+
+
+def _to_epoch(ts):
+    if ts is None:
+        return None
+    if isinstance(ts, (int, float)):
+        return float(ts)
+    if ts.tzinfo is None:
+        ts = ts.astimezone()  # naive datetimes are local time, like the legacy filenames
+    return ts.timestamp()
+
+def _to_datetime(epoch):
+    return datetime.fromtimestamp(epoch, tz=timezone.utc)
+
+
+class RawArchive:
+    """
+    Append-only archive of raw /coins/markets snapshots.
+
+    Each snapshot is compact NDJSON (one coin per line) compressed as its own
+    gzip member and appended to the current segment file, so any snapshot can
+    be read with a single seek + decompress. index.ndjson maps snapshot time
+    to (segment, offset, length); segments roll over at MAX_SEGMENT_BYTES.
+    A multi-page pull is stored as one entry per page sharing the snapshot
+    timestamp, and read back as a single snapshot.
+    """
+
+    def __init__(self, root=ARCHIVE_DIR, max_segment_bytes=MAX_SEGMENT_BYTES):
+        self.root = root
+        self.max_segment_bytes = max_segment_bytes
+        self.index_path = os.path.join(root, INDEX_FILENAME)
+        self.lock_path = os.path.join(root, ".lock")
+        self._entries = []
+        self._keys = []
+        self._index_pos = 0
+        self._lock = threading.Lock()
+        os.makedirs(root, exist_ok=True)
+
+    # --- Index ---
+    def _refresh_index(self):
+        """
+        Picks up index lines appended since the last read (by any process).
+        """
+        with self._lock:
+            try:
+                with open(self.index_path, "rb") as f:
+                    f.seek(self._index_pos)
+                    chunk = f.read()
+            except FileNotFoundError:
+                return list(self._entries)
+
+            # Only consume complete lines; a writer may be mid-append
+            complete = chunk[:chunk.rfind(b"\n") + 1]
+            self._index_pos += len(complete)
+            new_entries = [json.loads(line) for line in complete.splitlines() if line.strip()]
+            if new_entries:
+                self._entries.extend(new_entries)
+                # Legacy imports can land out of order, so keep the index sorted
+                self._entries.sort(key=lambda e: (e["ts"], e.get("page", 0)))
+                self._keys = [e["ts"] for e in self._entries]
+            return list(self._entries)
+
+    def entries(self, start=None, end=None):
+        """
+        Returns index entries with start <= ts <= end (None means unbounded).
+        """
+        entries = self._refresh_index()
+        lo = 0 if start is None else bisect.bisect_left(self._keys, _to_epoch(start))
+        hi = len(entries) if end is None else bisect.bisect_right(self._keys, _to_epoch(end))
+        return entries[lo:hi]
+
+    def snapshot_groups(self, start=None, end=None, vs_currency="usd"):
+        """
+        Returns [(ts, [entries])] with the page entries of each snapshot grouped together.
+        Only pages quoted in `vs_currency` are included (entries without "vs" are USD).
+        """
+        groups = []
+        for entry in self.entries(start, end):
+            if entry.get("vs", "usd") != vs_currency:
+                continue
+            if groups and groups[-1][0] == entry["ts"]:
+                groups[-1][1].append(entry)
+            else:
+                groups.append((entry["ts"], [entry]))
+        return groups
+
+    # --- Writing ---
+    def _segment_name(self, seq):
+        return f"segment_{seq:06d}.ndjson.gz"
+
+    def append(self, data, ts=None, page=None, vs_currency="usd"):
+        """
+        Appends one snapshot (or one page of it) and returns its index entry.
+        """
+        epoch = _to_epoch(ts) if ts is not None else datetime.now(timezone.utc).timestamp()
+        payload = "".join(json.dumps(item, separators=(",", ":")) + "\n" for item in data)
+        member = gzip.compress(payload.encode("utf-8"), compresslevel=COMPRESS_LEVEL)
+
+        with file_lock(self.lock_path):
+            existing = sorted(glob.glob(os.path.join(self.root, "segment_*.ndjson.gz")))
+            if existing:
+                segment_path = existing[-1]
+                if os.path.getsize(segment_path) >= self.max_segment_bytes:
+                    seq = int(os.path.basename(segment_path)[len("segment_"):-len(".ndjson.gz")]) + 1
+                    segment_path = os.path.join(self.root, self._segment_name(seq))
+                    logger.info(f"Rolling over to new archive segment {segment_path}")
+            else:
+                segment_path = os.path.join(self.root, self._segment_name(1))
+
+            with open(segment_path, "ab") as f:
+                offset = f.tell()
+                f.write(member)
+
+            entry = {
+                "ts": epoch,
+                "segment": os.path.basename(segment_path),
+                "offset": offset,
+                "length": len(member),
+                "count": len(data),
+            }
+            if page is not None:
+                entry["page"] = page
+            if vs_currency != "usd":
+                entry["vs"] = vs_currency
+            with open(self.index_path, "a") as f:
+                f.write(json.dumps(entry, separators=(",", ":")) + "\n")
+
+        logger.info(f"Archived {len(data)} coins to {entry['segment']} @ {offset} ({len(member)} bytes)")
+        return entry
+
+    # --- Reading ---
+    def read_entry(self, entry):
+        """
+        Decompresses a single snapshot given its index entry.
+        """
+        with open(os.path.join(self.root, entry["segment"]), "rb") as f:
+            f.seek(entry["offset"])
+            member = f.read(entry["length"])
+        lines = gzip.decompress(member).splitlines()
+        return [json.loads(line) for line in lines if line]
+
+    def read_group(self, entries):
+        """
+        Reads and concatenates the pages of one snapshot.
+        """
+        data = []
+        for entry in entries:
+            data.extend(self.read_entry(entry))
+        return data
+
+    def read_snapshot(self, at=None):
+        """
+        Returns (timestamp, data) for the latest snapshot at or before `at`
+        (the newest snapshot when `at` is None), or None if there is none.
+        """
+        groups = self.snapshot_groups(end=at)
+        if not groups:
+            return None
+        ts, entries = groups[-1]
+        return _to_datetime(ts), self.read_group(entries)
+
+    def iter_snapshots(self, start=None, end=None):
+        """
+        Yields (timestamp, data) for every snapshot in [start, end], oldest first,
+        decompressing one snapshot at a time.
+        """
+        for ts, entries in self.snapshot_groups(start, end):
+            yield _to_datetime(ts), self.read_group(entries)
+
+    # --- Legacy files ---
+    def import_legacy_files(self, raw_dir=DATA_RAW_DIR, remove=False):
+        """
+        Imports indent=4 data_raw/markets_<ts>.json files into the archive.
+        """
+        imported = 0
+        known = {e["ts"] for e in self._refresh_index()}
+        for path, ts in iter_legacy_files(raw_dir):
+            if _to_epoch(ts) in known:
+                continue
+            with open(path) as f:
+                data = json.load(f)
+            self.append(data, ts=ts)
+            imported += 1
+            if remove:
+                os.remove(path)
+        logger.info(f"Imported {imported} legacy snapshot files from {raw_dir}")
+        return imported
+
+
+def iter_legacy_files(raw_dir=DATA_RAW_DIR):
+    """
+    Yields (path, local timestamp) for legacy markets_<YYYYmmdd_HHMMSS>.json files.
+    """
+    for path in sorted(glob.glob(os.path.join(raw_dir, "markets_*.json"))):
+        stamp = os.path.basename(path)[len("markets_"):-len(".json")]
+        try:
+            ts = datetime.strptime(stamp, "%Y%m%d_%H%M%S")
+        except ValueError:
+            logger.warning(f"Skipping raw file with unexpected name: {path}")
+            continue
+        yield path, ts.astimezone()
+
+
+_default_archive = None
+_default_lock = threading.Lock()
+
+def get_archive():
+    """
+    Returns the process-wide archive that extract writes to.
+    """
+    global _default_archive
+    with _default_lock:
+        if _default_archive is None:
+            _default_archive = RawArchive()
+    return _default_archive
+
+
+if __name__ == "__main__":
+    archive = get_archive()
+    archive.import_legacy_files()
+    groups = archive.snapshot_groups()
+    print(f"Snapshots archived: {len(groups)}")
+    if groups:
+        ts, data = archive.read_snapshot()
+        print(f"Latest snapshot: {ts.isoformat()} ({len(data)} coins)")
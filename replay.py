@@ -0,0 +1,152 @@
+import argparse
+import json
+import logging
+import os
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timezone
+from raw_archive import get_archive, iter_legacy_files
+from transform import transform_markets_batch
+from market_batch import MarketBatch
+
+logger = logging.getLogger(__name__)
+
+STATE_DIR = "state"
+CHECKPOINT_FILE = os.path.join(STATE_DIR, "replay_checkpoint.json")
+DEFAULT_BATCH_SIZE = 5000
+DEFAULT_WORKERS = os.cpu_count() or 2
+
+
+def _read_checkpoint(path=CHECKPOINT_FILE):
+    try:
+        with open(path) as f:
+            return json.load(f).get("last_ts")
+    except (FileNotFoundError, json.JSONDecodeError):
+        return None
+
+def _write_checkpoint(last_ts, loaded, path=CHECKPOINT_FILE):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w") as f:
+        json.dump({"last_ts": last_ts, "loaded": loaded, "updated_at": datetime.now(timezone.utc).isoformat()}, f)
+    os.replace(tmp_path, path)
+
+def collect_sources(start=None, end=None):
+    """
+    Lists archived and legacy snapshots in [start, end] as (epoch, source) pairs, oldest first.
+    """
+    archive = get_archive()
+    sources = {ts: ("archive", entries) for ts, entries in archive.snapshot_groups(start, end)}
+    start_epoch = start.timestamp() if start else None
+    end_epoch = end.timestamp() if end else None
+
+    for path, ts in iter_legacy_files():
+        epoch = ts.timestamp()
+        if (start_epoch is not None and epoch < start_epoch) or (end_epoch is not None and epoch > end_epoch):
+            continue
+        # Archived copies of a legacy file win
+        sources.setdefault(epoch, ("legacy", path))
+
+    return sorted(sources.items())
+
+def _transform_source(item):
+    """
+    Worker: reads one snapshot and transforms it with its own timestamp.
+    Runs in a child process, so it only receives the small index records and
+    sends back a compact MarketBatch (pickled as raw arrays, not dicts).
+    """
+    epoch, (kind, ref) = item
+    if kind == "archive":
+        raw = get_archive().read_group(ref)
+    else:
+        with open(ref) as f:
+            raw = json.load(f)
+    extracted_at = datetime.fromtimestamp(epoch, tz=timezone.utc)
+    return epoch, transform_markets_batch(raw, extracted_at=extracted_at)
+
+def replay(start=None, end=None, workers=DEFAULT_WORKERS, batch_size=DEFAULT_BATCH_SIZE, reset=False):
+    """
+    Rebuilds crypto_market_history from archived raw snapshots.
+
+    Snapshots are transformed in a process pool (results are consumed in
+    time order) and loaded in time-ordered insert_many batches of roughly
+    `batch_size` docs. After each batch the timestamp of its last snapshot is
+    checkpointed, so an interrupted replay resumes where it stopped; rows
+    already present are reported as duplicates by the history unique index.
+    """
+    from storage import get_backend
+
+    if reset and os.path.exists(CHECKPOINT_FILE):
+        os.remove(CHECKPOINT_FILE)
+    checkpoint = _read_checkpoint()
+
+    sources = [s for s in collect_sources(start, end) if checkpoint is None or s[0] > checkpoint]
+    summary = {"snapshots": len(sources), "transformed": 0, "inserted": 0, "duplicates": 0, "batches": 0, "status": "success"}
+    if not sources:
+        logger.info("Replay: nothing to do (checkpoint is up to date).")
+        return summary
+
+    logger.info(f">>> Replaying {len(sources)} snapshots with {workers} workers (batch size {batch_size})")
+    backend = get_backend()
+
+    batch, batch_last_ts = [], None
+    batch_rows = 0
+
+    def flush():
+        nonlocal batch_rows
+        # Unordered (in Mongo) so rows left over from an interrupted batch do not stop the rest
+        history_res = backend.append_history(MarketBatch.concat(batch))
+        summary["inserted"] += history_res["inserted"]
+        summary["duplicates"] += history_res["duplicates"]
+        summary["batches"] += 1
+        if history_res["errors"]:
+            raise RuntimeError(f"Batch ending at {batch_last_ts} had {history_res['errors']}/{batch_rows} failed docs")
+        _write_checkpoint(batch_last_ts, summary["inserted"])
+        batch.clear()
+        batch_rows = 0
+
+    try:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            # map() yields in submission order, which keeps batches time-ordered
+            for epoch, docs in executor.map(_transform_source, sources, chunksize=8):
+                summary["transformed"] += len(docs)
+                batch.append(docs)
+                batch_rows += len(docs)
+                batch_last_ts = epoch
+                if batch_rows >= batch_size:
+                    flush()
+            if batch:
+                flush()
+    except Exception as e:
+        logger.error(f"Replay stopped: {e}. Resume from checkpoint by re-running.")
+        summary["status"] = "error"
+        summary["error_message"] = str(e)
+        return summary
+
+    logger.info(f"<<< Replay complete: {summary}")
+    return summary
+
+def _parse_time(value):
+    ts = datetime.fromisoformat(value)
+    return ts if ts.tzinfo else ts.replace(tzinfo=timezone.utc)
+
+def main(argv=None):
+    """
+    Replays archived snapshots into history and prints the summary (`crypto-etl replay`).
+    """
+    from log_setup import configure_logging
+
+    parser = argparse.ArgumentParser(description="Rebuild crypto_market_history from archived raw snapshots.")
+    parser.add_argument("--start", type=_parse_time, help="ISO timestamp (UTC if no offset)")
+    parser.add_argument("--end", type=_parse_time, help="ISO timestamp (UTC if no offset)")
+    parser.add_argument("--workers", type=int, default=DEFAULT_WORKERS)
+    parser.add_argument("--batch-size", type=int, default=DEFAULT_BATCH_SIZE)
+    parser.add_argument("--reset", action="store_true", help="Ignore the checkpoint and replay everything")
+    args = parser.parse_args(argv)
+
+    configure_logging("replay")
+    result = replay(args.start, args.end, workers=args.workers, batch_size=args.batch_size, reset=args.reset)
+    print("\n--- Replay Summary ---")
+    print(json.dumps(result, indent=2))
+
+if __name__ == "__main__":
+    main()
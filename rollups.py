@@ -0,0 +1,174 @@
+import argparse
+import json
+import logging
+from datetime import datetime, timedelta, timezone
+from pymongo import UpdateOne, ASCENDING
+from pymongo.errors import BulkWriteError
+
+logger = logging.getLogger(__name__)
+
+# Bucket granularities: name -> ($dateTrunc unit, bucket collection)
+GRANULARITIES = {
+    "1m": ("minute", "crypto_market_ohlc_1m"),
+    "1h": ("hour", "crypto_market_ohlc_1h"),
+    "1d": ("day", "crypto_market_ohlc_1d"),
+}
+
+# $dateTrunc unit -> bucket length, for widening rebuild ranges to whole buckets
+BUCKET_LENGTHS = {"minute": timedelta(minutes=1), "hour": timedelta(hours=1), "day": timedelta(days=1)}
+
+# Metrics tracked as open/high/low/close per bucket: bucket field -> history field
+OHLC_FIELDS = {
+    "price": "current_price",
+    "volume": "total_volume",
+    "market_cap": "market_cap",
+    "volatility_score": "volatility_score",
+}
+
+
+def bucket_start(ts, unit):
+    """
+    Truncates a datetime to the start of its minute/hour/day bucket (UTC).
+    """
+    if ts.tzinfo is not None:
+        ts = ts.astimezone(timezone.utc)
+    if unit == "minute":
+        return ts.replace(second=0, microsecond=0)
+    if unit == "hour":
+        return ts.replace(minute=0, second=0, microsecond=0)
+    return ts.replace(hour=0, minute=0, second=0, microsecond=0)
+
+def _bucket_update(doc, bucket):
+    set_on_insert = {"first_at": doc["extracted_at"]}
+    set_fields = {"last_at": doc["extracted_at"]}
+    min_fields, max_fields = {}, {}
+    for name, source in OHLC_FIELDS.items():
+        value = doc.get(source)
+        if value is None:
+            continue
+        set_on_insert[f"{name}.open"] = value
+        min_fields[f"{name}.low"] = value
+        max_fields[f"{name}.high"] = value
+        set_fields[f"{name}.close"] = value
+
+    update = {"$setOnInsert": set_on_insert, "$min": min_fields, "$max": max_fields, "$set": set_fields}
+    return UpdateOne(
+        {"coin_id": doc["coin_id"], "bucket": bucket},
+        {op: fields for op, fields in update.items() if fields},
+        upsert=True
+    )
+
+def apply_rollups(db, docs, granularities=tuple(GRANULARITIES)):
+    """
+    Folds freshly loaded history docs into the OHLC bucket collections.
+
+    One upsert per (coin, bucket): open is set on insert, high/low move with
+    $max/$min and close/last_at are overwritten, so docs must arrive in
+    extracted_at order (as they do from run_etl and replay).
+    Returns the number of bucket writes per granularity.
+    """
+    summary = {}
+    if not docs:
+        return summary
+
+    ordered_docs = sorted(docs, key=lambda d: d["extracted_at"])
+    for name in granularities:
+        unit, collection = GRANULARITIES[name]
+        ops = [_bucket_update(doc, bucket_start(doc["extracted_at"], unit)) for doc in ordered_docs]
+        try:
+            # Ordered so repeated updates to one bucket keep their time order
+            result = db[collection].bulk_write(ops, ordered=True)
+            summary[name] = result.upserted_count + result.modified_count
+        except BulkWriteError as bwe:
+            logger.error(f"Rollup {name} partially failed: {len(bwe.details.get('writeErrors', []))} errors")
+            summary[name] = bwe.details.get("nUpserted", 0) + bwe.details.get("nModified", 0)
+
+    logger.info(f"Rollup Summary: {summary}")
+    return summary
+
+def rebuild_rollups(db, granularities=tuple(GRANULARITIES), start=None, end=None):
+    """
+    Recomputes bucket collections from crypto_market_history server-side.
+
+    Groups raw rows per (coin_id, $dateTrunc bucket) in an aggregation and
+    $merges the result, replacing existing buckets in the range. start/end
+    are widened to whole buckets of each granularity, so a replaced bucket
+    is always rebuilt from all of its rows.
+    """
+    for name in granularities:
+        unit, collection = GRANULARITIES[name]
+        match = {}
+        if start or end:
+            match["extracted_at"] = {}
+            if start:
+                match["extracted_at"]["$gte"] = bucket_start(start, unit)
+            if end:
+                match["extracted_at"]["$lt"] = bucket_start(end, unit) + BUCKET_LENGTHS[unit]
+        group = {
+            "_id": {"coin_id": "$coin_id", "bucket": {"$dateTrunc": {"date": "$extracted_at", "unit": unit}}},
+            "first_at": {"$first": "$extracted_at"},
+            "last_at": {"$last": "$extracted_at"},
+        }
+        project = {"_id": 0, "coin_id": "$_id.coin_id", "bucket": "$_id.bucket", "first_at": 1, "last_at": 1}
+        for field, source in OHLC_FIELDS.items():
+            group[f"{field}_open"] = {"$first": f"${source}"}
+            group[f"{field}_high"] = {"$max": f"${source}"}
+            group[f"{field}_low"] = {"$min": f"${source}"}
+            group[f"{field}_close"] = {"$last": f"${source}"}
+            project[field] = {
+                "open": f"${field}_open", "high": f"${field}_high",
+                "low": f"${field}_low", "close": f"${field}_close",
+            }
+
+        pipeline = [
+            {"$match": match},
+            {"$sort": {"coin_id": ASCENDING, "extracted_at": ASCENDING}},
+            {"$group": group},
+            {"$project": project},
+            {"$merge": {"into": collection, "on": ["coin_id", "bucket"], "whenMatched": "replace", "whenNotMatched": "insert"}},
+        ]
+        logger.info(f"Rebuilding {collection} from crypto_market_history...")
+        db.crypto_market_history.aggregate(pipeline, allowDiskUse=True)
+        logger.info(f"Rebuilt {collection}: {db[collection].estimated_document_count()} buckets")
+
+def query_ohlc(db, coin_id, granularity="1h", start=None, end=None):
+    """
+    Returns the OHLC buckets for one coin in [start, end], oldest first.
+    """
+    _, collection = GRANULARITIES[granularity]
+    query = {"coin_id": coin_id}
+    if start or end:
+        query["bucket"] = {}
+        if start:
+            query["bucket"]["$gte"] = bucket_start(start, GRANULARITIES[granularity][0])
+        if end:
+            query["bucket"]["$lte"] = end
+    return list(db[collection].find(query, {"_id": 0}).sort("bucket", ASCENDING))
+
+def _parse_time(value):
+    ts = datetime.fromisoformat(value)
+    return ts if ts.tzinfo else ts.replace(tzinfo=timezone.utc)
+
+def main(argv=None):
+    """
+    Rebuilds OHLC rollups and prints the bucket counts (`crypto-etl rollups`).
+    """
+    from db_mongo import get_db, ensure_indexes
+    from log_setup import configure_logging
+
+    parser = argparse.ArgumentParser(description="Rebuild OHLC rollups from crypto_market_history.")
+    parser.add_argument("--granularity", choices=sorted(GRANULARITIES), action="append",
+                        help="Bucket size to rebuild (repeatable; default: all)")
+    parser.add_argument("--start", type=_parse_time, help="ISO timestamp (UTC if no offset)")
+    parser.add_argument("--end", type=_parse_time, help="ISO timestamp (UTC if no offset)")
+    args = parser.parse_args(argv)
+
+    configure_logging("rollups")
+
+    db = get_db()
+    ensure_indexes(db)
+    rebuild_rollups(db, tuple(args.granularity or GRANULARITIES), args.start, args.end)
+    print(json.dumps({name: db[coll].estimated_document_count() for name, (_, coll) in GRANULARITIES.items()}, indent=2))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,230 @@
+import argparse
+import logging
+import os
+import json
+import random
+import signal
+import socket
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from etl_pipeline import run_etl, currency_args
+from rate_limiter import get_limiter
+from storage import get_backend
+from spool import get_drainer
+from snapshot_service import SNAPSHOT_PORT, get_store, start_server
+
+logger = logging.getLogger(__name__)
+
+# --- Configuration & Constants ---
+ETL_INTERVAL_SECONDS = float(os.getenv("ETL_INTERVAL_SECONDS", "300"))
+# Each delay is stretched or shrunk by up to this share, so instances do not fire in lockstep
+ETL_JITTER = float(os.getenv("ETL_JITTER", "0.1"))
+# How often queued run requests (e.g. from the dashboard) are checked
+POLL_INTERVAL = 5.0
+
+LEASE_NAME = "etl"
+# The lease is renewed every LEASE_TTL / 3 while a run is in progress
+LEASE_TTL = 120.0
+# Upper bound for the rate-limit backoff
+MAX_BACKOFF = 3600.0
+RATE_LIMIT_ERRORS = {"RateLimitError", "CircuitOpenError"}
+# run_etl arguments a queued request may override
+REQUEST_PARAMS = {"save_history", "pages", "per_page", "streaming", "concurrency", "currencies"}
+
+
+class Scheduler:
+    """
+    Runs the ETL pipeline on a fixed cadence (with jitter) and drains queued run requests.
+
+    Every run happens under a lease held in the storage backend, so two
+    scheduler instances (or a manual run through run_once) never overlap.
+    Runs that hit rate limits push the next run out exponentially, up to
+    MAX_BACKOFF, and never earlier than the limiter's own Retry-After block.
+    """
+
+    def __init__(self, backend=None, interval=ETL_INTERVAL_SECONDS, jitter=ETL_JITTER,
+                 poll_interval=POLL_INTERVAL, run_kwargs=None, snapshot_store=None):
+        self.backend = backend or get_backend()
+        # In-memory snapshot served from this process (see snapshot_service), if any
+        self.snapshot_store = snapshot_store
+        self.interval = interval
+        self.jitter = jitter
+        self.poll_interval = poll_interval
+        self.run_kwargs = run_kwargs or {}
+        self.owner = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:6]}"
+        self.stop_event = threading.Event()
+        self.backoff = 0.0
+        self.next_due = time.monotonic()
+
+    def _jittered(self, delay):
+        return max(delay * (1 + random.uniform(-self.jitter, self.jitter)), 0.0)
+
+    @contextmanager
+    def lease(self):
+        """
+        Holds the ETL lease for the duration of the block, renewing it in the
+        background. Yields False (and runs nothing) when another owner has it.
+        """
+        if not self.backend.acquire_lease(LEASE_NAME, self.owner, LEASE_TTL):
+            yield False
+            return
+
+        stop = threading.Event()
+        def renew():
+            while not stop.wait(LEASE_TTL / 3):
+                if not self.backend.acquire_lease(LEASE_NAME, self.owner, LEASE_TTL):
+                    logger.error("Lost the ETL lease while a run was in progress")
+
+        renewer = threading.Thread(target=renew, name="etl-lease", daemon=True)
+        renewer.start()
+        try:
+            yield True
+        finally:
+            stop.set()
+            renewer.join()
+            self.backend.release_lease(LEASE_NAME, self.owner)
+
+    def _has_pending_request(self):
+        return any(r["status"] == "pending" for r in self.backend.recent_run_requests(limit=1))
+
+    def _seconds_since_last_run(self):
+        runs = self.backend.recent_runs(limit=1)
+        if not runs:
+            return None
+        started = runs[0]["started_at"]
+        if started.tzinfo is None:
+            started = started.replace(tzinfo=timezone.utc)
+        return (datetime.now(timezone.utc) - started).total_seconds()
+
+    def run_once(self, request_only=False):
+        """
+        Runs the pipeline once under the lease, serving the oldest queued
+        request if there is one. Returns the run summary, or None when the
+        lease is held elsewhere (or request_only and nothing is queued).
+        """
+        with self.lease() as held:
+            if not held:
+                logger.info("ETL lease is held by another instance; skipping")
+                return None
+
+            request = self.backend.claim_run_request(self.owner)
+            if request is None and request_only:
+                return None
+
+            params = dict(self.run_kwargs)
+            if request is not None:
+                params.update({k: v for k, v in request.get("params", {}).items() if k in REQUEST_PARAMS})
+                logger.info(f"Serving run request {request['request_id']} from {request.get('requested_by')}")
+
+            summary = run_etl(backend=self.backend, **params)
+            if self.snapshot_store is not None:
+                # run_etl already published its docs in-process; don't reload them on the next sync
+                self.snapshot_store.source_version = self.backend.snapshot_version()
+            if request is not None:
+                self.backend.finish_run_request(request["request_id"], summary["status"], summary.get("run_id"))
+        return summary
+
+    def _schedule_after(self, summary):
+        """
+        Sets the next due time: the normal cadence, or an exponential backoff after rate limiting.
+        """
+        throttled = summary.get("metrics", {}).get("counters", {}).get("http_429", 0)
+        if summary.get("error_type") in RATE_LIMIT_ERRORS or throttled:
+            self.backoff = min(max(self.backoff * 2, self.interval), MAX_BACKOFF)
+            delay = max(self.backoff, get_limiter().stats()["blocked_for"])
+            logger.warning(f"Rate limited ({throttled} x 429, {summary.get('error_type')}); backing off {delay:.0f}s")
+        else:
+            self.backoff = 0.0
+            delay = self.interval
+        self.next_due = time.monotonic() + self._jittered(delay)
+
+    def tick(self):
+        now = time.monotonic()
+        due = now >= self.next_due
+        if due:
+            since_last = self._seconds_since_last_run()
+            if since_last is not None and since_last < self.interval * (1 - self.jitter):
+                # Another instance ran recently; keep to the shared cadence
+                self.next_due = now + self._jittered(self.interval - since_last)
+                due = False
+        if not due and (self.backoff or not self._has_pending_request()):
+            # Queued requests run right away, except while backing off from rate limits
+            return
+
+        summary = self.run_once(request_only=not due)
+        if summary is None:
+            if due:
+                self.next_due = now + self._jittered(self.interval)
+            return
+        logger.info(f"Run {summary.get('run_id')} finished: {summary['status']} in {summary.get('duration_seconds', 0):.2f}s")
+        self._schedule_after(summary)
+
+    def run_forever(self):
+        def handle_signal(signum, frame):
+            logger.info(f"Received signal {signum}; stopping after the current run")
+            self.stop_event.set()
+
+        signal.signal(signal.SIGINT, handle_signal)
+        signal.signal(signal.SIGTERM, handle_signal)
+
+        logger.info(f">>> Scheduler {self.owner} started: every {self.interval:.0f}s (+/-{self.jitter:.0%}), "
+                    f"backend {self.backend.name}")
+        # Loads spooled while the database was unavailable are replayed in the background
+        drainer = get_drainer(self.backend)
+        while not self.stop_event.is_set():
+            try:
+                if self.snapshot_store is not None:
+                    # Picks up runs made by other processes (one version read per poll)
+                    self.snapshot_store.sync(self.backend)
+                self.tick()
+            except Exception as e:
+                logger.error(f"Scheduler tick failed: {e}")
+                self.next_due = time.monotonic() + self._jittered(self.poll_interval * 6)
+            self.stop_event.wait(self.poll_interval)
+        if not drainer.flush(timeout=self.poll_interval * 6):
+            logger.warning(f"Stopping with {drainer.spool.backlog()['records']} spool records left; the next start drains them")
+        drainer.stop()
+        logger.info("<<< Scheduler stopped.")
+
+
+def main(argv=None):
+    """
+    Runs the scheduler daemon, or a single leased run with --once (`crypto-etl schedule`).
+    """
+    from log_setup import configure_logging
+
+    parser = argparse.ArgumentParser(description="Run the ETL pipeline on a schedule and serve queued run requests.")
+    parser.add_argument("--interval", type=float, default=ETL_INTERVAL_SECONDS, help="Seconds between runs")
+    parser.add_argument("--jitter", type=float, default=ETL_JITTER, help="Random share of the interval (0-1)")
+    parser.add_argument("--pages", type=int, default=1)
+    parser.add_argument("--per-page", type=int, default=20)
+    parser.add_argument("--streaming", action="store_true")
+    parser.add_argument("--currencies", help="Comma-separated quote currencies (default: ETL_CURRENCIES)")
+    parser.add_argument("--once", action="store_true", help="Run once under the lease and exit")
+    parser.add_argument("--serve-snapshot", action="store_true",
+                        help="Also serve the latest snapshot from memory over HTTP (see snapshot_service)")
+    parser.add_argument("--snapshot-port", type=int, default=SNAPSHOT_PORT)
+    args = parser.parse_args(argv)
+    currencies = currency_args(parser, args)
+
+    configure_logging("scheduler")
+    snapshot_store = None
+    if args.serve_snapshot and not args.once:
+        snapshot_store = get_store()
+        start_server(snapshot_store, port=args.snapshot_port)
+    scheduler = Scheduler(
+        interval=args.interval, jitter=args.jitter,
+        run_kwargs={"pages": args.pages, "per_page": args.per_page, "streaming": args.streaming,
+                    "currencies": currencies},
+        snapshot_store=snapshot_store
+    )
+    if args.once:
+        print(json.dumps(scheduler.run_once(), indent=2))
+    else:
+        scheduler.run_forever()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,308 @@
+import json
+import logging
+import os
+import socket
+import threading
+import uuid
+from collections import OrderedDict
+from datetime import datetime, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+# --- Configuration & Constants ---
+SNAPSHOT_HOST = os.getenv("SNAPSHOT_HOST", "127.0.0.1")
+SNAPSHOT_PORT = int(os.getenv("SNAPSHOT_PORT", "8765"))
+# Orderings precomputed for every snapshot: view -> (field, descending)
+VIEWS = {
+    "market_cap": ("market_cap", True),
+    "gainers": ("price_change_24h", True),
+    "losers": ("price_change_24h", False),
+    "volatility": ("volatility_score", True),
+}
+DEFAULT_TOP_N = 10
+# Rendered responses kept per snapshot (view x limit x fields combinations)
+RENDER_CACHE_SIZE = 256
+# Standalone service: seconds between snapshot-version checks against the backend
+SYNC_INTERVAL = 5.0
+# Stored fields that are not part of the market data
+INTERNAL_FIELDS = {"_id", "content_hash"}
+
+logger = logging.getLogger(__name__)
+
+
+def _json_default(value):
+    if isinstance(value, datetime):
+        if value.tzinfo is None:
+            value = value.replace(tzinfo=timezone.utc)  # pymongo returns naive UTC
+        return value.isoformat()
+    return str(value)
+
+def _sort_key(field, descending):
+    # Missing values always sort last
+    def key(doc):
+        value = doc.get(field)
+        if value is None:
+            return (1, 0.0)
+        return (0, -value if descending else value)
+    return key
+
+
+class Snapshot:
+    """
+    One immutable version of the latest market state.
+
+    Docs are kept in market-cap-rank order, with every VIEWS ordering
+    precomputed, so a request only slices a list. Rendered JSON bodies are
+    memoized per (view, limit, fields), so repeated reads of an unchanged
+    snapshot cost a dict lookup.
+    """
+
+    def __init__(self, docs, generation, token):
+        self.generation = generation
+        self.published_at = datetime.now(timezone.utc)
+        self.docs = sorted(docs, key=_sort_key("market_cap_rank", False))
+        self.by_id = {doc["coin_id"]: doc for doc in self.docs}
+        self.orderings = {view: sorted(self.docs, key=_sort_key(field, desc)) for view, (field, desc) in VIEWS.items()}
+        self.etag_base = f"{token}-{generation}"
+        self._rendered = OrderedDict()
+        self._lock = threading.Lock()
+
+    def info(self):
+        return {"version": self.etag_base, "count": len(self.docs), "published_at": self.published_at}
+
+    def render(self, kind, key=None, limit=None, fields=None):
+        """
+        Returns (etag, JSON bytes) for "snapshot"/"top" (key = view, None for rank
+        order) or "coin" (key = coin_id). Raises KeyError for an unknown view or coin.
+        """
+        cache_key = (kind, key, limit, fields)
+        with self._lock:
+            cached = self._rendered.get(cache_key)
+            if cached is not None:
+                self._rendered.move_to_end(cache_key)
+                return cached
+
+        if kind == "coin":
+            payload = self._project(self.by_id[key], fields)
+        else:
+            docs = self.docs if key is None else self.orderings[key]
+            docs = docs[:limit] if limit else docs
+            payload = {**self.info(), "view": key or "rank", "coins": [self._project(doc, fields) for doc in docs]}
+        body = json.dumps(payload, default=_json_default, separators=(",", ":")).encode("utf-8")
+        etag = f'"{self.etag_base}-{abs(hash(cache_key)):x}"'
+
+        with self._lock:
+            self._rendered[cache_key] = (etag, body)
+            if len(self._rendered) > RENDER_CACHE_SIZE:
+                self._rendered.popitem(last=False)
+        return etag, body
+
+    @staticmethod
+    def _project(doc, fields):
+        if fields is None:
+            return doc
+        return {"coin_id": doc["coin_id"], **{field: doc[field] for field in fields if field in doc}}
+
+
+class SnapshotStore:
+    """
+    Holds the current Snapshot and swaps in a new one per publish.
+
+    Readers take the current reference without locking. publish() merges
+    docs by coin_id, so partial batches (streaming mode, spool drains) keep
+    the rest of the snapshot; load()/sync() replace it from the backend.
+    """
+
+    def __init__(self):
+        self.token = uuid.uuid4().hex[:8]  # keeps ETags from an earlier process from matching
+        self.generation = 0
+        self.source_version = None
+        self._publish_lock = threading.Lock()
+        self.current = Snapshot([], 0, self.token)
+
+    def publish(self, docs, replace=False):
+        with self._publish_lock:
+            merged = {} if replace else dict(self.current.by_id)
+            for doc in docs:
+                merged[doc["coin_id"]] = {k: v for k, v in doc.items() if k not in INTERNAL_FIELDS}
+            self.generation += 1
+            self.current = Snapshot(merged.values(), self.generation, self.token)
+        logger.info(f"Published snapshot {self.current.etag_base} with {len(self.current.docs)} coins")
+        return self.current
+
+    def load(self, backend):
+        version = backend.snapshot_version()
+        self.publish(backend.latest(), replace=True)
+        self.source_version = version
+
+    def sync(self, backend):
+        """
+        Reloads from the backend when its snapshot version moved (one tiny read per call).
+        """
+        if backend.snapshot_version() != self.source_version:
+            self.load(backend)
+            return True
+        return False
+
+
+class SnapshotHandler(BaseHTTPRequestHandler):
+    """
+    GET /snapshot[?view=&limit=&fields=], /top/<view>[?n=&fields=], /coins/<coin_id>[?fields=], /version.
+    Every 200 carries an ETag; a matching If-None-Match gets an empty 304.
+    """
+
+    store = None
+    protocol_version = "HTTP/1.1"
+
+    def setup(self):
+        super().setup()
+        # Headers and body go out as separate writes; without this, keep-alive
+        # clients wait out a delayed ACK (~40 ms) on every request
+        self.connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        query = parse_qs(url.query)
+        parts = [part for part in url.path.split("/") if part]
+        snapshot = self.store.current
+
+        try:
+            fields = tuple(sorted(f for f in query["fields"][0].split(",") if f)) if "fields" in query else None
+            if parts == ["version"]:
+                self._send(200, None, json.dumps(snapshot.info(), default=_json_default).encode("utf-8"))
+                return
+            if parts == ["snapshot"]:
+                view = query.get("view", [None])[0]
+                limit = int(query.get("limit", ["0"])[0]) or None
+                etag, body = snapshot.render("snapshot", view, limit, fields)
+            elif len(parts) == 2 and parts[0] == "top":
+                limit = int(query.get("n", [str(DEFAULT_TOP_N)])[0])
+                etag, body = snapshot.render("top", parts[1], limit, fields)
+            elif len(parts) == 2 and parts[0] == "coins":
+                etag, body = snapshot.render("coin", parts[1], None, fields)
+            else:
+                self._send(404, None, b'{"error":"not found"}')
+                return
+        except KeyError as e:
+            self._send(404, None, json.dumps({"error": f"unknown {e}"}).encode("utf-8"))
+            return
+        except ValueError as e:
+            self._send(400, None, json.dumps({"error": str(e)}).encode("utf-8"))
+            return
+
+        if etag in (tag.strip() for tag in self.headers.get("If-None-Match", "").split(",")):
+            self._send(304, etag, b"")
+        else:
+            self._send(200, etag, body)
+
+    def _send(self, status, etag, body):
+        self.send_response(status)
+        if etag:
+            self.send_header("ETag", etag)
+            self.send_header("Cache-Control", "no-cache")
+        if status != 304:
+            self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logger.debug(f"{self.address_string()} {format % args}")
+
+
+def start_server(store=None, host=SNAPSHOT_HOST, port=SNAPSHOT_PORT):
+    """
+    Serves `store` (default: the process-wide one) from a background thread; returns the server.
+    """
+    handler = type("BoundSnapshotHandler", (SnapshotHandler,), {"store": store or get_store()})
+    server = ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="snapshot-http", daemon=True).start()
+    logger.info(f"Snapshot service listening on http://{host}:{server.server_address[1]}")
+    return server
+
+
+class SnapshotClient:
+    """
+    Reads from a snapshot service, revalidating with If-None-Match so an
+    unchanged snapshot costs a bodyless 304 and no JSON parsing.
+    """
+
+    def __init__(self, base_url, timeout=5.0):
+        import requests
+        self.base_url = base_url.rstrip("/")
+        self.timeout = timeout
+        self.session = requests.Session()
+        self._cache = {}
+
+    def get(self, path, **params):
+        key = (path, tuple(sorted(params.items())))
+        cached = self._cache.get(key)
+        headers = {"If-None-Match": cached[0]} if cached else {}
+        response = self.session.get(f"{self.base_url}{path}", params=params, headers=headers, timeout=self.timeout)
+        if response.status_code == 304 and cached:
+            return cached[1]
+        response.raise_for_status()
+        payload = response.json()
+        if response.headers.get("ETag"):
+            self._cache[key] = (response.headers["ETag"], payload)
+        return payload
+
+
+_store = None
+_store_lock = threading.Lock()
+
+def get_store():
+    """
+    Returns the process-wide snapshot store, creating it on first use.
+    """
+    global _store
+    with _store_lock:
+        if _store is None:
+            _store = SnapshotStore()
+    return _store
+
+def publish(docs):
+    """
+    Feeds freshly upserted latest docs to the store (a no-op when this process serves no snapshot).
+    """
+    store = _store
+    if store is not None:
+        from market_batch import as_docs
+        store.publish(as_docs(docs))
+
+
+def main(argv=None):
+    """
+    Serves the snapshot standalone, polling the backend for new versions (`crypto-etl snapshot`).
+    """
+    import argparse
+    import time
+    from log_setup import configure_logging
+    from storage import get_backend
+
+    parser = argparse.ArgumentParser(description="Serve the latest market snapshot from memory.")
+    parser.add_argument("--host", default=SNAPSHOT_HOST)
+    parser.add_argument("--port", type=int, default=SNAPSHOT_PORT)
+    parser.add_argument("--sync-interval", type=float, default=SYNC_INTERVAL)
+    args = parser.parse_args(argv)
+
+    configure_logging("snapshot_service")
+
+    backend = get_backend()
+    store = get_store()
+    store.load(backend)
+    server = start_server(store, args.host, args.port)
+    try:
+        # Another process runs the pipeline; only the version counter is polled
+        while True:
+            time.sleep(args.sync_interval)
+            try:
+                store.sync(backend)
+            except Exception as e:
+                logger.warning(f"Snapshot sync failed: {e}")
+    except KeyboardInterrupt:
+        server.shutdown()
+
+if __name__ == "__main__":
+    main()
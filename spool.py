@@ -0,0 +1,399 @@
+import glob
+import json
+import os
+import time
+import uuid
+import logging
+import threading
+from datetime import datetime, timezone
+from file_lock import file_lock
+import metrics
+
+# --- Configuration & Constants ---
+STATE_DIR = "state"
+SPOOL_DIR = os.path.join(STATE_DIR, "spool")
+MAX_SEGMENT_BYTES = 16 * 1024 * 1024
+# Consecutive spooled batches of one kind are merged into bulk writes of up to this many docs
+DRAIN_BATCH_DOCS = 5000
+# Seconds between drain attempts while the database keeps failing
+DRAIN_BACKOFF = [1, 2, 5, 10, 30, 60]
+# A record that fails this many drains in a row is moved to the dead-letter file
+MAX_DRAIN_ATTEMPTS = 20
+# Idle drainer wake-up interval (a wake() call short-cuts it)
+DRAIN_POLL_SECONDS = 30.0
+
+KINDS = ("latest", "history")
+
+logger = logging.getLogger(__name__)
+
+
+def _encode(value):
+    if isinstance(value, datetime):
+        return {"$date": value.isoformat()}
+    return str(value)
+
+def _decode(obj):
+    if len(obj) == 1 and "$date" in obj:
+        return datetime.fromisoformat(obj["$date"])
+    return obj
+
+
+class Spool:
+    """
+    Append-only, fsync'd write-ahead log of transformed batches.
+
+    Each record is one NDJSON line {id, kind, at, docs} in
+    segment_NNNNNN.ndjson files. A separate cursor (segment, offset) marks
+    how far the drainer has applied the log; it only moves after the
+    database write succeeded, so a crash in between replays the record, and
+    the writes it replays (latest upsert by coin_id, history deduplicated on
+    (coin_id, last_updated)) are idempotent. Fully drained segments are
+    deleted.
+    """
+
+    def __init__(self, root=SPOOL_DIR, max_segment_bytes=MAX_SEGMENT_BYTES):
+        self.root = root
+        self.max_segment_bytes = max_segment_bytes
+        self.cursor_path = os.path.join(root, "cursor.json")
+        self.dead_letter_path = os.path.join(root, "dead_letter.ndjson")
+        self.append_lock = os.path.join(root, "append.lock")
+        self.drain_lock = os.path.join(root, "drain.lock")
+        os.makedirs(root, exist_ok=True)
+
+    # --- Writing ---
+    def _segments(self):
+        return sorted(glob.glob(os.path.join(self.root, "segment_*.ndjson")))
+
+    def _fsync_dir(self):
+        if hasattr(os, "O_DIRECTORY"):
+            fd = os.open(self.root, os.O_RDONLY | os.O_DIRECTORY)
+            try:
+                os.fsync(fd)
+            finally:
+                os.close(fd)
+
+    @staticmethod
+    def _ends_with_newline(path):
+        with open(path, "rb") as f:
+            f.seek(-1, os.SEEK_END)
+            return f.read(1) == b"\n"
+
+    def append(self, kind, docs, run_id=None):
+        """
+        Durably appends one batch and returns its record id. Returns once the
+        bytes are fsync'd, so the batch survives a crash or power loss.
+        `run_id` (the run that produced it) is kept for the drained write.
+        """
+        if kind not in KINDS:
+            raise ValueError(f"Unknown spool record kind: {kind}")
+        record_id = uuid.uuid4().hex
+        # A failed insert_many may already have stamped Mongo _ids on the docs
+        docs = [{k: v for k, v in doc.items() if k != "_id"} for doc in docs]
+        record = {"id": record_id, "kind": kind, "at": datetime.now(timezone.utc), "docs": docs}
+        if run_id is not None:
+            record["run_id"] = run_id
+        line = json.dumps(record, default=_encode, separators=(",", ":")) + "\n"
+
+        with file_lock(self.append_lock):
+            segments = self._segments()
+            path = segments[-1] if segments else None
+            if path is None or os.path.getsize(path) >= self.max_segment_bytes:
+                seq = int(os.path.basename(path)[len("segment_"):-len(".ndjson")]) + 1 if path else 1
+                path = os.path.join(self.root, f"segment_{seq:06d}.ndjson")
+            is_new = not os.path.exists(path)
+            with open(path, "ab") as f:
+                # Terminate a line torn by a crash, so it cannot swallow this record
+                if f.tell() and not self._ends_with_newline(path):
+                    f.write(b"\n")
+                f.write(line.encode("utf-8"))
+                f.flush()
+                os.fsync(f.fileno())
+            if is_new:
+                self._fsync_dir()
+
+        metrics.incr("spool_bytes", len(line))
+        logger.info(f"Spooled {len(docs)} {kind} docs as {record_id} in {os.path.basename(path)}")
+        return record_id
+
+    # --- Reading ---
+    def read_cursor(self):
+        try:
+            with open(self.cursor_path) as f:
+                cursor = json.load(f)
+            return cursor["segment"], cursor["offset"]
+        except (FileNotFoundError, json.JSONDecodeError, KeyError):
+            return None, 0
+
+    def _write_cursor(self, segment, offset):
+        tmp_path = f"{self.cursor_path}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump({"segment": segment, "offset": offset, "updated_at": datetime.now(timezone.utc).isoformat()}, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.cursor_path)
+
+    def pending(self):
+        """
+        Yields (segment, end_offset, record) for every record after the cursor, oldest first.
+        A trailing line without a newline in the newest segment is a write still
+        in progress and ends the scan; in an older segment it was torn by a
+        crash before the rollover, and is skipped.
+        """
+        cursor_segment, cursor_offset = self.read_cursor()
+        segments = self._segments()
+        for path in segments:
+            segment = os.path.basename(path)
+            if cursor_segment is not None and segment < cursor_segment:
+                continue
+            offset = cursor_offset if segment == cursor_segment else 0
+            with open(path, "rb") as f:
+                f.seek(offset)
+                for raw in f:
+                    if not raw.endswith(b"\n"):
+                        if path == segments[-1]:
+                            return
+                        logger.error(f"Skipping torn spool record at the end of {segment} ({len(raw)} bytes)")
+                        break
+                    offset += len(raw)
+                    try:
+                        record = json.loads(raw, object_hook=_decode)
+                    except json.JSONDecodeError:
+                        logger.error(f"Skipping corrupt spool record in {segment} before offset {offset}")
+                        continue
+                    yield segment, offset, record
+
+    def has_pending(self):
+        """
+        Returns True when at least one record is waiting after the cursor (reads one line at most).
+        """
+        return next(self.pending(), None) is not None
+
+    def oldest_pending(self, kind="history"):
+        """
+        Returns the earliest extracted_at among `kind` docs waiting after the cursor, or None.
+        """
+        oldest = None
+        for _, _, record in self.pending():
+            if record.get("kind") != kind:
+                continue
+            for doc in record["docs"]:
+                ts = doc.get("extracted_at")
+                if isinstance(ts, datetime) and (oldest is None or ts < oldest):
+                    oldest = ts
+        return oldest
+
+    def commit(self, segment, offset):
+        """
+        Advances the cursor past an applied record and drops fully drained segments.
+        """
+        self._write_cursor(segment, offset)
+        with file_lock(self.append_lock):
+            # The newest segment is kept, so segment numbers never restart below the cursor
+            for path in self._segments()[:-1]:
+                if os.path.basename(path) < segment:
+                    os.remove(path)
+
+    def dead_letter(self, record, error):
+        with open(self.dead_letter_path, "a") as f:
+            f.write(json.dumps({**record, "error": str(error)}, default=_encode, separators=(",", ":")) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+
+    def backlog(self):
+        """
+        Returns the number of records and bytes not yet drained.
+        """
+        records, size = 0, 0
+        cursor_segment, cursor_offset = self.read_cursor()
+        for segment, offset, record in self.pending():
+            records += 1
+        for path in self._segments():
+            segment = os.path.basename(path)
+            if cursor_segment is None or segment > cursor_segment:
+                size += os.path.getsize(path)
+            elif segment == cursor_segment:
+                size += max(os.path.getsize(path) - cursor_offset, 0)
+        return {"records": records, "bytes": size}
+
+
+class SpoolDrainer:
+    """
+    Background thread that applies spooled batches to the storage backend in order.
+
+    Consecutive records of one kind are merged into a single bulk write (for
+    latest docs the newest version of each coin wins). A failing write is
+    retried with backoff; the drain lock keeps one drainer per spool across
+    processes.
+    """
+
+    def __init__(self, spool=None, backend=None):
+        self.spool = spool or get_spool()
+        self.backend = backend
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self._idle = threading.Event()
+        self._thread = None
+        self._attempts = {}
+
+    def _get_backend(self):
+        if self.backend is None:
+            from storage import get_backend
+            self.backend = get_backend()
+        return self.backend
+
+    def _apply(self, kind, docs, run_id=None):
+        backend = self._get_backend()
+        if kind == "latest":
+            result = backend.upsert_latest(docs, run_id=run_id)
+            if not result.get("errors"):
+                from snapshot_service import publish
+                publish(docs)
+        else:
+            result = backend.append_history(docs)
+        if result.get("errors"):
+            raise RuntimeError(f"{result['errors']} of {len(docs)} {kind} docs failed")
+        return result
+
+    def _groups(self, single=False):
+        """
+        Yields (kind, docs, records, (segment, end_offset)) bulk groups from the
+        pending log; with single=True every record is its own group.
+        """
+        group, kind, docs, end = [], None, [], None
+        for segment, offset, record in self.spool.pending():
+            if group and (single or record["kind"] != kind or len(docs) + len(record["docs"]) > DRAIN_BATCH_DOCS):
+                yield kind, docs, group, end
+                group, docs = [], []
+            kind = record["kind"]
+            group.append(record)
+            docs.extend(record["docs"])
+            end = (segment, offset)
+        if group:
+            yield kind, docs, group, end
+
+    def drain(self):
+        """
+        Applies everything spooled so far. Returns {"records", "docs"} applied;
+        raises on a database error (the cursor stays before the failed group).
+        """
+        applied = {"records": 0, "docs": 0}
+        with file_lock(self.spool.drain_lock):
+            # After a failure, go record by record so one bad batch cannot hold back the rest
+            for kind, docs, records, (segment, offset) in self._groups(single=bool(self._attempts)):
+                if kind == "latest":
+                    docs = list({doc["coin_id"]: doc for doc in docs}.values())
+                try:
+                    with metrics.stage("spool_drain"):
+                        # A merged group's snapshot version belongs to its newest record
+                        self._apply(kind, docs, records[-1].get("run_id"))
+                except Exception as e:
+                    key = records[0]["id"]
+                    self._attempts[key] = self._attempts.get(key, 0) + 1
+                    if len(records) == 1 and self._attempts[key] >= MAX_DRAIN_ATTEMPTS:
+                        logger.error(f"Dead-lettering spool record {key} after {self._attempts[key]} attempts: {e}")
+                        self.spool.dead_letter(records[0], e)
+                        self.spool.commit(segment, offset)
+                        continue
+                    raise
+                self.spool.commit(segment, offset)
+                for record in records:
+                    self._attempts.pop(record["id"], None)
+                applied["records"] += len(records)
+                applied["docs"] += len(docs)
+        if applied["records"]:
+            logger.info(f"Drained {applied['records']} spool records ({applied['docs']} docs)")
+        return applied
+
+    def _run(self):
+        failures = 0
+        while not self._stop.is_set():
+            try:
+                self._idle.clear()
+                self.drain()
+                failures = 0
+                self._idle.set()
+                delay = DRAIN_POLL_SECONDS
+            except Exception as e:
+                delay = DRAIN_BACKOFF[min(failures, len(DRAIN_BACKOFF) - 1)]
+                failures += 1
+                logger.warning(f"Spool drain failed ({e}); retrying in {delay}s")
+            self._wake.wait(delay)
+            self._wake.clear()
+
+    def start(self):
+        if self._thread is None or not self._thread.is_alive():
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._run, name="spool-drainer", daemon=True)
+            self._thread.start()
+        return self
+
+    def wake(self):
+        self.start()
+        self._wake.set()
+
+    def flush(self, timeout=30.0):
+        """
+        Wakes the drainer and waits until the spool is empty. Returns False on timeout.
+        """
+        deadline = time.monotonic() + timeout
+        self.start()
+        while True:
+            if not self.spool.backlog()["records"]:
+                return True
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return False
+            self._idle.clear()
+            self._wake.set()
+            self._idle.wait(min(remaining, 1.0))
+
+    def stop(self):
+        self._stop.set()
+        self._wake.set()
+        if self._thread is not None:
+            self._thread.join()
+
+
+_spool = None
+_drainer = None
+_default_lock = threading.Lock()
+
+def get_spool():
+    """
+    Returns the process-wide spool.
+    """
+    global _spool
+    with _default_lock:
+        if _spool is None:
+            _spool = Spool()
+    return _spool
+
+def get_drainer(backend=None):
+    """
+    Returns the process-wide drainer (started on first use), writing to `backend`
+    or, by default, get_backend().
+    """
+    global _drainer
+    spool = get_spool()
+    with _default_lock:
+        if _drainer is None:
+            _drainer = SpoolDrainer(spool, backend)
+        elif backend is not None and _drainer.backend is None:
+            _drainer.backend = backend
+    return _drainer.start()
+
+
+def main(argv=None):
+    """
+    Prints the spool backlog, then drains it once (`crypto-etl spool`).
+    """
+    import argparse
+    from log_setup import configure_logging
+
+    argparse.ArgumentParser(description="Show and drain the local load spool.").parse_args(argv)
+    configure_logging("spool")
+    print(json.dumps(get_spool().backlog(), indent=2))
+    print(json.dumps(SpoolDrainer(get_spool()).drain(), indent=2))
+
+if __name__ == "__main__":
+    main()
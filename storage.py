@@ -0,0 +1,665 @@
+import json
+import os
+import sqlite3
+import logging
+import threading
+import uuid
+from abc import ABC, abstractmethod
+from datetime import datetime, timedelta, timezone
+import metrics
+from market_batch import MarketBatch, as_docs
+
+# --- Configuration & Constants ---
+STORAGE_BACKEND = os.getenv("STORAGE_BACKEND", "mongo")
+SQLITE_PATH = os.getenv("SQLITE_PATH", os.path.join("state", "crypto.db"))
+
+# Market fields stored as real columns by the embedded backend
+MARKET_COLUMNS = [
+    "coin_id", "symbol", "name", "current_price", "market_cap", "total_volume",
+    "price_change_24h", "market_cap_rank", "volatility_score", "last_updated", "extracted_at"
+]
+TIMESTAMP_COLUMNS = {"last_updated", "extracted_at"}
+# Fields top_n may order by (each has an index in the embedded backend)
+RANKABLE_FIELDS = {"market_cap", "price_change_24h", "volatility_score", "total_volume", "current_price"}
+# A claimed run request not finished within this many seconds is handed out again
+REQUEST_STALE_SECONDS = 3600
+# Date minus EPOCH gives epoch milliseconds inside aggregations (naive, which BSON treats as UTC)
+EPOCH = datetime(1970, 1, 1)
+
+logger = logging.getLogger(__name__)
+
+
+class StorageBackend(ABC):
+    """
+    Storage operations the pipeline and dashboard rely on.
+    """
+
+    name = None
+
+    def ensure_schema(self):
+        """Creates collections/tables and indexes if needed (cheap after the first call)."""
+
+    @abstractmethod
+    def upsert_latest(self, docs, run_id=None):
+        """
+        Upserts latest-snapshot docs (dicts or a MarketBatch); returns matched/modified/upserted/skipped/errors/total.
+        A change bumps the snapshot version, tagged with the etl_runs `run_id` that wrote it.
+        """
+
+    @abstractmethod
+    def append_history(self, docs):
+        """Appends history rows (dicts or a MarketBatch); returns inserted/duplicates/errors/total."""
+
+    @abstractmethod
+    def query_history(self, coin_id=None, start=None, end=None):
+        """Returns history rows (one coin, or all when coin_id is None) in [start, end], oldest first."""
+
+    @abstractmethod
+    def history_series(self, coin_id, start, end, field="current_price", max_points=None):
+        """Returns [(timestamp, value)] downsampled to at most max_points."""
+
+    def history_by_coin(self, start=None, end=None, field="current_price"):
+        """
+        Returns {coin_id: (epoch seconds, values)} float64 arrays for every coin in
+        [start, end], oldest first. Backends override this with a single grouped query.
+        """
+        import numpy as np
+        from history_query import HISTORY_FIELDS
+
+        if field not in HISTORY_FIELDS:
+            raise ValueError(f"Unsupported history field: {field}")
+        series = {}
+        for row in self.query_history(start=start, end=end):
+            series.setdefault(row["coin_id"], []).append((_to_epoch(row["extracted_at"]), row.get(field)))
+        return {
+            coin_id: (np.array([t for t, _ in points], dtype=np.float64),
+                      np.array([np.nan if v is None else v for _, v in points], dtype=np.float64))
+            for coin_id, points in series.items()
+        }
+
+    @abstractmethod
+    def top_n(self, field, n=10, ascending=False):
+        """Returns the n latest docs ordered by `field`."""
+
+    @abstractmethod
+    def latest(self):
+        """Returns every latest-snapshot doc."""
+
+    @abstractmethod
+    def snapshot_version(self):
+        """Returns a counter that changes whenever the latest snapshot changes."""
+
+    @abstractmethod
+    def record_run(self, run_doc):
+        """Appends one run's metrics document to etl_runs."""
+
+    @abstractmethod
+    def recent_runs(self, limit=200, since=None):
+        """Returns etl_runs documents, newest first."""
+
+    @abstractmethod
+    def acquire_lease(self, name, owner, ttl):
+        """Takes (or renews, for the same owner) an expiring named lease; returns False if someone else holds it."""
+
+    @abstractmethod
+    def release_lease(self, name, owner):
+        """Gives up a lease held by `owner`."""
+
+    @abstractmethod
+    def enqueue_run_request(self, params=None, requested_by=None):
+        """Queues an ETL run request, coalescing with one already pending; returns its request_id."""
+
+    @abstractmethod
+    def claim_run_request(self, owner):
+        """Marks the oldest pending (or stale) request as running and returns it, or None."""
+
+    @abstractmethod
+    def finish_run_request(self, request_id, status, run_id=None):
+        """Closes a claimed request with the run's status."""
+
+    @abstractmethod
+    def recent_run_requests(self, limit=5):
+        """Returns etl_requests documents, newest first."""
+
+    def close(self):
+        pass
+
+
+class MongoBackend(StorageBackend):
+    """
+    The MongoDB/Atlas implementation (crypto_market + crypto_market_history).
+    """
+
+    name = "mongo"
+
+    def __init__(self, db=None):
+        from db_mongo import get_db, ensure_indexes
+        self.db = db if db is not None else get_db()
+        ensure_indexes(self.db)
+        # coin_id -> content hash / newest history version written to this database (see load)
+        self._latest_hashes = {}
+        self._history_versions = {}
+
+    def ensure_schema(self):
+        from db_mongo import ensure_indexes
+        ensure_indexes(self.db)
+
+    def upsert_latest(self, docs, run_id=None):
+        from load import upsert_latest
+        from db_mongo import bump_snapshot_version
+        summary = upsert_latest(self.db, as_docs(docs), hashes=self._latest_hashes)
+        if summary["modified"] or summary["upserted"]:
+            bump_snapshot_version(self.db, run_id=run_id)
+        return summary
+
+    def append_history(self, docs):
+        from load import insert_history
+        from rollups import apply_rollups
+        summary, inserted = insert_history(self.db, as_docs(docs), return_docs=True,
+                                           versions=self._history_versions)
+        # Derived OHLC buckets live next to history in Mongo (timed inside history_insert).
+        # Only rows actually inserted are folded in, so replays and respooled batches
+        # that hit the dedup cache or the unique index are not counted twice.
+        with metrics.stage("rollups"):
+            summary["rollups"] = apply_rollups(self.db, inserted)
+        return summary
+
+    def query_history(self, coin_id=None, start=None, end=None):
+        query = {}
+        if coin_id is not None:
+            query["coin_id"] = coin_id
+        if start or end:
+            query["extracted_at"] = {}
+            if start:
+                query["extracted_at"]["$gte"] = start
+            if end:
+                query["extracted_at"]["$lte"] = end
+        return list(self.db.crypto_market_history.find(query, {"_id": 0}).sort("extracted_at", 1))
+
+    def history_series(self, coin_id, start, end, field="current_price", max_points=None):
+        from history_query import query_history, MAX_POINTS
+        return query_history(self.db, coin_id, start, end, field=field, max_points=max_points or MAX_POINTS)
+
+    def history_by_coin(self, start=None, end=None, field="current_price"):
+        from history_query import HISTORY_FIELDS
+        import numpy as np
+
+        if field not in HISTORY_FIELDS:
+            raise ValueError(f"Unsupported history field: {field}")
+        match = {}
+        if start or end:
+            match["extracted_at"] = {}
+            if start:
+                match["extracted_at"]["$gte"] = start
+            if end:
+                match["extracted_at"]["$lte"] = end
+        # One pass over the (coin_id, extracted_at) index; dates leave the server as epoch ms,
+        # so no datetime objects are decoded per row
+        pipeline = [
+            {"$match": match},
+            {"$sort": {"coin_id": 1, "extracted_at": 1}},
+            {"$group": {"_id": "$coin_id", "t": {"$push": {"$subtract": ["$extracted_at", EPOCH]}}, "v": {"$push": {"$ifNull": [f"${field}", None]}}}},
+        ]
+        series = {}
+        for group in self.db.crypto_market_history.aggregate(pipeline, allowDiskUse=True):
+            series[group["_id"]] = (np.array(group["t"], dtype=np.float64) / 1000.0,
+                                    np.array(group["v"], dtype=np.float64))
+        return series
+
+    def top_n(self, field, n=10, ascending=False):
+        if field not in RANKABLE_FIELDS:
+            raise ValueError(f"Unsupported ranking field: {field}")
+        return list(self.db.crypto_market.find({}, {"_id": 0}).sort(field, 1 if ascending else -1).limit(n))
+
+    def latest(self):
+        return list(self.db.crypto_market.find({}, {"_id": 0}))
+
+    def snapshot_version(self):
+        from db_mongo import get_snapshot_version
+        return get_snapshot_version(self.db)
+
+    def record_run(self, run_doc):
+        self.db.etl_runs.insert_one(dict(run_doc))
+
+    def recent_runs(self, limit=200, since=None):
+        query = {"started_at": {"$gte": since}} if since else {}
+        return list(self.db.etl_runs.find(query, {"_id": 0}).sort("started_at", -1).limit(limit))
+
+    def acquire_lease(self, name, owner, ttl):
+        from pymongo.errors import DuplicateKeyError
+        now = datetime.now(timezone.utc)
+        try:
+            # Matches only a free, expired or own lease; otherwise the upsert collides on _id
+            self.db.meta.find_one_and_update(
+                {"_id": f"lease:{name}", "$or": [{"expires_at": {"$lt": now}}, {"owner": owner}]},
+                {"$set": {"owner": owner, "expires_at": now + timedelta(seconds=ttl), "renewed_at": now}},
+                upsert=True
+            )
+            return True
+        except DuplicateKeyError:
+            return False
+
+    def release_lease(self, name, owner):
+        self.db.meta.delete_one({"_id": f"lease:{name}", "owner": owner})
+
+    def enqueue_run_request(self, params=None, requested_by=None):
+        from pymongo import ReturnDocument
+        from pymongo.errors import DuplicateKeyError
+        for attempt in range(3):
+            try:
+                request = self.db.etl_requests.find_one_and_update(
+                    {"status": "pending"},
+                    {"$setOnInsert": {
+                        "_id": uuid.uuid4().hex, "params": params or {}, "requested_by": requested_by,
+                        "requested_at": datetime.now(timezone.utc),
+                    }},
+                    upsert=True,
+                    return_document=ReturnDocument.AFTER
+                )
+                return request["_id"]
+            except DuplicateKeyError:
+                # A concurrent enqueue inserted the pending request first (the partial
+                # unique index from ensure_indexes allows one); the retry matches it
+                if attempt == 2:
+                    raise
+
+    def claim_run_request(self, owner):
+        from pymongo import ReturnDocument
+        now = datetime.now(timezone.utc)
+        stale = now - timedelta(seconds=REQUEST_STALE_SECONDS)
+        request = self.db.etl_requests.find_one_and_update(
+            {"$or": [{"status": "pending"}, {"status": "running", "claimed_at": {"$lt": stale}}]},
+            {"$set": {"status": "running", "claimed_at": now, "owner": owner}},
+            sort=[("requested_at", 1)],
+            return_document=ReturnDocument.AFTER
+        )
+        if request is not None:
+            request["request_id"] = request.pop("_id")
+        return request
+
+    def finish_run_request(self, request_id, status, run_id=None):
+        self.db.etl_requests.update_one(
+            {"_id": request_id},
+            {"$set": {"status": status, "run_id": run_id, "finished_at": datetime.now(timezone.utc)}}
+        )
+
+    def recent_run_requests(self, limit=5):
+        requests = list(self.db.etl_requests.find({}).sort("requested_at", -1).limit(limit))
+        for request in requests:
+            request["request_id"] = request.pop("_id")
+        return requests
+
+
+def _to_epoch(value):
+    if value is None:
+        return None
+    if value.tzinfo is None:
+        value = value.replace(tzinfo=timezone.utc)
+    return value.timestamp()
+
+def _from_epoch(value):
+    return None if value is None else datetime.fromtimestamp(value, tz=timezone.utc)
+
+
+class SQLiteBackend(StorageBackend):
+    """
+    Embedded backend on a single SQLite file (WAL mode) with real indexes.
+
+    Mirrors the Mongo semantics the pipeline depends on: latest docs keyed by
+    coin_id with content-hash change detection, history deduplicated on
+    (coin_id, last_updated), and a snapshot version counter. Fields beyond
+    MARKET_COLUMNS (e.g. indicators) are kept in a JSON column.
+    """
+
+    name = "sqlite"
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS crypto_market (
+            coin_id TEXT PRIMARY KEY, symbol TEXT, name TEXT, current_price REAL, market_cap REAL,
+            total_volume REAL, price_change_24h REAL, market_cap_rank INTEGER, volatility_score REAL,
+            last_updated REAL, extracted_at REAL, content_hash TEXT, extra TEXT
+        );
+        CREATE INDEX IF NOT EXISTS ix_latest_market_cap ON crypto_market (market_cap);
+        CREATE INDEX IF NOT EXISTS ix_latest_price_change ON crypto_market (price_change_24h);
+        CREATE INDEX IF NOT EXISTS ix_latest_volatility ON crypto_market (volatility_score);
+        CREATE INDEX IF NOT EXISTS ix_latest_volume ON crypto_market (total_volume);
+        CREATE INDEX IF NOT EXISTS ix_latest_price ON crypto_market (current_price);
+
+        CREATE TABLE IF NOT EXISTS crypto_market_history (
+            coin_id TEXT NOT NULL, symbol TEXT, name TEXT, current_price REAL, market_cap REAL,
+            total_volume REAL, price_change_24h REAL, market_cap_rank INTEGER, volatility_score REAL,
+            last_updated REAL, extracted_at REAL NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS ix_history_extracted_at ON crypto_market_history (extracted_at);
+        CREATE INDEX IF NOT EXISTS ix_history_coin_time ON crypto_market_history (coin_id, extracted_at);
+        CREATE UNIQUE INDEX IF NOT EXISTS ux_history_coin_version
+            ON crypto_market_history (coin_id, last_updated) WHERE last_updated IS NOT NULL;
+
+        CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value INTEGER NOT NULL);
+
+        CREATE TABLE IF NOT EXISTS etl_runs (run_id TEXT PRIMARY KEY, started_at REAL NOT NULL, doc TEXT NOT NULL);
+        CREATE INDEX IF NOT EXISTS ix_etl_runs_started_at ON etl_runs (started_at);
+
+        CREATE TABLE IF NOT EXISTS leases (name TEXT PRIMARY KEY, owner TEXT NOT NULL, expires_at REAL NOT NULL);
+        CREATE TABLE IF NOT EXISTS etl_requests (
+            request_id TEXT PRIMARY KEY, status TEXT NOT NULL, params TEXT, requested_by TEXT,
+            requested_at REAL NOT NULL, claimed_at REAL, owner TEXT, finished_at REAL, run_id TEXT
+        );
+        CREATE INDEX IF NOT EXISTS ix_etl_requests_status ON etl_requests (status, requested_at);
+    """
+
+    def __init__(self, path=SQLITE_PATH):
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.path = path
+        self._lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.row_factory = sqlite3.Row
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self._schema_ready = False
+        self.ensure_schema()
+
+    def ensure_schema(self):
+        if self._schema_ready:
+            return
+        with self._lock:
+            self.conn.executescript(self.SCHEMA)
+            self._schema_ready = True
+
+    # --- Row conversion ---
+    @staticmethod
+    def _market_values(doc):
+        return [
+            _to_epoch(doc.get(col)) if col in TIMESTAMP_COLUMNS else doc.get(col)
+            for col in MARKET_COLUMNS
+        ]
+
+    @staticmethod
+    def _row_to_doc(row):
+        doc = {}
+        for key in row.keys():
+            value = row[key]
+            if key in TIMESTAMP_COLUMNS:
+                value = _from_epoch(value)
+            elif key == "extra":
+                if value:
+                    doc.update(json.loads(value))
+                continue
+            doc[key] = value
+        return doc
+
+    # --- Writes ---
+    def upsert_latest(self, docs, run_id=None):
+        from load import content_hash
+
+        docs = as_docs(docs)
+        summary = {"matched": 0, "modified": 0, "upserted": 0, "skipped": 0, "errors": 0, "total": len(docs)}
+        if not docs:
+            return summary
+
+        with self._lock, self.conn:
+            ids = [doc["coin_id"] for doc in docs]
+            known = {}
+            for start in range(0, len(ids), 500):
+                chunk = ids[start:start + 500]
+                placeholders = ",".join("?" * len(chunk))
+                for row in self.conn.execute(
+                        f"SELECT coin_id, content_hash FROM crypto_market WHERE coin_id IN ({placeholders})", chunk):
+                    known[row["coin_id"]] = row["content_hash"]
+
+            rows = []
+            for doc in docs:
+                doc_hash = content_hash(doc)
+                if doc["coin_id"] in known:
+                    if known[doc["coin_id"]] == doc_hash:
+                        summary["skipped"] += 1
+                        continue
+                    summary["matched"] += 1
+                    summary["modified"] += 1
+                else:
+                    summary["upserted"] += 1
+                extra = {k: v for k, v in doc.items() if k not in MARKET_COLUMNS and k not in ("_id", "content_hash")}
+                rows.append(self._market_values(doc) + [doc_hash, json.dumps(extra, default=str) if extra else None])
+
+            columns = MARKET_COLUMNS + ["content_hash", "extra"]
+            updates = ", ".join(f"{col} = excluded.{col}" for col in columns if col != "coin_id")
+            self.conn.executemany(
+                f"INSERT INTO crypto_market ({', '.join(columns)}) VALUES ({', '.join('?' * len(columns))}) "
+                f"ON CONFLICT(coin_id) DO UPDATE SET {updates}",
+                rows
+            )
+            if rows:
+                self.conn.execute(
+                    "INSERT INTO meta (key, value) VALUES ('snapshot_version', 1) "
+                    "ON CONFLICT(key) DO UPDATE SET value = value + 1"
+                )
+                # The run that wrote this version, as Mongo's meta.snapshot.run_id
+                if run_id is None:
+                    self.conn.execute("DELETE FROM meta WHERE key = 'snapshot_run_id'")
+                else:
+                    self.conn.execute(
+                        "INSERT INTO meta (key, value) VALUES ('snapshot_run_id', ?) "
+                        "ON CONFLICT(key) DO UPDATE SET value = excluded.value", (run_id,)
+                    )
+
+        logger.info(f"SQLite Upsert Summary: {summary}")
+        return summary
+
+    def append_history(self, docs):
+        summary = {"inserted": 0, "duplicates": 0, "errors": 0, "total": len(docs)}
+        if not docs:
+            return summary
+        with self._lock, self.conn:
+            before = self.conn.total_changes
+            # A MarketBatch binds its columns directly, without building dicts or datetimes
+            rows = docs.market_rows() if isinstance(docs, MarketBatch) else (self._market_values(doc) for doc in docs)
+            # Only a repeated (coin_id, last_updated) is skipped; NOT NULL and other errors still raise
+            self.conn.executemany(
+                f"INSERT INTO crypto_market_history ({', '.join(MARKET_COLUMNS)}) "
+                f"VALUES ({', '.join('?' * len(MARKET_COLUMNS))}) "
+                f"ON CONFLICT(coin_id, last_updated) WHERE last_updated IS NOT NULL DO NOTHING",
+                rows
+            )
+            summary["inserted"] = self.conn.total_changes - before
+        summary["duplicates"] = len(docs) - summary["inserted"]
+        logger.info(f"SQLite History Summary: {summary}")
+        return summary
+
+    # --- Reads ---
+    def query_history(self, coin_id=None, start=None, end=None):
+        clauses, params = [], []
+        if coin_id is not None:
+            clauses.append("coin_id = ?")
+            params.append(coin_id)
+        if start is not None:
+            clauses.append("extracted_at >= ?")
+            params.append(_to_epoch(start))
+        if end is not None:
+            clauses.append("extracted_at <= ?")
+            params.append(_to_epoch(end))
+        where = f"WHERE {' AND '.join(clauses)}" if clauses else ""
+        with self._lock:
+            rows = self.conn.execute(
+                f"SELECT * FROM crypto_market_history {where} ORDER BY extracted_at", params).fetchall()
+        return [self._row_to_doc(row) for row in rows]
+
+    def history_series(self, coin_id, start, end, field="current_price", max_points=None):
+        from history_query import lttb, HISTORY_FIELDS, MAX_POINTS, OVERSAMPLE
+        import numpy as np
+
+        if field not in HISTORY_FIELDS:
+            raise ValueError(f"Unsupported history field: {field}")
+        max_points = max_points or MAX_POINTS
+        start_s, end_s = _to_epoch(start), _to_epoch(end)
+        bucket_s = max((end_s - start_s) / (max_points * OVERSAMPLE), 1.0)
+
+        with self._lock:
+            rows = self.conn.execute(
+                f"SELECT AVG(extracted_at) AS t, AVG({field}) AS v FROM crypto_market_history "
+                f"WHERE coin_id = ? AND extracted_at BETWEEN ? AND ? "
+                f"GROUP BY CAST((extracted_at - ?) / ? AS INTEGER) ORDER BY t",
+                (coin_id, start_s, end_s, start_s, bucket_s)
+            ).fetchall()
+        if not rows:
+            return []
+
+        t = np.array([row["t"] for row in rows], dtype=np.float64)
+        v = np.array([row["v"] if row["v"] is not None else np.nan for row in rows], dtype=np.float64)
+        keep = lttb(t, np.nan_to_num(v), max_points)
+        return [(_from_epoch(t[i]), float(v[i])) for i in keep]
+
+    def history_by_coin(self, start=None, end=None, field="current_price"):
+        from history_query import HISTORY_FIELDS
+        import numpy as np
+
+        if field not in HISTORY_FIELDS:
+            raise ValueError(f"Unsupported history field: {field}")
+        with self._lock:
+            rows = self.conn.execute(
+                f"SELECT coin_id, extracted_at, {field} FROM crypto_market_history "
+                f"WHERE extracted_at BETWEEN ? AND ? ORDER BY coin_id, extracted_at",
+                (_to_epoch(start) if start else float("-inf"), _to_epoch(end) if end else float("inf"))
+            ).fetchall()
+        if not rows:
+            return {}
+
+        coin_ids = [row[0] for row in rows]
+        t = np.array([row[1] for row in rows], dtype=np.float64)
+        v = np.array([row[2] for row in rows], dtype=np.float64)  # NULL becomes NaN
+        # Rows are ordered by coin, so each coin is one contiguous slice
+        bounds = [0] + [i for i in range(1, len(coin_ids)) if coin_ids[i] != coin_ids[i - 1]] + [len(coin_ids)]
+        return {coin_ids[lo]: (t[lo:hi], v[lo:hi]) for lo, hi in zip(bounds, bounds[1:])}
+
+    def top_n(self, field, n=10, ascending=False):
+        if field not in RANKABLE_FIELDS:
+            raise ValueError(f"Unsupported ranking field: {field}")
+        with self._lock:
+            rows = self.conn.execute(
+                f"SELECT * FROM crypto_market ORDER BY {field} {'ASC' if ascending else 'DESC'} LIMIT ?", (n,)
+            ).fetchall()
+        return [self._row_to_doc(row) for row in rows]
+
+    def latest(self):
+        with self._lock:
+            rows = self.conn.execute("SELECT * FROM crypto_market ORDER BY market_cap_rank").fetchall()
+        return [self._row_to_doc(row) for row in rows]
+
+    def snapshot_version(self):
+        with self._lock:
+            row = self.conn.execute("SELECT value FROM meta WHERE key = 'snapshot_version'").fetchone()
+        return row["value"] if row else 0
+
+    def record_run(self, run_doc):
+        with self._lock, self.conn:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO etl_runs (run_id, started_at, doc) VALUES (?, ?, ?)",
+                (run_doc["run_id"], _to_epoch(run_doc["started_at"]), json.dumps(run_doc, default=str))
+            )
+
+    def recent_runs(self, limit=200, since=None):
+        with self._lock:
+            rows = self.conn.execute(
+                "SELECT doc FROM etl_runs WHERE started_at >= ? ORDER BY started_at DESC LIMIT ?",
+                (_to_epoch(since) if since else 0, limit)
+            ).fetchall()
+        runs = []
+        for row in rows:
+            doc = json.loads(row["doc"])
+            doc["started_at"] = datetime.fromisoformat(doc["started_at"])
+            runs.append(doc)
+        return runs
+
+    def acquire_lease(self, name, owner, ttl):
+        now = datetime.now(timezone.utc).timestamp()
+        with self._lock, self.conn:
+            # One statement: inserts a new lease, or takes over an expired/own one
+            cursor = self.conn.execute(
+                "INSERT INTO leases (name, owner, expires_at) VALUES (?, ?, ?) "
+                "ON CONFLICT(name) DO UPDATE SET owner = excluded.owner, expires_at = excluded.expires_at "
+                "WHERE leases.expires_at < ? OR leases.owner = excluded.owner",
+                (name, owner, now + ttl, now)
+            )
+        return cursor.rowcount == 1
+
+    def release_lease(self, name, owner):
+        with self._lock, self.conn:
+            self.conn.execute("DELETE FROM leases WHERE name = ? AND owner = ?", (name, owner))
+
+    @staticmethod
+    def _request_doc(row):
+        doc = dict(row)
+        doc["params"] = json.loads(doc["params"]) if doc["params"] else {}
+        for key in ("requested_at", "claimed_at", "finished_at"):
+            doc[key] = _from_epoch(doc[key])
+        return doc
+
+    def enqueue_run_request(self, params=None, requested_by=None):
+        with self._lock, self.conn:
+            self.conn.execute("BEGIN IMMEDIATE")
+            row = self.conn.execute("SELECT request_id FROM etl_requests WHERE status = 'pending' LIMIT 1").fetchone()
+            if row:
+                return row["request_id"]
+            request_id = uuid.uuid4().hex
+            self.conn.execute(
+                "INSERT INTO etl_requests (request_id, status, params, requested_by, requested_at) "
+                "VALUES (?, 'pending', ?, ?, ?)",
+                (request_id, json.dumps(params or {}), requested_by, datetime.now(timezone.utc).timestamp())
+            )
+        return request_id
+
+    def claim_run_request(self, owner):
+        now = datetime.now(timezone.utc).timestamp()
+        with self._lock, self.conn:
+            self.conn.execute("BEGIN IMMEDIATE")
+            row = self.conn.execute(
+                "SELECT * FROM etl_requests WHERE status = 'pending' OR (status = 'running' AND claimed_at < ?) "
+                "ORDER BY requested_at LIMIT 1",
+                (now - REQUEST_STALE_SECONDS,)
+            ).fetchone()
+            if row is None:
+                return None
+            self.conn.execute(
+                "UPDATE etl_requests SET status = 'running', claimed_at = ?, owner = ? WHERE request_id = ?",
+                (now, owner, row["request_id"])
+            )
+        request = self._request_doc(row)
+        request.update(status="running", claimed_at=_from_epoch(now), owner=owner)
+        return request
+
+    def finish_run_request(self, request_id, status, run_id=None):
+        with self._lock, self.conn:
+            self.conn.execute(
+                "UPDATE etl_requests SET status = ?, run_id = ?, finished_at = ? WHERE request_id = ?",
+                (status, run_id, datetime.now(timezone.utc).timestamp(), request_id)
+            )
+
+    def recent_run_requests(self, limit=5):
+        with self._lock:
+            rows = self.conn.execute(
+                "SELECT * FROM etl_requests ORDER BY requested_at DESC LIMIT ?", (limit,)).fetchall()
+        return [self._request_doc(row) for row in rows]
+
+    def close(self):
+        self.conn.close()
+
+
+_backends = {}
+_backends_lock = threading.Lock()
+
+def get_backend(name=None):
+    """
+    Returns the process-wide backend selected by STORAGE_BACKEND ("mongo" or "sqlite").
+    """
+    name = name or STORAGE_BACKEND
+    with _backends_lock:
+        backend = _backends.get(name)
+        if backend is None:
+            if name == "mongo":
+                backend = MongoBackend()
+            elif name == "sqlite":
+                backend = SQLiteBackend()
+            else:
+                raise ValueError(f"Unknown storage backend: {name}")
+            _backends[name] = backend
+    return backend
@@ -0,0 +1,118 @@
+"""
+The columnar transform (behind transform_markets_batch, used by run_etl and
+replay) must produce exactly what the row-wise transform_markets does.
+
+    python -m pytest tests
+"""
+import glob
+import json
+import math
+import os
+import random
+import sys
+from datetime import datetime, timezone
+
+import pytest
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_ROOT)
+
+from transform import transform_markets, transform_markets_batch, transform_markets_columnar, frame_to_docs
+
+NAN = float("nan")
+NUMERIC_FIELDS = ["current_price", "market_cap", "total_volume", "price_change_percentage_24h", "market_cap_rank"]
+
+
+def markets(n, seed=42):
+    rng = random.Random(seed)
+    return [{
+        "id": f"coin-{i}",
+        "symbol": f"c{i}",
+        "name": f"Coin {i}",
+        "current_price": rng.uniform(0.0001, 70000),
+        "market_cap": rng.randint(0, 10**12),
+        "total_volume": rng.uniform(0, 10**10),
+        "price_change_percentage_24h": rng.uniform(-30, 30),
+        "market_cap_rank": i + 1,
+        "last_updated": "2026-03-01T00:00:00.000Z",
+    } for i in range(n)]
+
+def edge_cases():
+    rows = markets(12)
+    rows[1]["id"] = None                        # dropped: missing coin_id
+    rows[2].pop("id")                           # dropped: missing coin_id
+    rows[3]["current_price"] = None             # null -> 0
+    rows[4]["price_change_percentage_24h"] = None
+    rows[5]["market_cap_rank"] = None           # rank stays None
+    rows[6]["total_volume"] = "123.5"           # numeric string is accepted
+    rows[7]["market_cap"] = "n/a"               # dropped: bad cast
+    rows[8]["symbol"] = None                    # str(None).upper() -> "NONE"
+    rows[9].pop("symbol")                       # missing symbol -> ""
+    rows[10]["last_updated"] = "not a date"     # unparsable -> None
+    rows[11].pop("last_updated")
+    return rows
+
+def null_cases(with_strings):
+    # with_strings sends every column down the columnar path's per-value fallback
+    rows = markets(12, seed=7)
+    for field in NUMERIC_FIELDS:
+        rows[0][field] = NAN
+        rows[1][field] = None
+    rows[2]["market_cap_rank"] = float("inf")   # dropped: int(inf) overflows
+    rows[3]["current_price"] = float("inf")     # kept as inf
+    rows[4]["market_cap_rank"] = 5.9            # truncated to 5
+    if with_strings:
+        for field in NUMERIC_FIELDS:
+            rows[5][field] = "7"
+        rows[6]["current_price"] = "nan"        # parsed to NaN -> 0
+        rows[7]["market_cap_rank"] = "nan"      # dropped: int("nan") fails
+    return rows
+
+CASES = {
+    "clean": markets(200),
+    "edge cases": edge_cases(),
+    "null/NaN numeric columns": null_cases(with_strings=False),
+    "null/NaN mixed-type columns": null_cases(with_strings=True),
+    "empty": [],
+}
+for path in sorted(glob.glob(os.path.join(REPO_ROOT, "data_raw", "markets_*.json")))[:3]:
+    with open(path) as f:
+        CASES[os.path.basename(path)] = json.load(f)
+
+
+def assert_same_docs(expected, actual):
+    assert len(actual) == len(expected)
+    for exp, act in zip(expected, actual):
+        assert set(act) == set(exp)
+        for key, value in exp.items():
+            if isinstance(value, float):
+                assert isinstance(act[key], float) and (act[key] == value or math.isnan(value) and math.isnan(act[key])), \
+                    f"{exp['coin_id']}.{key}: {value!r} != {act[key]!r}"
+            else:
+                assert act[key] == value, f"{exp['coin_id']}.{key}: {value!r} != {act[key]!r}"
+
+
+@pytest.mark.parametrize("name", list(CASES))
+def test_columnar_matches_row_wise(name):
+    raw = CASES[name]
+    extracted_at = datetime(2026, 3, 1, 12, tzinfo=timezone.utc)
+    expected = transform_markets(raw, extracted_at=extracted_at)
+    frame, invalid_rows = transform_markets_columnar(raw, extracted_at=extracted_at)
+    assert len(expected) + len(invalid_rows) == len(raw)
+    assert_same_docs(expected, frame_to_docs(frame))
+
+@pytest.mark.parametrize("name", list(CASES))
+def test_batch_matches_row_wise(name):
+    raw = CASES[name]
+    extracted_at = datetime(2026, 3, 1, 12, tzinfo=timezone.utc)
+    assert_same_docs(transform_markets(raw, extracted_at=extracted_at),
+                     transform_markets_batch(raw, extracted_at=extracted_at).to_docs())
+
+def test_nan_and_null_become_zero():
+    docs = {doc["coin_id"]: doc for doc in transform_markets_batch(null_cases(with_strings=True)).to_docs()}
+    for coin_id in ("coin-0", "coin-1"):
+        assert docs[coin_id]["current_price"] == 0.0
+        assert docs[coin_id]["market_cap_rank"] is None
+    assert docs["coin-6"]["current_price"] == 0.0
+    assert docs["coin-4"]["market_cap_rank"] == 5
+    assert "coin-2" not in docs and "coin-7" not in docs
@@ -1,83 +1,315 @@
 import logging
-import os
+import math
 from datetime import datetime, timezone
+# Columns produced by every transform path, in document order
+from market_batch import MarketBatch, DOC_COLUMNS
 
-# --- Setup Logging ---
-LOGS_DIR = "logs"
-os.makedirs(LOGS_DIR, exist_ok=True)
-log_filename = os.path.join(LOGS_DIR, "transform.log")
-
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(levelname)s - %(message)s',
-    handlers=[
-        logging.FileHandler(log_filename),
-        logging.StreamHandler()
-    ]
-)
 logger = logging.getLogger(__name__)
 
-def transform_markets(raw_list):
+def _parse_timestamp(value):
+    """
+    Parses CoinGecko's ISO-8601 timestamps (e.g. 2026-02-28T19:48:40.855Z) to aware UTC datetimes.
+    """
+    if not value:
+        return None
+    try:
+        parsed = datetime.fromisoformat(str(value).replace("Z", "+00:00"))
+    except ValueError:
+        return None
+    if parsed.tzinfo is None:
+        parsed = parsed.replace(tzinfo=timezone.utc)
+    return parsed.astimezone(timezone.utc)
+
+# Per-row problems are tagged with a rate_key, so a feed full of bad rows logs
+# a sample and a suppressed count (see log_setup.RowRateLimit) rather than every row
+def _log_missing_id(index, item):
+    logger.warning(f"Skipping row {index} with missing coin_id (symbol={item.get('symbol')!r})",
+                   extra={"rate_key": "transform.missing_coin_id", "row": index})
+
+def _log_bad_row(coin_id, error):
+    logger.error(f"Error transforming coin {coin_id}: {error}",
+                 extra={"rate_key": "transform.bad_row", "coin_id": coin_id})
+
+def _is_null(value):
+    # NaN (e.g. from a pandas-built feed) counts as missing, like None
+    return value is None or (isinstance(value, float) and math.isnan(value))
+
+def _to_float(value):
+    """
+    `float(value or 0.0)`, with NaN (given or parsed from "nan") also -> 0.
+    """
+    value = float(value or 0.0)
+    return 0.0 if math.isnan(value) else value
+
+def _parse_row(item, extracted_at):
+    """
+    Applies the row rules to one raw item (which must have an id) and returns
+    its doc. Raises ValueError/TypeError/OverflowError for values that do
+    not cast.
+    """
+    # Data Cleaning & Safety Casting (Rule: null or NaN -> 0)
+    current_price = _to_float(item.get("current_price"))
+    market_cap = _to_float(item.get("market_cap"))
+    total_volume = _to_float(item.get("total_volume"))
+
+    # price_change_24h = raw price_change_percentage_24h (as requested)
+    # Rule: Missing price_change_percentage_24h -> 0
+    price_change_24h = _to_float(item.get("price_change_percentage_24h"))
+
+    market_cap_rank = item.get("market_cap_rank")
+    market_cap_rank = None if _is_null(market_cap_rank) else int(market_cap_rank)
+
+    return {
+        "coin_id": item["id"],
+        # Rule: symbol upper-case
+        "symbol": str(item.get("symbol", "")).upper(),
+        "name": item.get("name"),
+        "current_price": current_price,
+        "market_cap": market_cap,
+        "total_volume": total_volume,
+        "price_change_24h": price_change_24h,
+        "market_cap_rank": market_cap_rank,
+        # New Field: volatility_score = abs(price_change_24h) * total_volume
+        "volatility_score": abs(price_change_24h) * total_volume,
+        # Source-side version of this quote; history is deduplicated on (coin_id, last_updated)
+        "last_updated": _parse_timestamp(item.get("last_updated")),
+        "extracted_at": extracted_at
+    }
+
+def transform_markets(raw_list, extracted_at=None):
     """
     Transforms raw CoinGecko market data into a clean, schema-aligned format.
+    `extracted_at` defaults to now; replays pass the snapshot's own timestamp.
     """
     transformed_docs = []
-    extracted_at = datetime.now(timezone.utc)
+    skipped = 0
+    if extracted_at is None:
+        extracted_at = datetime.now(timezone.utc)
     
     logger.info(f"Starting transformation for {len(raw_list)} items.")
     
-    for item in raw_list:
+    for index, item in enumerate(raw_list):
         coin_id = item.get("id")
         
         # Rule: If coin_id missing, skip that row (log warning)
         if not coin_id:
-            logger.warning(f"Skipping row with missing coin_id: {item}")
+            skipped += 1
+            _log_missing_id(index, item)
             continue
             
         try:
-            # Data Cleaning & Safety Casting
-            current_price = float(item.get("current_price") or 0.0)
-            market_cap = float(item.get("market_cap") or 0.0)
-            total_volume = float(item.get("total_volume") or 0.0)
-            
-            # price_change_24h = raw price_change_percentage_24h (as requested)
-            # Rule: Missing price_change_percentage_24h -> 0
-            price_change_24h = float(item.get("price_change_percentage_24h") or 0.0)
-            
-            market_cap_rank = item.get("market_cap_rank")
-            if market_cap_rank is not None:
-                market_cap_rank = int(market_cap_rank)
-            
-            # Rule: symbol upper-case
-            symbol = str(item.get("symbol", "")).upper()
-            
-            # New Field: volatility_score = abs(price_change_24h) * total_volume
-            volatility_score = abs(price_change_24h) * total_volume
-
-            doc = {
-                "coin_id": coin_id,
-                "symbol": symbol,
-                "name": item.get("name"),
-                "current_price": current_price,
-                "market_cap": market_cap,
-                "total_volume": total_volume,
-                "price_change_24h": price_change_24h,
-                "market_cap_rank": market_cap_rank,
-                "volatility_score": volatility_score,
-                "extracted_at": extracted_at
-            }
-            
-            transformed_docs.append(doc)
-            
-        except (ValueError, TypeError) as e:
-            logger.error(f"Error transforming coin {coin_id}: {e}")
+            transformed_docs.append(_parse_row(item, extracted_at))
+        except (ValueError, TypeError, OverflowError) as e:
+            skipped += 1
+            _log_bad_row(coin_id, e)
             continue
 
-    logger.info(f"Transformation complete. Output: {len(transformed_docs)} docs.")
+    logger.info(f"Transformation complete. Output: {len(transformed_docs)} docs ({skipped} skipped).")
     return transformed_docs
 
+def transform_markets_batch(raw_list, extracted_at=None):
+    """
+    Same rules as transform_markets, packed straight into a MarketBatch
+    (typed columns, one shared extracted_at) instead of one dict per coin.
+    The rules run column-at-a-time (as in transform_markets_columnar) and
+    the columns go into the batch's arrays without a DataFrame or per-row
+    dicts; run_etl and replay both come through here.
+    """
+    if extracted_at is None:
+        extracted_at = datetime.now(timezone.utc)
+    
+    logger.info(f"Starting batch transformation for {len(raw_list)} items.")
+    columns, invalid_rows = _market_columns(raw_list)
+    for row in invalid_rows:
+        if row["reason"] == "missing coin_id":
+            _log_missing_id(row["index"], raw_list[row["index"]])
+        else:
+            _log_bad_row(row["coin_id"], row["reason"])
+    batch = MarketBatch.from_columns(columns, extracted_at)
+    
+    logger.info(f"Batch transformation complete. Output: {len(batch)} rows ({len(invalid_rows)} skipped).")
+    return batch
+
+# Per-currency quote fields: quote key -> raw /coins/markets field
+QUOTE_FIELDS = {
+    "price": "current_price",
+    "market_cap": "market_cap",
+    "total_volume": "total_volume",
+    "price_change_24h": "price_change_percentage_24h",
+}
+
+def transform_multi_currency(rows_by_currency, base_currency="usd", extracted_at=None):
+    """
+    Merges per-currency /coins/markets pulls into one doc per coin.
+
+    The coin set and the top-level fields come from `base_currency` exactly
+    as in transform_markets; every currency's figures (base included) are
+    added under quotes.<currency>, with the same null -> 0 rule.
+    """
+    docs = transform_markets(rows_by_currency[base_currency], extracted_at=extracted_at)
+
+    quotes = {}
+    for currency, rows in rows_by_currency.items():
+        for item in rows:
+            coin_id = item.get("id")
+            if not coin_id:
+                continue
+            try:
+                quote = {field: _to_float(item.get(source)) for field, source in QUOTE_FIELDS.items()}
+            except (ValueError, TypeError) as e:
+                logger.error(f"Error transforming {currency} quote for coin {coin_id}: {e}",
+                             extra={"rate_key": "transform.bad_quote", "coin_id": coin_id, "currency": currency})
+                continue
+            quotes.setdefault(coin_id, {})[currency] = quote
+
+    for doc in docs:
+        doc["quotes"] = quotes.get(doc["coin_id"], {})
+    logger.info(f"Merged {len(rows_by_currency)} currencies into {len(docs)} docs.")
+    return docs
+
+
+# infer_dtype kinds that NumPy casts exactly like float()/int() would
+_NUMERIC_KINDS = {"integer", "floating", "mixed-integer-float", "empty"}
+
+def _float_column(values):
+    """
+    Vectorized _to_float. Returns (float64 array, invalid mask).
+    """
+    import numpy as np
+    import pandas as pd
+    invalid = np.zeros(len(values), dtype=bool)
+    if pd.api.types.infer_dtype(values, skipna=True) in _NUMERIC_KINDS:
+        # None becomes NaN here and is zeroed below
+        column = np.array(values, dtype=np.float64)
+    else:
+        # Strings or odd types: fall back to exact per-value semantics for this column only
+        column = np.zeros(len(values), dtype=np.float64)
+        for i, value in enumerate(values):
+            try:
+                column[i] = float(value or 0.0)
+            except (ValueError, TypeError):
+                invalid[i] = True
+    # Rule: null or NaN -> 0
+    column[np.isnan(column)] = 0.0
+    return column, invalid
+
+def _rank_column(values):
+    """
+    Vectorized `None if _is_null(value) else int(value)`. Returns (Int64 array, invalid mask).
+    """
+    import numpy as np
+    import pandas as pd
+    invalid = np.zeros(len(values), dtype=bool)
+    if pd.api.types.infer_dtype(values, skipna=True) in _NUMERIC_KINDS:
+        floats = np.array(values, dtype=np.float64)
+        isnull = np.isnan(floats)
+        # int() truncates finite floats and raises on inf
+        invalid = np.isinf(floats)
+        missing = isnull | invalid
+        ranks = np.trunc(np.where(missing, 0.0, floats)).astype(np.int64)
+        return pd.arrays.IntegerArray(ranks, missing), invalid
+
+    ranks = np.zeros(len(values), dtype=np.int64)
+    missing = np.zeros(len(values), dtype=bool)
+    for i, value in enumerate(values):
+        if _is_null(value):
+            missing[i] = True
+            continue
+        try:
+            ranks[i] = int(value)
+        except (ValueError, TypeError, OverflowError):
+            invalid[i] = True
+            missing[i] = True
+    return pd.arrays.IntegerArray(ranks, missing), invalid
+
+def _market_columns(raw_list):
+    """
+    Applies the transform rules column-at-a-time. Returns (columns,
+    invalid_rows): {name: array} for DOC_COLUMNS except extracted_at, holding
+    only the valid rows (last_updated as UTC datetime64), and a list of
+    {"index", "coin_id", "reason"} dicts for every dropped row.
+    """
+    import numpy as np
+    import pandas as pd
+    
+    coin_ids = [item.get("id") for item in raw_list]
+    current_price, bad_price = _float_column([item.get("current_price") for item in raw_list])
+    market_cap, bad_mcap = _float_column([item.get("market_cap") for item in raw_list])
+    total_volume, bad_volume = _float_column([item.get("total_volume") for item in raw_list])
+    price_change_24h, bad_change = _float_column([item.get("price_change_percentage_24h") for item in raw_list])
+    market_cap_rank, bad_rank = _rank_column([item.get("market_cap_rank") for item in raw_list])
+    
+    missing_id = np.fromiter((not coin_id for coin_id in coin_ids), dtype=bool, count=len(coin_ids))
+    valid = ~(missing_id | bad_price | bad_mcap | bad_volume | bad_change | bad_rank)
+    
+    invalid_rows = []
+    for i in np.flatnonzero(~valid):
+        reason = "missing coin_id" if missing_id[i] else "invalid numeric field"
+        invalid_rows.append({"index": int(i), "coin_id": coin_ids[i], "reason": reason})
+    if invalid_rows:
+        logger.warning(f"Dropped {len(invalid_rows)} invalid rows (first: {invalid_rows[0]})")
+    
+    columns = {
+        "coin_id": np.array(coin_ids, dtype=object),
+        "symbol": np.array([str(item.get("symbol", "")).upper() for item in raw_list], dtype=object),
+        "name": np.array([item.get("name") for item in raw_list], dtype=object),
+        "current_price": current_price,
+        "market_cap": market_cap,
+        "total_volume": total_volume,
+        "price_change_24h": price_change_24h,
+        "market_cap_rank": market_cap_rank,
+        "volatility_score": np.abs(price_change_24h) * total_volume,
+        "last_updated": pd.to_datetime(
+            pd.Series([item.get("last_updated") for item in raw_list], dtype=object),
+            utc=True, errors="coerce", format="ISO8601"
+        ).array,
+    }
+    if invalid_rows:
+        columns = {name: values[valid] for name, values in columns.items()}
+    return columns, invalid_rows
+
+def transform_markets_columnar(raw_list, extracted_at=None):
+    """
+    Batch version of transform_markets backed by NumPy/pandas.
+
+    Applies the same rules (null -> 0, upper-case symbols,
+    volatility_score = abs(price_change_24h) * total_volume, rows without
+    coin_id dropped) column-at-a-time instead of per row. Returns
+    (frame, invalid_rows): a DataFrame with DOC_COLUMNS and a list of
+    {"index", "coin_id", "reason"} dicts for every dropped row.
+    """
+    import pandas as pd
+    if extracted_at is None:
+        extracted_at = datetime.now(timezone.utc)
+    
+    logger.info(f"Starting columnar transformation for {len(raw_list)} items.")
+    columns, invalid_rows = _market_columns(raw_list)
+    frame = pd.DataFrame(columns)
+    frame["extracted_at"] = extracted_at
+    
+    logger.info(f"Columnar transformation complete. Output: {len(frame)} rows.")
+    return frame, invalid_rows
+
+def frame_to_docs(frame):
+    """
+    Converts transform_markets_columnar output into transform_markets-style dicts.
+    """
+    import pandas as pd
+    records = frame.astype({"market_cap_rank": object}).to_dict("records")
+    extracted_at = frame["extracted_at"].iloc[0].to_pydatetime() if len(frame) else None
+    for doc in records:
+        if pd.isna(doc["market_cap_rank"]):
+            doc["market_cap_rank"] = None
+        last_updated = doc["last_updated"]
+        doc["last_updated"] = None if pd.isna(last_updated) else last_updated.to_pydatetime()
+        doc["extracted_at"] = extracted_at
+    return records
+
 if __name__ == "__main__":
     from extract import fetch_markets
+    from log_setup import configure_logging
+
+    configure_logging("transform")
     
     try:
         raw_data = fetch_markets(per_page=5) # Small batch for sanity